@@ -6,19 +6,21 @@ as xp65 does not have ants
 example usage:
     python adjust_albedo.py --fpath /path/to/albedo_file.nc --mask_file /path/to/fire_mask.nc --plot
 '''
-import argparse
+# script setup is skipped when qa_plots worker processes (spawn) re-import this file
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Reduces soil albedo by a specified factor within fire-affected areas defined by a mask file.')
+    parser.add_argument('--fpath', help='fpath to albedo file',default='/scratch/fy29/mjl561/cylc-run/ancil_blue_mountains/share/data/ancils/Bluemountains/d0198/qrparm.soil_cci')
+    parser.add_argument('--mask_file', help='path to fire mask NetCDF file', default='/scratch/public/as9583/fire_mask.nc')
+    parser.add_argument('--plot', help='whether to plot result', default=False, action='store_true')
+    args = parser.parse_args()
 
-parser = argparse.ArgumentParser(description='Reduces soil albedo by a specified factor within fire-affected areas defined by a mask file.')
-parser.add_argument('--fpath', help='fpath to albedo file',default='/scratch/fy29/mjl561/cylc-run/ancil_blue_mountains/share/data/ancils/Bluemountains/d0198/qrparm.soil_cci')
-parser.add_argument('--mask_file', help='path to fire mask NetCDF file', default='/scratch/public/as9583/fire_mask.nc')
-parser.add_argument('--plot', help='whether to plot result', default=False, action='store_true')
-args = parser.parse_args()
+    import ants
+    import mule
 
-import ants
 import numpy as np
 import os
-import matplotlib.pyplot as plt
-import mule
 import xarray as xr
 
 ###############################################################################
@@ -60,13 +62,18 @@ def main(original_path):
     print(f"Adjusted albedo range: {cb_adjusted.data[mask].min():.3f} to {cb_adjusted.data[mask].max():.3f}")
     print(f"Number of grid cells modified: {np.sum(mask)}")
 
-    save_adjusted_cube(cb_adjusted, updated_fpath, original_path, stashid)
-
+    # start QA plot in background so it overlaps with saving
+    plot_future = None
     if args.plot:
         print('plotting changes')
         # Get output directory for plots
         output_path = os.path.dirname(original_path)
-        plot_albedo_comparison(cb, cb_adjusted, mask, albedo_reduction_factor, output_path)
+        plot_future = plot_albedo_comparison(cb, cb_adjusted, mask, albedo_reduction_factor, output_path)
+
+    save_adjusted_cube(cb_adjusted, updated_fpath, original_path, stashid)
+
+    if plot_future is not None:
+        plot_future.result()
 
     return
 
@@ -94,30 +101,25 @@ def save_adjusted_cube(cb_adjusted, output_path, original_path, stashid):
         ancil.to_file(output_path)
 
 def plot_albedo_comparison(cb, cb_adjusted, mask, reduction_factor, output_path):
-    """Plot comparison of original vs adjusted albedo and save figure."""
-    
-    fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(15, 5))
+    """Plot comparison of original vs adjusted albedo and save figure.
 
-    # Original albedo
-    im1 = ax1.imshow(cb.data, origin='lower', cmap='Greys_r', vmin=0, vmax=0.3)
-    ax1.set_title('Original Albedo')
-    plt.colorbar(im1, ax=ax1)
+    Panels are rendered in background processes by qa_plots.py. Returns a future.
+    """
 
-    # Adjusted albedo
-    im2 = ax2.imshow(cb_adjusted.data, origin='lower', cmap='Greys_r', vmin=0, vmax=0.3)
-    ax2.set_title(f'Adjusted Albedo (-{reduction_factor*100}% in polygon)')
-    plt.colorbar(im2, ax=ax2)
+    import qa_plots
 
     # Difference (should show the polygon area)
+    _, vmax_diff = qa_plots.colour_limits(cb.data, cb_adjusted.data)
     diff = cb_adjusted.data - cb.data
-    im3 = ax3.imshow(diff, origin='lower', cmap='Blues_r')
-    ax3.set_title('Difference (Adjusted - Original)')
-    plt.colorbar(im3, ax=ax3)
 
-    plt.tight_layout()
-    
-    # Save figure
-    plt.savefig(f'{output_path}/adjusted_albedo.png', bbox_inches='tight')
+    panels = [
+        qa_plots.panel(cb.data, 'Original Albedo', cmap='Greys_r', vmin=0, vmax=0.3),
+        qa_plots.panel(cb_adjusted.data, f'Adjusted Albedo (-{reduction_factor*100}% in polygon)',
+            cmap='Greys_r', vmin=0, vmax=0.3),
+        qa_plots.panel(diff, 'Difference (Adjusted - Original)', cmap='Blues_r', vmin=-vmax_diff, vmax=0),
+    ]
+
+    return qa_plots.submit_figure(panels, ncols=3, fname=f'{output_path}/adjusted_albedo.png')
 
 
 if __name__ == '__main__':
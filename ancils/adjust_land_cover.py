@@ -7,19 +7,22 @@ Example usage:
 
 q
 '''
-import argparse
+# script setup is skipped when qa_plots worker processes (spawn) re-import this file
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Adjust land cover fractions in a UM ancillary file using a fire mask, setting soil and shrub percentages within fire-affected areas.')
+    parser.add_argument('--fpath', help='fpath to land cover file',default='/scratch/fy29/mjl561/cylc-run/ancil_blue_mountains/share/data/ancils/Bluemountains/d0198/qrparm.veg.frac.urb2t')
+    parser.add_argument('--mask_file', help='path to fire mask NetCDF file', default='/scratch/public/as9583/fire_mask.nc')
+    parser.add_argument('--plot', help='whether to plot result', default=False, action='store_true')
+    args = parser.parse_args()
 
-parser = argparse.ArgumentParser(description='Adjust land cover fractions in a UM ancillary file using a fire mask, setting soil and shrub percentages within fire-affected areas.')
-parser.add_argument('--fpath', help='fpath to land cover file',default='/scratch/fy29/mjl561/cylc-run/ancil_blue_mountains/share/data/ancils/Bluemountains/d0198/qrparm.veg.frac.urb2t')
-parser.add_argument('--mask_file', help='path to fire mask NetCDF file', default='/scratch/public/as9583/fire_mask.nc')
-parser.add_argument('--plot', help='whether to plot result', default=False, action='store_true')
-args = parser.parse_args()
+    import ants
+    import mule
 
 import os
-import ants
 import numpy as np
 import xarray as xr
-import mule
 
 ###############################################################################
 
@@ -71,14 +74,19 @@ def main(original_path):
     cb_adjusted = cb.copy()
     cb_adjusted = adjust_land_cover(cb_adjusted, mask, soil_fraction, shrub_fraction)
 
-    save_adjusted_cube(cb_adjusted, updated_fpath, original_path, stashid)
-
+    # start QA plot in background so it overlaps with saving
+    plot_future = None
     if args.plot:
         print('plotting changes')
         # Get output directory for plots
         output_path = os.path.dirname(original_path)
         
-        plot_land_cover(cb_adjusted, output_path)
+        plot_future = plot_land_cover(cb_adjusted, output_path)
+
+    save_adjusted_cube(cb_adjusted, updated_fpath, original_path, stashid)
+
+    if plot_future is not None:
+        plot_future.result()
 
     return
 
@@ -128,23 +136,21 @@ def save_adjusted_cube(cb_adjusted, output_path, original_path, stashid):
         ancil.to_file(output_path)
 
 def plot_land_cover(cb_adjusted, output_path):
-    """Plot all land cover levels and save figure."""
-    import xarray as xr
-    import matplotlib.pyplot as plt
+    """Plot all land cover levels and save figure.
+
+    Panels are rendered in background processes by qa_plots.py. Returns a future.
+    """
+    import qa_plots
 
     pseudo_levels = cb_adjusted.coord('pseudo_level').points
     
-    # Plot all dim_0 levels using xarray
-    ds = xr.DataArray().from_iris(cb_adjusted)
-    ds.plot(col='dim_0', col_wrap=5, cmap='turbo', vmin=0, vmax=1, figsize=(20, 8))
-    
     # Give titles based on pseudo_map levels
+    panels = []
     for i, level in enumerate(pseudo_levels):
         name = list(pseudo_map.keys())[list(pseudo_map.values()).index(level)]
-        plt.gcf().axes[i].set_title(f"{level} - {name}")
+        panels.append(qa_plots.panel(cb_adjusted.data[i], f"{level} - {name}", cmap='turbo', vmin=0, vmax=1))
     
-    # Save figure
-    plt.savefig(f'{output_path}/adjusted_land_cover.png', bbox_inches='tight')
+    return qa_plots.submit_figure(panels, ncols=5, fname=f'{output_path}/adjusted_land_cover.png')
 
 if __name__ == '__main__':
     print('functions loaded')
@@ -14,22 +14,38 @@ The u-dr216 suite currently calls this script with the following command:
 
 Which after processing is:
     python u-dr216/bin/adjust_soil_ics.py --fpath /path/to/RAL3P2_astart --mask_file /path/to/ancils/fire_mask.nc
+
+Reruns are idempotent: the original file is backed up once to <astart>_original (by hard link,
+reflink or copy), the adjusted file is always derived from that backup and committed by an
+atomic rename, and checksums of the soil moisture fields are recorded in <astart>_adjusted.json
+(written before the rename and marked complete after it). If the target already matches the
+recorded output for the same mask and reduction factor, nothing is done. The backup is checked
+against the recorded source checksum before it is adjusted from or replaced.
+
+With --plot, the QA figure is rendered by qa_plots.py (in the same directory as this script),
+so that file must also be copied to u-dr216/bin.
 '''
 
-import argparse
+# script setup is skipped when qa_plots worker processes (spawn) re-import this file
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='adjusts initial condition soil moisture prior to inner nest recon')
+    parser.add_argument('--fpath', help='fpath to startdump',default='/scratch/fy29/mjl561/cylc-run/u-dr216/share/cycle/20200114T0000Z/control/d0198/RAL3P2/ics/RAL3P2_astart')
+    parser.add_argument('--mask_file', help='path to fire mask NetCDF file', default='/scratch/fy29/mjl561/cylc-run/ancil_blue_mountains/share/data/ancils/Bluemountains/d0198/fire_mask.nc')
+    parser.add_argument('--plot', help='whether to plot result to ics dir', default=False, action='store_true')
+    args = parser.parse_args()
 
-parser = argparse.ArgumentParser(description='adjusts initial condition soil moisture prior to inner nest recon')
-parser.add_argument('--fpath', help='fpath to startdump',default='/scratch/fy29/mjl561/cylc-run/u-dr216/share/cycle/20200114T0000Z/control/d0198/RAL3P2/ics/RAL3P2_astart')
-parser.add_argument('--mask_file', help='path to fire mask NetCDF file', default='/scratch/fy29/mjl561/cylc-run/ancil_blue_mountains/share/data/ancils/Bluemountains/d0198/fire_mask.nc')
-parser.add_argument('--plot', help='whether to plot result to ics dir', default=False, action='store_true')
-args = parser.parse_args()
+    import ants
+    import mule
 
-import ants
+import hashlib
+import json
 import numpy as np
-import mule
 import xarray as xr
 import os
 import shutil
+import subprocess
 
 ###############################################################################
 
@@ -41,8 +57,9 @@ def main(original_path):
 
     print(f'processing {original_path}')
 
-    # get soil moisture data
-    cb = ants.load_cube(original_path, constraint='moisture_content_of_soil_layer')
+    backup_fpath = original_path+'_original'
+    record_fpath = original_path+'_adjusted.json'
+    stashid = 9  # for moisture content of soil layer stash m01s00i009
 
     # Load pre-created fire mask
     if os.path.exists(args.mask_file):
@@ -55,25 +72,49 @@ def main(original_path):
         print("Please run create_fire_mask.py first to generate the mask file")
         return
 
-    print('updating files')
+    settings = {
+        'mask_checksum': hashlib.sha256(np.packbits(mask).tobytes()).hexdigest(),
+        'sm_reduction_factor': sm_reduction_factor,
+    }
 
-    # make changes to ics file with mule
-    backup_fpath = original_path+'_original'
-    stashid = 9  # for moisture content of soil layer stash m01s00i009
+    # work out whether the target is unadjusted, or was adjusted by a previous run
+    target_checksum = field_checksum(original_path, stashid)
+    record = read_record(record_fpath)
+
+    if not os.path.exists(backup_fpath):
+        create_backup(original_path, backup_fpath)
+    elif record is not None and record['output_checksum'] == target_checksum:
+        # also covers a run that stopped after the replace but before marking the record complete
+        if all(record[key] == val for key, val in settings.items()):
+            if not record.get('complete', True):
+                write_record(dict(record, complete=True), record_fpath)
+            print('target already adjusted with this mask and reduction factor, nothing to do')
+            return
+        print('target was adjusted with different settings, re-adjusting from backup')
+        check_backup(backup_fpath, record, stashid)
+    elif record is not None and record['source_checksum'] == target_checksum:
+        print('target is unadjusted (previous run stopped before replacing it), adjusting from backup')
+        check_backup(backup_fpath, record, stashid)
+    elif record is not None:
+        print('target has changed since last adjustment (e.g. recon rerun), replacing backup')
+        check_backup(backup_fpath, record, stashid)
+        os.remove(backup_fpath)
+        create_backup(original_path, backup_fpath)
+    elif target_checksum != field_checksum(backup_fpath, stashid):
+        print(f'WARNING: no record of previous adjustment, assuming {backup_fpath} is the original')
+
+    # get soil moisture data (always from the unadjusted backup)
+    cb = ants.load_cube(backup_fpath, constraint='moisture_content_of_soil_layer')
+
+    print('updating files')
 
     cb_adjusted = cb.copy()
     # Broadcast mask to match the shape of cb_adjusted.data
     mask_broadcast = np.broadcast_to(mask, cb_adjusted.data.shape)
     cb_adjusted.data[mask_broadcast] *= sm_reduction_factor
 
-    # Create backup of original file
-    print(f'Creating backup: {backup_fpath}')
-    shutil.copy2(original_path, backup_fpath)
-    
-    # Save adjusted data to original file path (overwriting original)
-    # Use backup file as template to preserve all other fields
-    save_adjusted_cube(cb_adjusted, original_path, backup_fpath, stashid)
-
+    # start QA plot in background so it overlaps with saving
+    plot_future = None
     if args.plot:
         print('plotting changes')
         # Get bounds for plotting (currently using the full domain)
@@ -85,10 +126,88 @@ def main(original_path):
         domain = os.path.basename(original_path).split('_astart')[0]
 
         # Create comprehensive comparison plot
-        plot_soil_moisture_comparison(cb, cb_adjusted, xmin, xmax, ymin, ymax, domain)
+        plot_future = plot_soil_moisture_comparison(cb, cb_adjusted, xmin, xmax, ymin, ymax, domain)
+
+    # Save adjusted data to a temporary file, then atomically replace the original path
+    # Use backup file as template to preserve all other fields
+    tmp_fpath = original_path+'_tmp'
+    save_adjusted_cube(cb_adjusted, tmp_fpath, backup_fpath, stashid)
+    record = dict(settings,
+        source_checksum=field_checksum(backup_fpath, stashid),
+        output_checksum=field_checksum(tmp_fpath, stashid),
+        complete=False,
+        )
+    # record the output before the replace, so a run stopped in between is recognised next time
+    write_record(record, record_fpath)
+    os.replace(tmp_fpath, original_path)
+    write_record(dict(record, complete=True), record_fpath)
+    print(f'replaced {original_path} with adjusted file')
+
+    if plot_future is not None:
+        plot_future.result()
 
     return
 
+def create_backup(original_path, backup_fpath):
+    """Back up the original file by hard link, reflink or copy (in order of preference).
+
+    A hard link is safe because the original path is only ever replaced by rename, never
+    modified in place, so the backup keeps the original contents.
+    """
+
+    try:
+        os.link(original_path, backup_fpath)
+        print(f'Created backup (hard link): {backup_fpath}')
+        return
+    except OSError:
+        pass
+
+    result = subprocess.run(['cp', '--reflink=always', original_path, backup_fpath], capture_output=True)
+    if result.returncode == 0:
+        print(f'Created backup (reflink): {backup_fpath}')
+        return
+
+    print(f'Creating backup (copy): {backup_fpath}')
+    shutil.copy2(original_path, backup_fpath)
+
+def check_backup(backup_fpath, record, stashid):
+    """Raise if the backup no longer matches the source recorded by the last adjustment.
+
+    The backup is the only unadjusted copy, so it is never adjusted from or replaced unless it
+    is the file the recorded adjustment was made from.
+    """
+
+    if field_checksum(backup_fpath, stashid) != record['source_checksum']:
+        raise RuntimeError(f'{backup_fpath} does not match the source recorded in the adjustment record, '
+            'check the backup and the target by hand before rerunning')
+
+def field_checksum(fpath, stashid):
+    """Return a sha256 checksum of the data of all fields with a given STASH code."""
+
+    umfile = mule.AncilFile.from_file(fpath)
+    checksum = hashlib.sha256()
+    for field in umfile.fields:
+        if field.lbuser4 == stashid:
+            checksum.update(np.ascontiguousarray(field.get_data()).tobytes())
+
+    return checksum.hexdigest()
+
+def read_record(record_fpath):
+    """Read the record of a previous adjustment, or None if there is none."""
+
+    if not os.path.exists(record_fpath):
+        return None
+    with open(record_fpath) as f:
+        return json.load(f)
+
+def write_record(record, record_fpath):
+    """Write the adjustment record via an atomic rename."""
+
+    tmp_fpath = record_fpath+'_tmp'
+    with open(tmp_fpath, 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmp_fpath, record_fpath)
+
 def save_adjusted_cube(cb_adjusted, output_path, template_path, stashid):
     """Save the adjusted cube using MULE
     
@@ -122,73 +241,46 @@ def save_adjusted_cube(cb_adjusted, output_path, template_path, stashid):
         ancil.to_file(output_path)
 
 def plot_soil_moisture_comparison(cb, cb_adjusted, xmin, xmax, ymin, ymax, domain, cmap='RdYlBu'):
-    """Plot comparison of original vs adjusted soil moisture for all 4 levels in a 3x4 grid."""
+    """Plot comparison of original vs adjusted soil moisture for all 4 levels in a 3x4 grid.
 
-    import matplotlib.pyplot as plt
+    Panels are rendered in background processes by qa_plots.py. Returns a future.
+    """
+
+    import qa_plots
     
     plotpath = f'{os.path.dirname(args.fpath)}'
     
-    # Convert to xarray for easier plotting
-    ds_orig = xr.DataArray.from_iris(cb)
-    ds_updated = xr.DataArray.from_iris(cb_adjusted)
-    
-    # Rename coordinate if needed
-    if 'soil_model_level_number' in ds_orig.dims:
-        ds_orig = ds_orig.rename({'soil_model_level_number': 'depth'})
-        ds_updated = ds_updated.rename({'soil_model_level_number': 'depth'})
-    
     # Subset to plotting domain
-    ds_orig_subset = ds_orig.sel(latitude=slice(ymin, ymax), longitude=slice(xmin, xmax))
-    ds_updated_subset = ds_updated.sel(latitude=slice(ymin, ymax), longitude=slice(xmin, xmax))
-    
-    # Calculate difference
-    ds_diff = ds_updated_subset - ds_orig_subset
-    
-    # Create figure with 3 rows, 4 columns
-    plt.close('all')
-    fig, axes = plt.subplots(3, 4, figsize=(18, 12), sharey=True, sharex=True)
-    
-    for i in range(4):
-        # Set color limits for this specific soil level
-        vmax_orig = float(ds_orig_subset.isel(depth=i).max())
-        vmin_orig = 0
-        vmax_diff = max(abs(float(ds_diff.isel(depth=i).min())), 
-                       abs(float(ds_diff.isel(depth=i).max())))
-        
-        # Row 1: Original soil moisture
-        im1 = ds_orig_subset.isel(depth=i).plot(
-            ax=axes[0, i], cmap=cmap, vmin=vmin_orig, vmax=vmax_orig,
-        )
-        axes[0, i].set_title(f'Original - Level {i+1}')
-        axes[0, i].set_xlabel('Longitude' if i == 3 else '')
-        axes[0, i].set_ylabel('Latitude' if i == 0 else '')
-        
-        # Row 2: Adjusted soil moisture  
-        im2 = ds_updated_subset.isel(depth=i).plot(
-            ax=axes[1, i], cmap=cmap, vmin=vmin_orig, vmax=vmax_orig,
-        )
-        axes[1, i].set_title(f'Adjusted - Level {i+1}')
-        axes[1, i].set_xlabel('Longitude' if i == 3 else '')
-        axes[1, i].set_ylabel('Latitude' if i == 0 else '')
-        
-        # Row 3: Difference
-        im3 = ds_diff.isel(depth=i).plot(
-            ax=axes[2, i], cmap='RdBu_r', vmin=-vmax_diff, vmax=vmax_diff,
-        )
-        axes[2, i].set_title(f'Difference - Level {i+1}')
-        axes[2, i].set_xlabel('Longitude' if i == 3 else '')
-        axes[2, i].set_ylabel('Latitude' if i == 0 else '')
-    
-    # Add main title
-    fig.suptitle(f'{domain} Soil Moisture Comparison: Original, Adjusted, and Difference', 
-                 fontsize=14, y=0.95)
-    
-    # Save figure
-    plt.savefig(f'{plotpath}/{domain}_soil_moisture_comparison.png', 
-                dpi=200, bbox_inches='tight')
-    plt.close()
+    lons = cb.coord('longitude').points
+    lats = cb.coord('latitude').points
+    ix = (lons >= xmin) & (lons <= xmax)
+    iy = (lats >= ymin) & (lats <= ymax)
+    orig = cb.data[:, iy, :][:, :, ix]
+    adjusted = cb_adjusted.data[:, iy, :][:, :, ix]
+    extent = [lons[ix].min(), lons[ix].max(), lats[iy].min(), lats[iy].max()]
+
+    # Set color limits for all soil levels at once
+    vmax_orig, vmax_diff = qa_plots.colour_limits(orig, adjusted)
+    nlevels = orig.shape[0]
+
+    # Rows: original, adjusted, difference. Columns: soil levels
+    rows = [
+        ('Original', orig, cmap, np.zeros_like(vmax_orig), vmax_orig),
+        ('Adjusted', adjusted, cmap, np.zeros_like(vmax_orig), vmax_orig),
+        ('Difference', adjusted - orig, 'RdBu_r', -vmax_diff, vmax_diff),
+    ]
+    panels = []
+    for label, data, row_cmap, vmins, vmaxs in rows:
+        for i in range(nlevels):
+            panels.append(qa_plots.panel(data[i], f'{label} - Level {i+1}', extent=extent,
+                cmap=row_cmap, vmin=vmins[i], vmax=vmaxs[i],
+                xlabel='Longitude' if i == nlevels-1 else '',
+                ylabel='Latitude' if i == 0 else ''))
     
-    print(f'Saved soil moisture comparison plot: {plotpath}/{domain}_soil_moisture_comparison.png')
+    fname = f'{plotpath}/{domain}_soil_moisture_comparison.png'
+    suptitle = f'{domain} Soil Moisture Comparison: Original, Adjusted, and Difference'
+
+    return qa_plots.submit_figure(panels, ncols=nlevels, fname=fname, suptitle=suptitle)
 
 if __name__ == '__main__':
     print('functions loaded')
@@ -15,16 +15,17 @@ Arguments:
     --polygon       Path to polygon gpkg file containing fire boundaries (default provided)
     --output        Output file for mask file (default provided)
     --area_threshold Minimum polygon area in square degrees (default: 0.005)
+    --cache_dir     Directory for cached polygons from fire_polygons.py (default: ~/.cache/fire_polygons)
+    --level         Simplified geometry level used for the bulk of the grid (default: d0198)
 '''
 
 import argparse
 import ants
-import geopandas as gpd
 import numpy as np
 import os
 import xarray as xr
-from shapely.geometry import Point, Polygon
-from shapely.ops import unary_union
+
+import fire_polygons as fp
 
 parser = argparse.ArgumentParser(description='Create a fire mask NetCDF file from polygon data')
 parser.add_argument('--fpath', help='Template file to get grid structure from', 
@@ -35,6 +36,10 @@ parser.add_argument('--output', help='Output file for mask file',
                     default='/scratch/ng72/as9583/cylc-run/ancil_blue_mountains/share/data/ancils/Bluemountains/d0198/fire_mask.nc')
 parser.add_argument('--area_threshold', type=float, help='Minimum polygon area in square degrees', 
                     default=0.005)
+parser.add_argument('--cache_dir', help='Directory for cached polygons',
+                    default=fp.default_cache_dir)
+parser.add_argument('--level', help='Simplified geometry level used for the bulk of the grid (full, d1100, d0198)',
+                    default='d0198')
 
 args = parser.parse_args()
 
@@ -45,21 +50,10 @@ def main():
     # Load template file to get grid structure
     cb = ants.load_cube(args.fpath, constraint='soil_albedo')
     
-    # Load polygon data
-    gdf = gpd.read_file(args.polygon)
-    print(f"Found {len(gdf)} polygons in the file")
-    
-    # Filter out very small polygons
+    # Create mask (polygons are filtered, unioned and cached by fire_polygons.py)
     print(f"Filtering polygons smaller than {args.area_threshold} square degrees (~{args.area_threshold * 11100:.0f} km2)")
-    gdf['area'] = gdf.geometry.area
-    gdf_filtered = gdf[gdf['area'] >= args.area_threshold]
-    
-    print(f"After filtering: {len(gdf_filtered)} polygons remain")
-    print(f"Removed {len(gdf) - len(gdf_filtered)} small polygons")
-    
-    # Create mask
     print("Creating mask from polygons...")
-    mask = create_mask_from_polygons(cb, gdf_filtered)
+    mask = create_mask_from_polygons(cb, args.polygon)
     
     # Save mask as NetCDF
     save_mask_netcdf(mask, cb, args.output)
@@ -69,32 +63,15 @@ def main():
     print(f"Mask shape: {mask.shape}")
     print(f"Fire-affected grid cells: {np.sum(mask)} ({np.sum(mask)/mask.size*100:.2f}% of domain)")
 
-def create_mask_from_polygons(cb, gdf):
-    """Create a boolean mask from multiple polygons for the cube grid."""
+def create_mask_from_polygons(cb, polygon):
+    """Create a boolean mask from the unioned fire polygons for the cube grid."""
     lons = cb.coord('longitude').points
     lats = cb.coord('latitude').points
-    lon_2d, lat_2d = np.meshgrid(lons, lats)
-    
-    # Initialize combined mask
-    combined_mask = np.zeros_like(lon_2d, dtype=bool)
-    
-    # Iterate through all polygons and combine masks
-    for idx, polygon in enumerate(gdf.geometry):
-        print(f"Processing polygon {idx+1}/{len(gdf)}")
-        polygon_mask = np.zeros_like(lon_2d, dtype=bool)
-        
-        for i in range(lon_2d.shape[0]):
-            for j in range(lon_2d.shape[1]):
-                point = Point(lon_2d[i, j], lat_2d[i, j])
-                polygon_mask[i, j] = polygon.contains(point)
-        
-        # Combine with overall mask using OR operation
-        combined_mask = combined_mask | polygon_mask
-        
-        # Print progress
-        cells_in_polygon = np.sum(polygon_mask)
-        print(f"  Polygon {idx+1}: {cells_in_polygon} grid cells")
-    
+
+    # polygons are kept in their native crs, as the area threshold is in square degrees
+    combined_mask = fp.polygon_mask(lons, lats, polygon, level=args.level,
+        cache_dir=args.cache_dir, area_threshold=args.area_threshold, crs=None)
+
     total_cells = np.sum(combined_mask)
     print(f"Total grid cells in all polygons: {total_cells}")
     
@@ -0,0 +1,190 @@
+'''
+Cached preprocessing of fire polygons.
+
+The fire polygon gpkg files (total_fires.gpkg, merged_fires.gpkg) are read, reprojected,
+filtered by area and unioned by create_fire_mask.py and in most notebooks. This script does
+that once and stores the result as GeoParquet, together with simplified versions of the
+unioned geometry sized to the model grid resolutions.
+
+Masks made with polygon_mask() select exactly the same cells as the full resolution geometry:
+the simplified geometry is used for cells well inside or outside the fire scars, and only cells
+within the simplification error of a boundary are tested against the full geometry.
+
+Requires geopandas >= 0.14 and shapely >= 2.0 (hh5 or xp65 conda/analysis3)
+
+Example usage:
+    python fire_polygons.py --polygon /path/to/polygon.gpkg --cache_dir /path/to/cache
+
+In python:
+    import fire_polygons as fp
+    fires = fp.load_fire_polygons('/path/to/merged_fires.gpkg')
+    mask = fp.polygon_mask(lons, lats, '/path/to/merged_fires.gpkg', level='d0198')
+
+Arguments:
+    --polygon        Path to polygon gpkg file containing fire boundaries (default provided)
+    --cache_dir      Directory to store cached polygons (default: ~/.cache/fire_polygons)
+    --area_threshold Minimum polygon area in square degrees (default: 0.005)
+    --crs            CRS to project polygons to (default: EPSG:7844)
+'''
+
+import hashlib
+import json
+import os
+import numpy as np
+
+oshome = os.getenv('HOME')
+
+###############################################################################
+
+# approximate grid spacing (degrees) of model domains, used to size simplified geometries
+grid_resolutions = {
+    'd1100': 0.11,
+    'd0198': 0.0198,
+}
+
+# simplification tolerance as a fraction of grid spacing
+simplify_fraction = 0.25
+
+default_cache_dir = f'{oshome}/.cache/fire_polygons'
+
+###############################################################################
+
+def get_cache_paths(polygon, cache_dir=None, area_threshold=0.005, crs='EPSG:7844'):
+    """Return cache file paths for polygons and unioned geometries.
+
+    The cache key includes the source file size and modification time, so the cache
+    is rebuilt automatically when the source polygons change."""
+
+    cache_dir = default_cache_dir if cache_dir is None else cache_dir
+
+    stat = os.stat(polygon)
+    key_items = [os.path.abspath(polygon), stat.st_size, stat.st_mtime_ns, area_threshold, str(crs)]
+    key = hashlib.sha1(json.dumps(key_items).encode()).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(polygon))[0]
+
+    return {
+        'polygons': f'{cache_dir}/{stem}_{key}_polygons.parquet',
+        'union': f'{cache_dir}/{stem}_{key}_union.parquet',
+        }
+
+def build_cache(polygon, cache_dir=None, area_threshold=0.005, crs='EPSG:7844'):
+    """Read, filter, project and union fire polygons, and save them as GeoParquet.
+
+    Small polygons are filtered in the native CRS of the file (as in create_fire_mask.py)
+    before projecting to crs. If crs is None the native CRS is kept.
+    """
+
+    import geopandas as gpd
+    import shapely
+
+    paths = get_cache_paths(polygon, cache_dir, area_threshold, crs)
+    os.makedirs(os.path.dirname(paths['polygons']), exist_ok=True)
+
+    print(f'building polygon cache for {polygon}')
+    gdf = gpd.read_file(polygon)
+    print(f"Found {len(gdf)} polygons in the file")
+
+    gdf['area'] = gdf.geometry.area
+    gdf = gdf[gdf['area'] >= area_threshold]
+    print(f"After filtering: {len(gdf)} polygons >= {area_threshold} square degrees")
+
+    if crs is not None:
+        gdf = gdf.to_crs(crs)
+
+    union = shapely.union_all(gdf.geometry.values)
+
+    # full resolution union plus simplified versions for each grid resolution
+    levels, tolerances, errors, geoms = ['full'], [0.], [0.], [union]
+    for level, resolution in grid_resolutions.items():
+        tolerance = simplify_fraction * resolution
+        simple = shapely.simplify(union, tolerance, preserve_topology=True)
+        levels.append(level)
+        tolerances.append(tolerance)
+        # maximum distance between full and simplified boundaries (at least the tolerance)
+        error = shapely.hausdorff_distance(union.boundary, simple.boundary, densify=0.25)
+        errors.append(float(max(error, tolerance)))
+        geoms.append(simple)
+        print(f'  {level}: {shapely.get_num_coordinates(union)} -> {shapely.get_num_coordinates(simple)} vertices')
+
+    union_gdf = gpd.GeoDataFrame(
+        {'level': levels, 'tolerance': tolerances, 'max_error': errors},
+        geometry=geoms, crs=gdf.crs)
+
+    gdf.to_parquet(paths['polygons'])
+    union_gdf.to_parquet(paths['union'])
+    print(f"saved polygon cache: {paths['polygons']}")
+
+    return paths
+
+def load_fire_polygons(polygon, cache_dir=None, area_threshold=0.005, crs='EPSG:7844'):
+    """Return filtered and projected fire polygons as a GeoDataFrame, using the cache if available."""
+
+    import geopandas as gpd
+
+    paths = get_cache_paths(polygon, cache_dir, area_threshold, crs)
+    if not os.path.exists(paths['polygons']):
+        build_cache(polygon, cache_dir, area_threshold, crs)
+
+    return gpd.read_parquet(paths['polygons'])
+
+def load_fire_union(polygon, level='full', cache_dir=None, area_threshold=0.005, crs='EPSG:7844'):
+    """Return the unioned fire geometry at a simplification level, and its maximum error.
+
+    level: 'full' or a key of grid_resolutions (e.g. 'd0198')
+    """
+
+    import geopandas as gpd
+
+    paths = get_cache_paths(polygon, cache_dir, area_threshold, crs)
+    if not os.path.exists(paths['union']):
+        build_cache(polygon, cache_dir, area_threshold, crs)
+
+    union_gdf = gpd.read_parquet(paths['union']).set_index('level')
+    assert level in union_gdf.index, f"level '{level}' not in cache, choose from {list(union_gdf.index)}"
+
+    return union_gdf.geometry[level], float(union_gdf.loc[level, 'max_error'])
+
+def polygon_mask(lons, lats, polygon, level='full', cache_dir=None, area_threshold=0.005, crs='EPSG:7844'):
+    """Create a boolean mask (lat, lon) of grid points inside the fire polygons.
+
+    Uses the simplified geometry for the bulk of the grid and the full geometry only for
+    points within the simplification error of the boundary, so the result is the same as
+    testing every point against the full geometry.
+    """
+
+    import shapely
+
+    lon_2d, lat_2d = np.meshgrid(lons, lats)
+
+    simple, max_error = load_fire_union(polygon, level, cache_dir, area_threshold, crs)
+    shapely.prepare(simple)
+    mask = shapely.contains_xy(simple, lon_2d, lat_2d)
+
+    if level == 'full':
+        return mask
+
+    # retest points close to the simplified boundary with the full geometry
+    boundary = simple.boundary
+    shapely.prepare(boundary)
+    near = shapely.dwithin(boundary, shapely.points(lon_2d, lat_2d), max_error)
+    if np.any(near):
+        full, _ = load_fire_union(polygon, 'full', cache_dir, area_threshold, crs)
+        shapely.prepare(full)
+        mask[near] = shapely.contains_xy(full, lon_2d[near], lat_2d[near])
+    print(f'tested {np.sum(near)} of {mask.size} points against full geometry')
+
+    return mask
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Cache filtered, projected and simplified fire polygons')
+    parser.add_argument('--polygon', help='Path to polygon gpkg file containing fire boundaries',
+                        default='/scratch/public/as9583/total_fires.gpkg')
+    parser.add_argument('--cache_dir', help='Directory to store cached polygons', default=default_cache_dir)
+    parser.add_argument('--area_threshold', type=float, help='Minimum polygon area in square degrees',
+                        default=0.005)
+    parser.add_argument('--crs', help='CRS to project polygons to', default='EPSG:7844')
+    args = parser.parse_args()
+
+    build_cache(args.polygon, args.cache_dir, args.area_threshold, args.crs)
@@ -33,8 +33,12 @@ region = 'Bluemountains'
 
 ancil_path = f'{oshome}/cylc-run/{cylc_dir}/share/data/ancils/{region}'
 plot_path = os.path.dirname(ancil_path) # parent dir of ancil_path
+cache_path = f'{plot_path}/domain_plot_cache' # masked orography and display rasters
 domains = os.listdir(ancil_path) # list of dirs in ancil_path
 
+figsize = (11,9)
+dpi = 300
+
 ############## functions ##############
 
 def plot_domain_orography():
@@ -45,23 +49,7 @@ def plot_domain_orography():
 
     data = {}
     for domain in domains:
-        print(f'loading {domain} data')
-
-        # get land sea mask ancil
-        opts = get_variable_opts('land_sea_mask')
-        fname = f'{ancil_path}/{domain}/{opts["fname"]}'
-        cb = iris.load_cube(fname, constraint=opts["constraint"])
-        lsm = xr.DataArray().from_iris(cb)
-
-        # get orography ancil
-        opts = get_variable_opts('surface_altitude')
-        fname = f'{ancil_path}/{domain}/{opts["fname"]}'
-        cb = iris.load_cube(fname, constraint=opts["constraint"])
-        # convert to xarray and constrain to lsm
-        data[domain] = xr.DataArray().from_iris(cb)
-        # reindex lsm (rounding errors)
-        lsm = lsm.reindex_like(data[domain],method='nearest')
-        data[domain] = data[domain].where(lsm>0)
+        data[domain] = load_domain_orography(domain)
 
     # get resolutions of domains
     rslns = {dom: data[dom].rio.resolution() for dom in domains}
@@ -79,19 +67,26 @@ def plot_domain_orography():
     # cmap = replace_cmap_min_with_white(cmap)
 
     plt.close('all')
-    fig,ax = plt.subplots(nrows=1,ncols=1,figsize=(11,9),
+    fig,ax = plt.subplots(nrows=1,ncols=1,figsize=figsize,
                             sharey=True,sharex=True,
                             subplot_kw={'projection': proj},
                             )
     # update vmax based on outer domain, to nearest 100m
     vmax = np.floor(data[doms[0]].max().values/100)*100 - 100
 
+    # approximate pixels across the outer domain in the saved figure
+    left, bottom, right, top = cf.get_bounds(data[doms[0]])
+    outer_width, outer_px = right-left, figsize[0]*dpi
+
     for domain in doms:
         print(f'plotting {domain}')
-        im = data[domain].plot(ax=ax,cmap=cmap, vmin=opts['vmin'],vmax=vmax,
-            add_colorbar=False, transform=proj)
-        # draw rectangle around domain
         left, bottom, right, top = cf.get_bounds(data[domain])
+        npx = int(np.ceil(outer_px*(right-left)/outer_width))
+        raster, extent = get_display_raster(data[domain], domain, npx)
+        # raster is already in the axes projection, so no reprojection is needed by cartopy
+        im = ax.imshow(raster, origin='lower', extent=extent,
+            cmap=cmap, vmin=opts['vmin'], vmax=vmax, interpolation='nearest', transform=proj)
+        # draw rectangle around domain
         ax.plot([left, right, right, left, left], [bottom, bottom, top, top, bottom], 
             color='red', linewidth=1, linestyle='dashed' if domain=='SY_1' else 'solid')
         # label domain with white border around black text
@@ -116,10 +111,78 @@ def plot_domain_orography():
 
     fname = f'{plot_path}/{region}_domains_{opts["plot_fname"]}.png'
     print(f'saving {fname}')
-    fig.savefig(fname,dpi=300,bbox_inches='tight')
+    fig.savefig(fname,dpi=dpi,bbox_inches='tight')
 
     return
 
+def get_cache_key(domain, *items):
+    """Cache key from the ancil file modification times and any extra items."""
+
+    mtimes = []
+    for variable in ['land_sea_mask', 'surface_altitude']:
+        fname = f'{ancil_path}/{domain}/{get_variable_opts(variable)["fname"]}'
+        mtimes.append(str(os.stat(fname).st_mtime_ns))
+
+    return '_'.join([domain] + mtimes + [str(item) for item in items])
+
+def load_domain_orography(domain):
+    """
+    Load orography for a domain masked by the land sea mask ancil.
+    The result is cached as netcdf, so iris loading and reindexing is only done once.
+    """
+
+    fname = f'{cache_path}/{get_cache_key(domain)}_orog.nc'
+    if os.path.exists(fname):
+        print(f'loading cached {domain} data')
+        return xr.open_dataarray(fname).load()
+
+    print(f'loading {domain} data')
+
+    # get land sea mask ancil
+    opts = get_variable_opts('land_sea_mask')
+    cb = iris.load_cube(f'{ancil_path}/{domain}/{opts["fname"]}', constraint=opts["constraint"])
+    lsm = xr.DataArray().from_iris(cb)
+
+    # get orography ancil
+    opts = get_variable_opts('surface_altitude')
+    cb = iris.load_cube(f'{ancil_path}/{domain}/{opts["fname"]}', constraint=opts["constraint"])
+    # convert to xarray and constrain to lsm
+    da = xr.DataArray().from_iris(cb)
+    # reindex lsm (rounding errors)
+    lsm = lsm.reindex_like(da,method='nearest')
+    da = da.where(lsm>0)
+
+    # iris attributes (e.g. STASH) are not netcdf serialisable
+    da.attrs = {key: str(val) for key, val in da.attrs.items()}
+    os.makedirs(cache_path, exist_ok=True)
+    da.to_netcdf(fname)
+
+    return da
+
+def get_display_raster(da, domain, npx):
+    """
+    Downsample a domain to about npx pixels wide (the resolution it is displayed at),
+    using a block mean. Rasters are cached as npy for each display size.
+    Edge cells that do not fill a block are trimmed, so the extent [left, right, bottom, top]
+    returned with the raster is that of the trimmed cells.
+    """
+
+    factor = max(1, int(da.shape[1] // npx))
+    ny, nx = (da.shape[0]//factor)*factor, (da.shape[1]//factor)*factor
+    left, bottom, right, top = cf.get_bounds(da.isel(latitude=slice(0, ny), longitude=slice(0, nx)))
+    extent = [left, right, bottom, top]
+
+    fname = f'{cache_path}/{get_cache_key(domain, factor)}_raster.npy'
+    if os.path.exists(fname):
+        return np.load(fname), extent
+
+    print(f'downsampling {domain} by {factor} to {da.shape[1]//factor} pixels wide')
+    raster = da.coarsen(latitude=factor, longitude=factor, boundary='trim').mean().values
+    os.makedirs(cache_path, exist_ok=True)
+    np.save(fname, raster)
+
+    return raster, extent
+
 def get_variable_opts(variable):
     '''standard variable options for plotting. to be updated within master script as needed'''
 
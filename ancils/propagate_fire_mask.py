@@ -0,0 +1,205 @@
+'''
+Propagate a fire mask between nested grids (e.g. d0198 RAL3P2 and d1100 GAL9).
+
+Instead of an independent point-in-polygon pass for every domain, the fine grid mask from
+create_fire_mask.py is built once and other grids are derived from it:
+
+    aggregate: coarser grid fire fraction by conservative (area weighted) aggregation of the
+               fine mask. Coarse cells not fully covered by the fine grid are NaN.
+    refine:    finer grid mask. Parent cells fully inside or outside the fire polygons are
+               inherited, and only points in parent cells crossing a scar boundary are tested
+               against the polygons. Parent cells are only classified within the polygon
+               bounding box. The source mask supplies the parent grid, its values are not used
+               (they are point samples, so cannot tell which parent cells are partly burnt).
+
+Cell edges and overlaps are shared with regrid_functions.py, so the repository must be at
+~/git/RNS_Sydney_bushfire.
+
+Requires hh5, i.e.:
+    module use /g/data/hh5/public/modules;module load conda/analysis3
+as xp65 does not have ants
+
+Example usage:
+    python propagate_fire_mask.py --mode aggregate --mask_file /path/to/d0198/fire_mask.nc --fpath /path/to/d1100/qrparm.soil_cci --output /path/to/d1100/fire_fraction.nc
+    python propagate_fire_mask.py --mode refine --mask_file /path/to/d0198/fire_mask.nc --fpath /path/to/d0100/qrparm.soil_cci --polygon /path/to/polygon.gpkg --output /path/to/d0100/fire_mask.nc
+
+Arguments:
+    --mode          aggregate (to coarser grid) or refine (to finer grid)
+    --mask_file     Fire mask NetCDF on the source grid (from create_fire_mask.py)
+    --fpath         Template file to get target grid structure from
+    --polygon       Path to polygon gpkg file (refine mode only)
+    --output        Output NetCDF file
+    --area_threshold Minimum polygon area in square degrees (default: 0.005)
+    --cache_dir     Directory for cached polygons from fire_polygons.py (default: ~/.cache/fire_polygons)
+'''
+
+import os
+import sys
+import numpy as np
+import xarray as xr
+
+oshome=os.getenv('HOME')
+sys.path.append(f'{oshome}/git/RNS_Sydney_bushfire')
+from regrid_functions import cell_edges, overlap_matrix
+
+###############################################################################
+
+def aggregate_mask(mask, src_lons, src_lats, dst_lons, dst_lats):
+    """Conservatively aggregate a (lat, lon) mask to a coarser grid, returning fire fraction.
+
+    The grids are rectilinear, so area weights separate into a longitude overlap and a
+    sin(latitude) overlap, and the aggregation is two small matrix products.
+    Destination cells not fully covered by the source grid are returned as NaN.
+    """
+
+    wx = overlap_matrix(cell_edges(src_lons), cell_edges(dst_lons))
+    wy = overlap_matrix(np.sin(np.deg2rad(cell_edges(src_lats))), np.sin(np.deg2rad(cell_edges(dst_lats))))
+
+    burnt = wy @ mask.astype(float) @ wx.T
+    covered = np.outer(wy.sum(axis=1), wx.sum(axis=1))
+    area = np.outer(np.diff(np.sin(np.deg2rad(cell_edges(dst_lats)))), np.diff(cell_edges(dst_lons)))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = burnt / covered
+    fraction[~np.isclose(covered, area)] = np.nan
+
+    return fraction
+
+def refine_mask(src_lons, src_lats, dst_lons, dst_lats, geometry):
+    """Create a (lat, lon) mask on a finer grid, testing only points in source cells crossing a boundary.
+
+    Source (parent) cells within the geometry bounding box are classified against the geometry as
+    fully inside, fully outside or crossing the boundary (cells beyond it are outside). Destination points inherit the class of their parent cell, and
+    only points in boundary cells, or outside the source grid, are tested individually.
+    The result is the same as testing every destination point against the geometry.
+    """
+
+    import shapely
+
+    shapely.prepare(geometry)
+    src_xe, src_ye = cell_edges(src_lons), cell_edges(src_lats)
+
+    # classify parent cells: 1 inside, 0 outside, -1 boundary
+    # only parent cells overlapping the geometry bounding box are tested, the rest are outside
+    xmin, ymin, xmax, ymax = geometry.bounds
+    near_x = (np.maximum(src_xe[:-1], src_xe[1:]) >= xmin) & (np.minimum(src_xe[:-1], src_xe[1:]) <= xmax)
+    near_y = (np.maximum(src_ye[:-1], src_ye[1:]) >= ymin) & (np.minimum(src_ye[:-1], src_ye[1:]) <= ymax)
+    near = np.outer(near_y, near_x)
+
+    x0, y0 = np.meshgrid(src_xe[:-1], src_ye[:-1])
+    x1, y1 = np.meshgrid(src_xe[1:], src_ye[1:])
+    boxes = shapely.box(x0[near], y0[near], x1[near], y1[near])
+    near_parent = np.full(boxes.shape, -1, dtype=np.int8)
+    near_parent[~shapely.intersects(geometry, boxes)] = 0
+    near_parent[shapely.contains_properly(geometry, boxes)] = 1
+
+    parent = np.zeros(near.shape, dtype=np.int8)
+    parent[near] = near_parent
+    print(f'{np.sum(parent == -1)} of {parent.size} parent cells cross a scar boundary '
+          f'({np.sum(near)} within the polygon bounding box tested)')
+
+    # parent index of each destination point (-1 if outside source grid)
+    ix = np.searchsorted(src_xe, dst_lons) - 1
+    iy = np.searchsorted(src_ye, dst_lats) - 1
+    ix[(ix < 0) | (ix >= len(src_lons))] = -1
+    iy[(iy < 0) | (iy >= len(src_lats))] = -1
+    ix_2d, iy_2d = np.meshgrid(ix, iy)
+    inside_src = (ix_2d >= 0) & (iy_2d >= 0)
+
+    state = np.full(ix_2d.shape, -1, dtype=np.int8)
+    state[inside_src] = parent[iy_2d[inside_src], ix_2d[inside_src]]
+
+    # only test undecided points within the geometry bounding box
+    lon_2d, lat_2d = np.meshgrid(dst_lons, dst_lats)
+    xmin, ymin, xmax, ymax = geometry.bounds
+    in_bbox = (lon_2d >= xmin) & (lon_2d <= xmax) & (lat_2d >= ymin) & (lat_2d <= ymax)
+    state[(state == -1) & ~in_bbox] = 0
+
+    todo = state == -1
+    print(f'testing {np.sum(todo)} of {state.size} points against polygons')
+    mask = state == 1
+    mask[todo] = shapely.contains_xy(geometry, lon_2d[todo], lat_2d[todo])
+
+    return mask
+
+def save_netcdf(data, lons, lats, output_file, name, attrs):
+    """Save a (lat, lon) array as a NetCDF file with the same layout as create_fire_mask.py."""
+
+    da = xr.DataArray(
+        data,
+        coords={'latitude': lats, 'longitude': lons},
+        dims=['latitude', 'longitude'],
+        name=name,
+        attrs=attrs,
+    )
+    da.to_netcdf(output_file)
+    print(f'Saved {name} as NetCDF: {output_file}')
+
+def main(args):
+
+    import ants
+
+    print(f'propagating fire mask ({args.mode}) from: {args.mask_file}')
+    print(f'Using template file: {args.fpath}')
+
+    mask_da = xr.open_dataarray(args.mask_file)
+    mask = mask_da.values.astype(bool)
+    src_lons, src_lats = mask_da.longitude.values, mask_da.latitude.values
+
+    cb = ants.load_cube(args.fpath, constraint='soil_albedo')
+    dst_lons = cb.coord('longitude').points
+    dst_lats = cb.coord('latitude').points
+
+    attrs = {
+        'created_by': 'propagate_fire_mask.py',
+        'source_mask': args.mask_file,
+        'grid_shape': f"{len(dst_lats)} x {len(dst_lons)}",
+    }
+
+    if args.mode == 'aggregate':
+        fraction = aggregate_mask(mask, src_lons, src_lats, dst_lons, dst_lats)
+        attrs.update({
+            'description': 'Fire scar fraction of grid cell (NaN where not covered by source grid)',
+            'units': '1',
+        })
+        save_netcdf(fraction.astype(np.float32), dst_lons, dst_lats, args.output, 'fire_fraction', attrs)
+        print(f"Fire-affected area: {np.nansum(fraction):.1f} grid cells equivalent")
+
+    elif args.mode == 'refine':
+        import fire_polygons as fp
+
+        geometry, _ = fp.load_fire_union(args.polygon, 'full', cache_dir=args.cache_dir,
+            area_threshold=args.area_threshold, crs=None)
+        new_mask = refine_mask(src_lons, src_lats, dst_lons, dst_lats, geometry)
+        attrs.update({
+            'description': 'Fire scar mask (1=fire affected, 0=not affected)',
+            'units': 'dimensionless',
+            'source_polygons': args.polygon,
+            'area_threshold_sq_degrees': args.area_threshold,
+            'total_fire_cells': int(np.sum(new_mask)),
+        })
+        save_netcdf(new_mask.astype(int), dst_lons, dst_lats, args.output, 'fire_mask', attrs)
+        print(f"Fire-affected grid cells: {np.sum(new_mask)} ({np.sum(new_mask)/new_mask.size*100:.2f}% of domain)")
+
+    return
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Propagate a fire mask between nested grids')
+    parser.add_argument('--mode', help='aggregate (to coarser grid) or refine (to finer grid)',
+                        choices=['aggregate', 'refine'], default='aggregate')
+    parser.add_argument('--mask_file', help='Fire mask NetCDF on the source grid',
+                        default='/scratch/ng72/as9583/cylc-run/ancil_blue_mountains/share/data/ancils/Bluemountains/d0198/fire_mask.nc')
+    parser.add_argument('--fpath', help='Template file to get target grid structure from',
+                        default='/scratch/ng72/as9583/cylc-run/ancil_blue_mountains/share/data/ancils/Bluemountains/d1100/qrparm.soil_cci')
+    parser.add_argument('--polygon', help='Path to polygon gpkg file (refine mode only)',
+                        default='/scratch/public/as9583/total_fires.gpkg')
+    parser.add_argument('--output', help='Output NetCDF file',
+                        default='/scratch/ng72/as9583/cylc-run/ancil_blue_mountains/share/data/ancils/Bluemountains/d1100/fire_fraction.nc')
+    parser.add_argument('--area_threshold', type=float, help='Minimum polygon area in square degrees',
+                        default=0.005)
+    parser.add_argument('--cache_dir', help='Directory for cached polygons', default=None)
+    args = parser.parse_args()
+
+    main(args)
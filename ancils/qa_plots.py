@@ -0,0 +1,130 @@
+'''
+Plotting backend for ancil and initial condition QA figures.
+
+Used by adjust_albedo.py, adjust_land_cover.py and adjust_soil_ics.py when run with --plot.
+Colour limits for all levels are computed in one vectorised reduction, each panel is
+rendered with imshow in a separate process (at most one per panel and per PBS_NCPUS), and the
+panels are tiled into a single png. Workers are spawned, so they re-import the calling script
+as __mp_main__: keep argparse and heavy imports (ants, mule) under its __name__ guard.
+submit_figure() runs this in the background so it can overlap with writing the
+adjusted file with mule; call .result() on the returned future before exiting.
+
+Example usage (from an adjust script):
+    import qa_plots
+    orig_vmax, diff_vmax = qa_plots.colour_limits(orig, adjusted)
+    panels = [qa_plots.panel(orig[0], 'Original', extent=extent, vmin=0, vmax=orig_vmax[0])]
+    future = qa_plots.submit_figure(panels, ncols=1, fname='/path/to/plot.png')
+    ...
+    future.result()
+'''
+
+import concurrent.futures
+import multiprocessing
+import os
+import numpy as np
+
+###############################################################################
+
+def colour_limits(orig, adjusted):
+    """Return the maximum of the original and the maximum absolute difference for each level.
+
+    orig, adjusted: arrays (..., lat, lon), e.g. (level, lat, lon). Both limits are
+    computed in a single reduction over the spatial dimensions.
+    """
+
+    orig = np.ma.filled(np.ma.asarray(orig, dtype=float), np.nan)
+    adjusted = np.ma.filled(np.ma.asarray(adjusted, dtype=float), np.nan)
+
+    stacked = np.stack([orig, np.abs(adjusted - orig)])
+    orig_vmax, diff_vmax = np.nanmax(stacked, axis=(-2, -1))
+
+    return orig_vmax, diff_vmax
+
+def panel(data, title, extent=None, cmap='viridis', vmin=None, vmax=None, xlabel='', ylabel=''):
+    """Return a panel specification for render_figure()."""
+
+    return {
+        'data': np.ma.filled(np.ma.asarray(data, dtype=np.float32), np.nan),
+        'title': title,
+        'extent': extent,
+        'cmap': cmap,
+        'vmin': vmin,
+        'vmax': vmax,
+        'xlabel': xlabel,
+        'ylabel': ylabel,
+    }
+
+def render_panel(spec, size=(4.5, 4), dpi=100):
+    """Render a single panel with colorbar and return it as an RGBA array."""
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=size, dpi=dpi)
+    im = ax.imshow(spec['data'], origin='lower', extent=spec['extent'], cmap=spec['cmap'],
+        vmin=spec['vmin'], vmax=spec['vmax'], interpolation='nearest', aspect='auto')
+    fig.colorbar(im, ax=ax)
+    ax.set_title(spec['title'])
+    ax.set_xlabel(spec['xlabel'])
+    ax.set_ylabel(spec['ylabel'])
+
+    fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba()).copy()
+    plt.close(fig)
+
+    return image
+
+def render_title(title, width, dpi=100):
+    """Render a title strip of a given pixel width as an RGBA array."""
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(width/dpi, 0.5), dpi=dpi)
+    fig.text(0.5, 0.5, title, ha='center', va='center', fontsize=14)
+    fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba()).copy()
+    plt.close(fig)
+
+    return image
+
+def render_figure(panels, ncols, fname, suptitle=None, max_workers=None, dpi=100):
+    """Render panels in parallel processes and tile them into a single png (row major order).
+
+    max_workers defaults to the number of panels, capped at PBS_NCPUS (or the cpu count).
+    """
+
+    import matplotlib.image
+
+    if max_workers is None:
+        max_workers = min(len(panels), int(os.environ.get('PBS_NCPUS', os.cpu_count())))
+
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as pool:
+        images = list(pool.map(render_panel, panels, [(4.5, 4)]*len(panels), [dpi]*len(panels)))
+
+    # pad to a full grid with blank (white) panels
+    blank = np.full_like(images[0], 255)
+    nrows = int(np.ceil(len(images) / ncols))
+    images += [blank] * (nrows*ncols - len(images))
+
+    rows = [np.concatenate(images[i*ncols:(i+1)*ncols], axis=1) for i in range(nrows)]
+    grid = np.concatenate(rows, axis=0)
+    if suptitle is not None:
+        grid = np.concatenate([render_title(suptitle, grid.shape[1], dpi), grid], axis=0)
+
+    matplotlib.image.imsave(fname, grid)
+    print(f'Saved QA plot: {fname}')
+
+    return fname
+
+def submit_figure(panels, ncols, fname, suptitle=None, max_workers=None):
+    """Start render_figure() in the background and return a future."""
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(render_figure, panels, ncols, fname, suptitle, max_workers)
+    executor.shutdown(wait=False)
+
+    return future
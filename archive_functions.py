@@ -0,0 +1,625 @@
+'''
+Index and layouts of the converted netcdf archive: a queryable catalogue, a virtual reference
+index and space major copies.
+
+Catalogue: build_catalogue records every converted file once (only new or updated files on later
+runs) in {datapath}/catalogue.csv, with the region, domain, config and perturbation flags parsed
+from the experiment name (cf.parse_experiment), the variable, the name of the data variable in
+the file (which is not consistent between files), the time span, shape and chunking. query
+selects files from the catalogue without opening any, and open_query opens the matching files
+lazily as one Dataset aligned on (experiment, time). repair_archive renames the data variable
+of files converted before names were normalised to their plot_fname, in place.
+
+Reference index (kerchunk): opening the archive otherwise means one xr.open_dataset per
+experiment and variable file, each parsing the HDF5 metadata of the file. build_references scans
+all converted files once and records where every chunk lives (file, byte offset, length) as zarr
+references:
+    {datapath}/references/files/{plot_fname}/{exp}_{plot_fname}.json   one per converted file
+    {datapath}/references/{domain}/{plot_fname}.json                   experiments stacked per variable
+    {datapath}/references/{domain}.json (or .parq)                     all variables of a domain
+Per file references are only rebuilt when the netcdf file is newer, so rerunning after a
+conversion only scans the new files. The combined references stack experiments along a new
+'experiment' dim and name each data variable by its plot_fname, so a whole domain (variables x
+experiments) opens as one lazy zarr dataset that reads chunks straight from the netcdf files,
+with no data copied and no per file metadata cost.
+
+Variables whose experiments or times differ from the rest of the domain are left out of the
+domain references, but can still be opened on their own with open_references.
+
+Space major copies: the converted files are chunked {'time':24, full latitude/longitude}, which
+suits maps but not per grid cell time series (percentiles, significance tests, diurnal
+composites). rechunk_space_major writes a (full time, tile, tile) chunked copy with bounded memory
+to {datapath}/space_major, and open_layout reads whichever layout suits an operation.
+
+Usage:
+    import archive_functions as af
+
+    af.build_catalogue()      # or run preprocessing/build_reference_index.py
+    af.query(variable='latent_heat_flux', domain='d0198', bare=True)[['experiment', 'start', 'end']]
+    ds = af.open_query(variable=['latent_heat_flux', 'sensible_heat_flux'], domain='d0198', region='drysoil')
+
+    af.build_references()
+    ds = af.open_archive('d0198_RAL3P2', aest=True)
+    ds.air_temperature.sel(experiment='drysoil_d0198_RAL3P2').mean('time')
+
+    ds = af.open_references(['latent_heat_flux', 'sensible_heat_flux'], 'd0198_RAL3P2')
+
+    af.rechunk_space_major('control_d0198_RAL3P2', 'air_temperature')
+    da = af.open_layout('control_d0198_RAL3P2', 'air_temperature', 'quantile')
+'''
+
+import os
+import glob
+import shutil
+import json
+from collections import Counter
+import xarray as xr
+
+import common_functions as cf
+
+###############################################################################
+
+# files with more references than this are also written as parquet when fmt='auto'
+max_json_refs = 100000
+
+# inline (store in the index) arrays smaller than this many bytes, e.g. coordinates
+inline_threshold = 300
+
+###############################################################################
+# kerchunk reference index
+
+def get_reference_dir(datapath=cf.datapath):
+    '''directory of the reference index'''
+
+    return f'{datapath}/references'
+
+def get_domain(exp):
+    '''domain (e.g. d0198_RAL3P2) from an experiment name, 'other' if there is none'''
+
+    info = cf.parse_experiment(exp)
+
+    return 'other' if info['domain'] is None else f"{info['domain']}_{info['config']}"
+
+def scan_archive(datapath=cf.datapath):
+    '''converted files in the archive as (plot_fname, experiment, file name) tuples'''
+
+    files = []
+    for fpath in sorted(glob.glob(f'{datapath}/*/*.nc')):
+        plot_fname = os.path.basename(os.path.dirname(fpath))
+        name = os.path.basename(fpath)[:-3]
+        # only {exp}_{plot_fname}.nc, which skips the products kept beside the variables
+        if name.endswith(f'_{plot_fname}'):
+            files.append((plot_fname, name[:-len(plot_fname)-1], fpath))
+
+    return files
+
+def get_arrays(refs):
+    '''array name -> (dims, shape, chunks) from zarr (v2) references'''
+
+    arrays = {}
+    for key, value in refs['refs'].items():
+        if key.endswith('/.zarray'):
+            name = key[:-len('/.zarray')]
+            zarray = json.loads(value)
+            zattrs = json.loads(refs['refs'].get(f'{name}/.zattrs', '{}'))
+            arrays[name] = (zattrs.get('_ARRAY_DIMENSIONS', []), zarray['shape'], zarray['chunks'])
+
+    return arrays
+
+def get_data_name(refs):
+    '''name of the data variable in references (the non coordinate array with the most dims)'''
+
+    arrays = get_arrays(refs)
+    data = {name: dims for name, (dims, _, _) in arrays.items() if name not in dims}
+
+    return max(data, key=lambda name: len(data[name]))
+
+def rename_refs(refs, old, new):
+    '''rename an array in references'''
+
+    refs['refs'] = {(new + key[len(old):] if key.startswith(f'{old}/') else key): value
+        for key, value in refs['refs'].items()}
+
+    return refs
+
+def build_file_refs(fpath, fname):
+    '''references for one netcdf file, reusing the saved references if newer than the file'''
+
+    if os.path.exists(fname) and os.path.getmtime(fname) >= os.path.getmtime(fpath):
+        with open(fname) as f:
+            return json.load(f)
+
+    from kerchunk.hdf import SingleHdf5ToZarr
+
+    print(f'scanning {fpath}')
+    with open(fpath, 'rb') as f:
+        refs = SingleHdf5ToZarr(f, fpath, inline_threshold=inline_threshold).translate()
+
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, 'w') as f:
+        json.dump(refs, f)
+
+    return refs
+
+def combine_experiments(file_refs, exps, plot_fname):
+    '''
+    stack per experiment references along a new 'experiment' dim, with the data variable renamed
+    to plot_fname (experiments must share the shape and chunking of the data variable)
+    '''
+
+    from kerchunk.combine import MultiZarrToZarr
+
+    file_refs = [rename_refs(refs, get_data_name(refs), plot_fname) for refs in file_refs]
+    coords = [name for name in get_arrays(file_refs[0]) if name != plot_fname]
+
+    mzz = MultiZarrToZarr(file_refs, concat_dims=['experiment'], coo_map={'experiment': list(exps)},
+        identical_dims=coords, remote_protocol='file', inline_threshold=inline_threshold)
+
+    return mzz.translate()
+
+def get_coords_hash(refs, name):
+    '''hash of the coordinate values (e.g. time, latitude, longitude) of an array, read through the references'''
+
+    import hashlib
+    import numpy as np
+
+    ds = open_refs(refs)
+    sha = hashlib.sha1()
+    for dim in ds[name].dims:
+        if dim in ds.coords and dim != 'experiment':
+            sha.update(dim.encode())
+            sha.update(np.ascontiguousarray(ds[dim].values).tobytes())
+
+    return sha.hexdigest()
+
+def get_layout(refs, plot_fname, exps):
+    '''
+    experiments, dims, shape and coordinate values of a combined variable, which must match to
+    share a dataset (variables of the same length but with different time axes are kept apart)
+    '''
+
+    arrays = get_arrays(refs)
+    dims, shape, _ = arrays[plot_fname]
+    grid = {dim: arrays[dim][1] for dim in dims if dim in arrays}
+
+    return json.dumps({'shape': shape, 'grid': grid, 'experiment': exps,
+        'coords': get_coords_hash(refs, plot_fname)})
+
+def write_refs(refs, fname, fmt='json'):
+    '''save references as json or as a parquet reference directory (fname with .parq)'''
+
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    if fmt == 'auto':
+        fmt = 'parquet' if len(refs['refs']) > max_json_refs else 'json'
+
+    name = os.path.splitext(fname)[0]
+    if fmt == 'parquet':
+        from kerchunk.df import refs_to_dataframe
+        fname, stale = f'{name}.parq', f'{name}.json'
+        refs_to_dataframe(refs, fname)
+    else:
+        fname, stale = f'{name}.json', f'{name}.parq'
+        with open(fname, 'w') as f:
+            json.dump(refs, f)
+
+    # remove references in the other format so they are not opened instead
+    if os.path.isdir(stale):
+        shutil.rmtree(stale)
+    elif os.path.exists(stale):
+        os.remove(stale)
+    print(f'saved references: {fname}')
+
+    return fname
+
+def build_references(datapath=cf.datapath, variables=None, fmt='auto'):
+    '''
+    scan the archive and write per file, per variable and per domain references (see module docstring)
+        variables (list): plot_fname directories to index (None for all)
+        fmt (string): 'json', 'parquet' or 'auto' (parquet above max_json_refs references)
+    returns dict of domain -> list of variables in the domain references
+    '''
+
+    refdir = get_reference_dir(datapath)
+    files = [f for f in scan_archive(datapath) if variables is None or f[0] in variables]
+
+    # (domain, plot_fname) -> {exp: refs}
+    grouped = {}
+    for plot_fname, exp, fpath in files:
+        refs = build_file_refs(fpath, f'{refdir}/files/{plot_fname}/{exp}_{plot_fname}.json')
+        grouped.setdefault((get_domain(exp), plot_fname), {})[exp] = refs
+
+    # domain -> {plot_fname: (experiments, combined refs)}
+    combined = {}
+    for (domain, plot_fname), exp_refs in grouped.items():
+        # experiments with a different shape or coordinates (e.g. a shorter or shifted run) cannot
+        # be stacked with the others, as the coordinates of the first experiment are used for all
+        shapes = {exp: json.dumps([get_arrays(refs)[get_data_name(refs)][1:], get_coords_hash(refs, get_data_name(refs))])
+            for exp, refs in exp_refs.items()}
+        common = Counter(shapes.values()).most_common(1)[0][0]
+        exps = [exp for exp in exp_refs if shapes[exp] == common]
+        for exp in set(exp_refs) - set(exps):
+            print(f'WARNING: {exp} {plot_fname} has a different shape or coordinates, left out of the combined references')
+
+        refs = combine_experiments([exp_refs[exp] for exp in exps], exps, plot_fname)
+        write_refs(refs, f'{refdir}/{domain}/{plot_fname}.json', 'json')
+        combined.setdefault(domain, {})[plot_fname] = (exps, refs)
+
+    indexed = {}
+    for domain, var_refs in combined.items():
+        # variables sharing the most common experiments, dims and shape are merged into one dataset
+        layouts = {plot_fname: get_layout(refs, plot_fname, exps) for plot_fname, (exps, refs) in var_refs.items()}
+        common = Counter(layouts.values()).most_common(1)[0][0]
+        indexed[domain] = [plot_fname for plot_fname, layout in layouts.items() if layout == common]
+
+        refs = {'version': 1, 'refs': {}}
+        for plot_fname in indexed[domain]:
+            refs['refs'].update(var_refs[plot_fname][1]['refs'])
+        others = sorted(set(var_refs) - set(indexed[domain]))
+        if others:
+            print(f'{domain}: not in domain references (open with open_references): {others}')
+
+        write_refs(refs, f'{refdir}/{domain}.json', fmt)
+
+    return indexed
+
+def open_refs(fname, chunks={}):
+    '''open json or parquet references (or a references dict) as a lazy zarr dataset (chunks follow the netcdf chunking)'''
+
+    storage_options = {'fo': fname, 'remote_protocol': 'file'}
+    if isinstance(fname, str) and fname.endswith('.parq'):
+        storage_options['lazy'] = True
+
+    return xr.open_dataset('reference://', engine='zarr', chunks=chunks,
+        backend_kwargs={'consolidated': False, 'storage_options': storage_options})
+
+def get_refs_fname(name):
+    '''json or parquet references, whichever exists'''
+
+    for fname in [f'{name}.json', f'{name}.parq']:
+        if os.path.exists(fname):
+            return fname
+
+    raise FileNotFoundError(f'no references for {name}, run build_references')
+
+def open_archive(domain='d0198_RAL3P2', datapath=cf.datapath, chunks={}, aest=False):
+    '''
+    all indexed variables and experiments of a domain as one lazy Dataset
+    data variables are named by plot_fname, on (experiment, time, ...)
+    '''
+
+    ds = open_refs(get_refs_fname(f'{get_reference_dir(datapath)}/{domain}'), chunks)
+
+    return cf.to_aest(ds) if aest else ds
+
+def open_references(variables, domain='d0198_RAL3P2', exps=None, datapath=cf.datapath, chunks={}, aest=False):
+    '''
+    lazy Dataset of variables from their combined references, including variables left out of
+    the domain references
+        variables (list): variable names in get_variable_opts (or plot_fname)
+        exps (list): experiment names to keep (None for all, NaN where a variable has no file)
+    '''
+
+    refdir = get_reference_dir(datapath)
+    das = []
+    for variable in variables:
+        plot_fname = variable if os.path.isdir(f'{datapath}/{variable}') else cf.get_variable_opts(variable)['plot_fname']
+        ds = open_refs(get_refs_fname(f'{refdir}/{domain}/{plot_fname}'), chunks)
+        das.append(ds[plot_fname] if exps is None else ds[plot_fname].reindex(experiment=exps))
+
+    ds = xr.merge(das, join='outer')
+
+    return cf.to_aest(ds) if aest else ds
+
+###############################################################################
+# catalogue of the converted files, queried without opening them
+
+def get_catalogue_fpath(datapath=cf.datapath):
+    '''path of the archive catalogue'''
+
+    return f'{datapath}/catalogue.csv'
+
+def describe_file(plot_fname, exp, fpath):
+    '''catalogue row for one converted file (reads only the metadata and time coordinate)'''
+
+    import pandas as pd
+
+    with xr.open_dataset(fpath) as ds:
+        # files not yet repaired (see repair_archive) may use other names, so fall back to the first
+        data_var = plot_fname if plot_fname in ds.data_vars else list(ds.data_vars)[0]
+        da = ds[data_var]
+        times = pd.DatetimeIndex(ds.time.values) if 'time' in ds.coords and ds.time.ndim == 1 else None
+        row = {'variable': plot_fname, 'experiment': exp}
+        row.update(cf.parse_experiment(exp))
+        row.update({
+            'flags': ' '.join(row['flags']),
+            'data_var': data_var,
+            'long_name': da.attrs.get('long_name', da.attrs.get('standard_name', '')),
+            'units': da.attrs.get('units', ''),
+            'dims': ' '.join(da.dims),
+            'shape': ' '.join(map(str, da.shape)),
+            'chunks': ' '.join(map(str, da.encoding.get('chunksizes') or da.shape)),
+            'dtype': str(da.dtype),
+            'start': times[0] if times is not None and len(times) else pd.NaT,
+            'end': times[-1] if times is not None and len(times) else pd.NaT,
+            'ntimes': 0 if times is None else len(times),
+            'gathered': 'landpoint' in da.dims,
+            'path': fpath,
+            'mtime': os.stat(fpath).st_mtime_ns,
+        })
+
+    return row
+
+def build_catalogue(datapath=cf.datapath, fname=None):
+    '''
+    index every converted file by region, domain, config, perturbation flags, variable,
+    data variable name, time span, shape and chunking, rescanning only new or updated files
+    returns DataFrame (also saved as csv)
+    '''
+
+    import pandas as pd
+
+    fname = get_catalogue_fpath(datapath) if fname is None else fname
+    old = read_catalogue(datapath, fname).set_index('path') if os.path.exists(fname) else None
+
+    rows = []
+    for plot_fname, exp, fpath in scan_archive(datapath):
+        if old is not None and fpath in old.index and old.loc[fpath, 'mtime'] >= os.stat(fpath).st_mtime_ns:
+            rows.append(dict(old.loc[fpath], path=fpath))
+        else:
+            print(f'cataloguing {fpath}')
+            rows.append(describe_file(plot_fname, exp, fpath))
+
+    catalogue = pd.DataFrame(rows)
+    catalogue.to_csv(fname, index=False)
+    print(f'saved catalogue of {len(catalogue)} files: {fname}')
+
+    return catalogue
+
+def read_catalogue(datapath=cf.datapath, fname=None):
+    '''the saved archive catalogue as a DataFrame'''
+
+    import pandas as pd
+
+    fname = get_catalogue_fpath(datapath) if fname is None else fname
+
+    return pd.read_csv(fname, parse_dates=['start', 'end'], keep_default_na=False,
+        na_values={'start': [''], 'end': [''], 'domain': [''], 'config': ['']})
+
+def query(catalogue=None, datapath=cf.datapath, **criteria):
+    '''
+    catalogue rows matching all criteria, e.g. query(variable='air_temperature', domain='d0198', bare=True)
+        criteria: column -> value or list of values (any of); variable accepts get_variable_opts
+                  names as well as plot_fname, and time='YYYY-MM-DD' keeps files covering that time
+    '''
+
+    import pandas as pd
+
+    catalogue = read_catalogue(datapath) if catalogue is None else catalogue
+    keep = pd.Series(True, index=catalogue.index)
+
+    for column, value in criteria.items():
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        if column == 'variable':
+            values = [get_plot_fname(var, catalogue) for var in values]
+        if column == 'time':
+            keep &= (catalogue.start <= pd.Timestamp(value)) & (catalogue.end >= pd.Timestamp(value))
+        elif column not in catalogue.columns:
+            raise ValueError(f'unknown catalogue column: {column}')
+        else:
+            keep &= catalogue[column].isin(values)
+
+    return catalogue[keep]
+
+def get_plot_fname(variable, catalogue):
+    '''plot_fname of a variable (catalogue variables are plot_fname directories)'''
+
+    if variable in set(catalogue.variable):
+        return variable
+
+    return cf.get_variable_opts(variable)['plot_fname']
+
+def repair_archive(variables, datapath=cf.datapath, dry_run=False):
+    '''
+    rename the data variable of every catalogued file to its canonical name (plot_fname, as written
+    by the converter) and set long_name from get_variable_opts, in place (metadata only, no data
+    is rewritten, units are kept). Files needing repair are selected from the catalogue in one pass.
+        variables (list): get_variable_opts names, whose files also get registry attributes
+                          (files of other variables, or names not in the registry, are only renamed)
+        dry_run (bool): only return the files that would be repaired
+    returns DataFrame of the files needing repair, with a repaired column
+    Files are opened for writing, so run this in a fresh process (as build_reference_index.py
+    does): files still open elsewhere (e.g. lazily in a notebook) cannot be repaired and are
+    reported as skipped.
+    '''
+
+    import pandas as pd
+
+    catalogue = build_catalogue(datapath)
+
+    registry = []
+    for variable in variables:
+        try:
+            opts = cf.get_variable_opts(variable)
+        except ValueError:
+            print(f'{variable} is not in get_variable_opts, its files are only renamed')
+            continue
+        registry.append({'variable': opts['plot_fname'], 'registry_variable': variable,
+            'registry_long_name': opts['plot_title']})
+    registry = pd.DataFrame(registry, columns=['variable', 'registry_variable',
+        'registry_long_name']).drop_duplicates('variable')
+
+    table = catalogue.merge(registry, on='variable', how='left')
+    rename = table.data_var != table.variable
+    attrs = table.registry_variable.notna() & (table.long_name != table.registry_long_name)
+    todo = table[rename | attrs]
+    print(f'{rename.sum()} files to rename, {attrs.sum()} files to update attributes')
+
+    if dry_run or len(todo) == 0:
+        return todo
+
+    import netCDF4
+
+    # close files xarray keeps open in this process (HDF5 refuses to reopen them for writing)
+    cache = xr.backends.file_manager.FILE_CACHE
+    for handle in list(cache.values()):
+        handle.close()
+    cache.clear()
+
+    repaired = []
+    for row in todo.itertuples():
+        print(f'repairing {row.path}')
+        try:
+            with netCDF4.Dataset(row.path, 'a') as nc:
+                if row.data_var != row.variable:
+                    nc.renameVariable(row.data_var, row.variable)
+                if isinstance(row.registry_variable, str):
+                    nc[row.variable].setncatts(cf.get_registry_attrs(row.registry_variable, source_name=row.data_var))
+        except OSError as e:
+            print(f'WARNING: skipped {row.path} ({e}), is it open in another process?')
+            repaired.append(False)
+        else:
+            repaired.append(True)
+    todo = todo.assign(repaired=repaired)
+    if not all(repaired):
+        print(f'{len(repaired) - sum(repaired)} files skipped, rerun in a fresh process to repair them')
+
+    build_catalogue(datapath)
+
+    return todo
+
+def open_row(row, chunks={}):
+    '''lazy DataArray for a catalogue row, using the recorded data variable name'''
+
+    ds = xr.open_dataset(row.path, chunks=chunks)
+    da = ds[row.data_var]
+    if row.gathered:
+        da = cf.scatter_land(da, ds.latitude, ds.longitude)
+
+    return da
+
+def open_query(catalogue=None, datapath=cf.datapath, join='inner', chunks={}, aest=False, **criteria):
+    '''
+    lazy Dataset of all files matching criteria (see query), one data variable per variable on
+    (experiment, time, ...), with experiments and variables aligned on time (join='inner' or 'outer')
+    e.g. open_query(variable=['latent_heat_flux', 'sensible_heat_flux'], domain='d0198', region='drysoil')
+    '''
+
+    rows = query(catalogue, datapath, **criteria)
+    if len(rows) == 0:
+        raise ValueError(f'no files in the catalogue match {criteria}')
+    if rows[['domain', 'config']].drop_duplicates().shape[0] > 1:
+        raise ValueError('files are on more than one grid, select a domain and config')
+
+    das = []
+    for variable, group in rows.groupby('variable', sort=False):
+        da = xr.concat([open_row(row, chunks) for row in group.itertuples()],
+            dim=xr.DataArray(list(group.experiment), dims='experiment', name='experiment'), join=join)
+        das.append(da.rename(variable))
+
+    ds = xr.merge(das, join=join)
+
+    return cf.to_aest(ds) if aest else ds
+
+###############################################################################
+# space major copies for per grid cell time series work
+
+# latitude x longitude tile of the space major copies (each chunk holds the full time series)
+space_major_tile = 32
+
+# memory (bytes) held while rechunking, which sets how many latitude rows are copied at once
+max_rechunk_mem = 1e9
+
+# layout read for each kind of operation: 'time' major (the converted files, chunked
+# {'time':24, full latitude/longitude}) or 'space' major (full time in small tiles)
+layouts = {
+    'map':          'time',     # fields at given times, time or period means of the whole grid
+    'region_mean':  'time',     # spatial means and other reductions over latitude/longitude
+    'series':       'space',    # time series at grid cells or points
+    'quantile':     'space',    # per grid cell percentiles over time
+    'significance': 'space',    # per grid cell tests over time
+    'diurnal':      'space',    # per grid cell diurnal composites
+    }
+
+def get_space_major_fpath(exp, variable, datapath=cf.datapath):
+    '''path of the space major copy of a converted file'''
+
+    opts = cf.get_variable_opts(variable)
+
+    return f"{datapath}/space_major/{opts['plot_fname']}/{exp}_{opts['plot_fname']}.nc"
+
+def is_current(fname, srcs):
+    '''whether fname exists and is newer than every source file (which must all exist)'''
+
+    return os.path.exists(fname) and all(
+        os.path.exists(src) and os.path.getmtime(fname) >= os.path.getmtime(src) for src in srcs)
+
+def rechunk_space_major(exp, variable, datapath=cf.datapath, tile=space_major_tile, max_mem=max_rechunk_mem):
+    '''
+    write a space major copy of a converted (time, latitude, longitude) file, chunked (full time,
+    tile, tile). Bands of latitude rows (a multiple of tile, sized so that a band fits in max_mem)
+    are read for all times and written as whole chunks, so memory stays bounded and each output
+    chunk is written once. Copies newer than their source (all inputs of a derived variable) are kept.
+    returns the file name of the copy
+    '''
+
+    import numpy as np
+    import dask.array as dsa
+    import netCDF4
+
+    fname = get_space_major_fpath(exp, variable, datapath)
+    if is_current(fname, cf.get_source_fpaths(exp, variable, datapath)):
+        print(f'space major copy up to date: {fname}')
+        return fname
+
+    da = cf.open_experiment(exp, variable, datapath)
+    if set(da.dims) != {'time', 'latitude', 'longitude'}:
+        raise ValueError(f'{variable} for {exp} is not a (time, latitude, longitude) field: {da.dims}')
+    da = da.transpose('time', 'latitude', 'longitude').rename(cf.get_variable_opts(variable)['plot_fname'])
+    ntime, nlat, nlon = da.shape
+    tile = min(tile, nlat, nlon)
+
+    row_bytes = ntime * nlon * np.dtype('float32').itemsize
+    rows = max(tile, int(max_mem // row_bytes) // tile * tile)
+    print(f'rechunking {exp} {variable} in {int(np.ceil(nlat/rows))} bands of {rows} rows')
+
+    # write the metadata and coordinates, then fill the data variable one band at a time
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp = f'{fname}.{os.getpid()}.tmp'
+    template = da.copy(data=dsa.zeros(da.shape, dtype='float32', chunks=(ntime, tile, tile)))
+    encoding = {da.name: {'dtype': 'float32', 'zlib': True, 'shuffle': True, '_FillValue': -999,
+        'chunksizes': (ntime, tile, tile)}}
+    template.to_dataset().to_netcdf(tmp, encoding=encoding, compute=False)
+
+    with netCDF4.Dataset(tmp, 'a') as nc:
+        for start in range(0, nlat, rows):
+            band = da.isel(latitude=slice(start, start + rows)).values.astype('float32')
+            nc[da.name][:, start:start + band.shape[1], :] = band
+
+    os.replace(tmp, fname)
+    print(f'saved space major copy: {fname}')
+
+    return fname
+
+def open_layout(exp, variable, operation='map', datapath=cf.datapath, aest=False):
+    '''
+    lazy DataArray from the layout suited to an operation (see layouts), e.g.
+    open_layout(exp, 'air_temperature', 'quantile') reads the space major copy, so each dask chunk
+    holds the full time series of a tile. Falls back to the converted file if there is no current
+    space major copy (see rechunk_space_major).
+    '''
+
+    if operation not in layouts:
+        raise ValueError(f'unknown operation {operation}, expected one of {list(layouts)}')
+
+    fname = get_space_major_fpath(exp, variable, datapath)
+    srcs = cf.get_source_fpaths(exp, variable, datapath)
+
+    if layouts[operation] == 'space' and is_current(fname, srcs):
+        cf.record_sources(srcs)
+        da = xr.open_dataset(fname, chunks={})[cf.get_variable_opts(variable)['plot_fname']]
+        return cf.to_aest(da) if aest else da
+
+    if layouts[operation] == 'space':
+        print(f'no space major copy of {exp} {variable}, reading the time major file')
+
+    return cf.open_experiment(exp, variable, datapath, aest=aest)
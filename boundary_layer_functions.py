@@ -0,0 +1,99 @@
+'''
+Boundary layer diagnostics for all experiments and regions from one scheduled computation.
+
+Region mean boundary layer height series for every experiment and region (and optionally daily
+maximum maps) are computed in a single dask pass. The series are then reshaped to
+(day, hour of day) in AEST, and every diagnostic is a vectorised grouped reduction over that
+table (as flox does for groupby) rather than a python loop of groupby/resample/quantile calls:
+    daily_max:          maximum of the region mean in each day
+    hour_of_max:        hour (AEST) of the daily maximum
+    growth_hour:        first hour the region mean exceeds min + growth_fraction*(max - min)
+    growth_rate:        largest hourly increase in each day (m per hour)
+    diurnal_mean:       mean over days for each hour of the day
+    diurnal_quantile:   quantiles over days for each hour of the day
+Differences from control are included for daily_max and diurnal_mean.
+
+Usage:
+    import common_functions as cf
+    import boundary_layer_functions as bl
+
+    regions = {'land': landmask == 1, 'fires': fire_mask == 1}
+    ds = bl.diagnostics(cf.experiments, regions, quantiles=[0.1, 0.5, 0.9])
+    ds.diurnal_quantile.sel(region='fires', experiment='All Variables').plot.line(x='hour')
+'''
+
+import dask
+import xarray as xr
+
+import common_functions as cf
+import stats_functions as sf
+
+###############################################################################
+
+def open_stack(exps, variable='boundary_layer_thickness', datapath=cf.datapath, aest=True):
+    '''lazy (experiment, time, latitude, longitude) stack labelled by the keys of exps, on common times'''
+
+    das = [cf.open_experiment(exp, variable, datapath, aest=aest) for exp in exps.values()]
+
+    return xr.concat(das, dim=xr.DataArray(list(exps.keys()), dims='experiment', name='experiment'),
+        join='inner')
+
+def region_means(stack, regions):
+    '''lazy region mean series (experiment, region, time) for boolean region masks (None for all)'''
+
+    means = [(stack if mask is None else stack.where(mask)).mean(dim=['latitude', 'longitude'])
+        for mask in regions.values()]
+
+    means = xr.concat(means, dim=xr.DataArray(list(regions.keys()), dims='region', name='region'))
+
+    return means.transpose('experiment', 'region', 'time')
+
+def growth_timing(table, growth_fraction=0.5):
+    '''hour of daily maximum, hour of growth past growth_fraction of the daily range, and largest hourly increase'''
+
+    lo, hi = table.min('hour'), table.max('hour')
+    grown = table >= lo + growth_fraction*(hi - lo)
+
+    return {
+        'hour_of_max': table.idxmax('hour'),
+        'growth_hour': grown.idxmax('hour'),
+        'growth_rate': table.diff('hour').max('hour'),
+    }
+
+def diagnostics(exps, regions=None, control='Control', quantiles=(0.1, 0.5, 0.9), growth_fraction=0.5,
+                variable='boundary_layer_thickness', maps=False, datapath=cf.datapath):
+    '''
+    boundary layer diagnostics for all experiments and regions (see module docstring)
+        exps (dict): label -> experiment name (e.g. cf.experiments)
+        regions (dict): region name -> boolean mask DataArray (None for the full domain)
+        control (string): label in exps that differences are taken from
+        maps (bool): also return daily maximum maps (experiment, day, latitude, longitude)
+    returns Dataset
+    '''
+
+    regions = {'domain': None} if regions is None else regions
+    stack = open_stack(exps, variable, datapath, aest=True)
+
+    todo = {'series': region_means(stack, regions)}
+    if maps:
+        todo['daily_max_map'] = stack.resample(time='1D').max()
+
+    print(f'computing {variable} diagnostics for {len(exps)} experiments and {len(regions)} regions')
+    done = dask.compute(todo)[0]
+
+    table = sf.daily_table(done['series'])
+    ds = xr.Dataset({'series': done['series']})
+    ds['daily_max'] = table.max('hour')
+    ds.update(growth_timing(table, growth_fraction))
+    ds['diurnal_mean'] = table.mean('day')
+    ds['diurnal_quantile'] = table.quantile(list(quantiles), dim='day')
+    if control in exps:
+        ds['daily_max_diff'] = ds.daily_max - ds.daily_max.sel(experiment=control)
+        ds['diurnal_mean_diff'] = ds.diurnal_mean - ds.diurnal_mean.sel(experiment=control)
+    if maps:
+        ds['daily_max_map'] = done['daily_max_map'].rename(time='day').sel(day=table.day)
+
+    ds.attrs = {'variable': variable, 'units': cf.get_variable_opts(variable)['units'],
+        'time': 'AEST', 'growth_fraction': growth_fraction}
+
+    return ds
@@ -57,6 +57,7 @@ def get_variable_opts(variable):
     fmt: format string for the variable error statistics
     dtype: data type for saving the variable to netcdf
     level: level of the variable (e.g. soil level, 0-indexed)
+    bins: histogram bin edges (list), or ('log'|'linear', min, max, n) for n spaced edges
     '''
 
     # standard ops
@@ -73,7 +74,8 @@ def get_variable_opts(variable):
         'cmap'      : 'viridis',
         'threshold' : None,
         'fmt'       : '{:.2f}',
-        'dtype'     : 'float32'
+        'dtype'     : 'float32',
+        'bins'      : None,
         }
     
     if variable == 'air_temperature':
@@ -377,7 +379,7 @@ def get_variable_opts(variable):
             'constraint': 'm01s00i025',
             'plot_title': 'boundary layer thickness',
             'plot_fname': 'boundary_layer_thickness',
-            'units'     : '°C',
+            'units'     : 'm',
             'fname'     : 'umnsaa_pvera',
             'vmin'      : 0,
             'vmax'      : 3000,
@@ -759,6 +761,7 @@ def get_variable_opts(variable):
             'vmax'      : 100,
             'cmap'      : 'gist_earth_r',
             'fmt'       : '{:.5f}',
+            'bins'      : [0, 1, 5, 10, 20, 50, 100, 200, 250, 300, 400], # mm (after *3600 and summing)
             })
         
     elif variable == 'daily_precipitation_amount':
@@ -777,6 +780,7 @@ def get_variable_opts(variable):
             'vmax'      : 100,
             'cmap'      : 'gist_earth_r',
             'fmt'       : '{:.2f}',
+            'bins'      : [0, 1, 5, 10, 20, 50, 100, 200, 250, 300, 400],
             })
     
     elif variable == 'stratiform_rainfall_amount_10min':
@@ -813,6 +817,7 @@ def get_variable_opts(variable):
             'vmax'      : 32,
             'cmap'      : 'gist_earth_r',
             'fmt'       : '{:.6f}',
+            'bins'      : ('log', 0.1, 200, 34),
             })
 
 
@@ -1208,8 +1213,85 @@ def get_variable_opts(variable):
             'vmax'      : 0.02,
             'fmt'       : '{:.6f}',
             })
-    
 
+    # all pressure levels of the single level entries above (e.g. for preprocessing/extract_profiles.py)
+    elif variable in ['wind_u_plev', 'wind_v_plev', 'upward_air_velocity_plev', 'geopotential_height_plev',
+                      'air_temperature_plev', 'relative_humidity_wrt_ice_plev', 'specific_humidity_plev']:
+        stash = {
+            'wind_u'                    : 'm01s15i201',
+            'wind_v'                    : 'm01s15i202',
+            'upward_air_velocity'       : 'm01s15i242',
+            'geopotential_height'       : 'm01s16i202',
+            'air_temperature'           : 'm01s16i203',
+            'relative_humidity_wrt_ice' : 'm01s16i204',
+            'specific_humidity'         : 'm01s30i205',
+            }
+        base = variable.replace('_plev', '')
+        opts.update(get_variable_opts(f'{base}_500hPa'))
+        opts.update({
+            'constraint': iris.Constraint(name=stash[base]),
+            'plot_title': f"{base.replace('_',' ')} (pressure levels)",
+            'plot_fname': variable,
+            })
+
+    # derived variables (built from converted variables, see derived_variables below)
+
+    elif variable == 'wind_direction':
+        opts.update({
+            'plot_title': '10 m wind direction',
+            'plot_fname': 'wind_direction_10m',
+            'units'     : 'degrees',
+            'vmin'      : 0,
+            'vmax'      : 360,
+            'cmap'      : 'twilight',
+            'fmt'       : '{:.1f}',
+            })
+
+    elif variable == 'net_radiation':
+        opts.update({
+            'plot_title': 'surface net radiation',
+            'plot_fname': 'net_radiation',
+            'units'     : 'W m-2',
+            'obs_key'   : 'Rnet',
+            'vmin'      : -200,
+            'vmax'      : 900,
+            'cmap'      : 'inferno',
+            'fmt'       : '{:.1f}',
+            })
+
+    elif variable == 'bowen_ratio':
+        opts.update({
+            'plot_title': 'Bowen ratio',
+            'plot_fname': 'bowen_ratio',
+            'units'     : '1',
+            'vmin'      : 0,
+            'vmax'      : 10,
+            'cmap'      : 'turbo',
+            })
+
+    elif variable == 'evaporative_fraction':
+        opts.update({
+            'plot_title': 'evaporative fraction',
+            'plot_fname': 'evaporative_fraction',
+            'units'     : '1',
+            'vmin'      : 0,
+            'vmax'      : 1,
+            'cmap'      : 'turbo_r',
+            })
+
+    elif variable in ['volumetric_soil_moisture_l1', 'volumetric_soil_moisture_l2',
+                      'volumetric_soil_moisture_l3', 'volumetric_soil_moisture_l4']:
+        layer = variable[-1]
+        opts.update({
+            'plot_title': f'volumetric soil moisture (layer {layer})',
+            'plot_fname': f'volumetric_soil_moisture_l{layer}',
+            'units'     : 'm3 m-3',
+            'level'     : int(layer) - 1,
+            'vmin'      : 0,
+            'vmax'      : 0.5,
+            'cmap'      : 'turbo_r',
+            'fmt'       : '{:.3f}',
+            })
 
     else:
         raise ValueError(f"Variable '{variable}' not recognised. Check common_functions.py")
@@ -1219,3 +1301,547 @@ def get_variable_opts(variable):
     opts.update({'variable':variable})
 
     return opts
+
+###############################################################################
+# converted netcdf archive (see preprocessing/convert_um_to_netcdf.py)
+
+datapath = '/g/data/ng72/as9583/cylc-run/u-dr216/netcdf_new'
+
+# inner domain experiments, labelled as in the thesis figures
+experiments = {
+    'Control'       : 'control_d0198_RAL3P2',
+    'Albedo'        : 'control_d0198_RAL3P2_albedo',
+    'Bare'          : 'control_d0198_RAL3P2_bare',
+    'Albedo + Bare' : 'control_d0198_RAL3P2_albedo_bare',
+    'SM'            : 'drysoil_d0198_RAL3P2',
+    'SM + Albedo'   : 'drysoil_d0198_RAL3P2_albedo',
+    'SM + Bare'     : 'drysoil_d0198_RAL3P2_bare',
+    'All Variables' : 'drysoil_d0198_RAL3P2_albedo_bare',
+}
+
+# perturbations that can appear in experiment names
+perturbations = ['drysoil', 'albedo', 'bare']
+
+def parse_experiment(exp):
+    '''
+    parts of an experiment name {region}_{domain}_{config}_{flags}, e.g. 'drysoil_d0198_RAL3P2_albedo' ->
+    {'region': 'drysoil', 'domain': 'd0198', 'config': 'RAL3P2', 'flags': ['albedo'],
+     'drysoil': True, 'albedo': True, 'bare': False}
+    '''
+
+    import re
+
+    parts = [part for part in exp.split('_') if part]
+    domain = next((i for i, part in enumerate(parts) if re.fullmatch(r'd\d{4}', part)), None)
+
+    info = {'region': parts[0]}
+    if domain is None:
+        info.update({'domain': None, 'config': None, 'flags': parts[1:]})
+    else:
+        config = parts[domain+1] if len(parts) > domain+1 else None
+        info.update({'domain': parts[domain], 'config': config, 'flags': parts[domain+2:]})
+    info.update({flag: flag == info['region'] or flag in info['flags'] for flag in perturbations})
+
+    return info
+
+def get_fpath(exp, variable, datapath=datapath):
+    '''path of the converted netcdf file for an experiment and variable'''
+
+    opts = get_variable_opts(variable)
+
+    return f"{datapath}/{opts['plot_fname']}/{exp}_{opts['plot_fname']}.nc"
+
+def get_registry_attrs(variable, attrs={}, source_name=None):
+    '''
+    attributes from get_variable_opts (long_name, registry variable), updating attrs
+    units are left as written by iris (registry units are plot labels, not CF units)
+    '''
+
+    opts = get_variable_opts(variable)
+
+    attrs = dict(attrs, long_name=opts['plot_title'], variable=variable)
+    if source_name is not None and source_name != opts['plot_fname']:
+        attrs['source_name'] = str(source_name)
+
+    return attrs
+
+def normalise_metadata(da, variable):
+    '''
+    name a converted DataArray by its plot_fname with long_name from get_variable_opts, so files
+    of every experiment share one data variable name (from_iris names derived cubes unpredictably,
+    e.g. 'filled-2e8ca822bc...'), keeping the original name as source_name
+    '''
+
+    opts = get_variable_opts(variable)
+    attrs = get_registry_attrs(variable, da.attrs, da.name)
+
+    return da.rename(opts['plot_fname']).assign_attrs(attrs)
+
+def open_experiment(exp, variable, datapath=datapath, chunks={}, aest=False, cache=False, gathered=False):
+    '''
+    opens a converted variable for one experiment as a lazy (dask) DataArray
+        exp (string): experiment name, e.g. 'control_d0198_RAL3P2'
+        variable (string): variable name in get_variable_opts
+        chunks (dict): dask chunks passed to xr.open_dataset ({} uses the file chunking)
+        aest (bool): shift time from UTC to AEST (UTC+10)
+        cache (bool): for derived variables, save to (or read from) the derived cache
+        gathered (bool): for land only files, keep the 1D landpoint dim instead of scattering
+    derived variables without a converted file are built lazily with open_derived
+    land only (gathered) files are scattered back to latitude/longitude with NaN over the ocean
+    '''
+
+    import os
+    import xarray as xr
+
+    record_sources(get_source_fpaths(exp, variable, datapath))
+
+    if variable in derived_variables and not os.path.exists(get_fpath(exp, variable, datapath)):
+        return open_derived(exp, variable, datapath, chunks, aest, cache)
+
+    ds = xr.open_dataset(get_fpath(exp, variable, datapath), chunks=chunks)
+    # files converted before names were normalised (see archive_functions.repair_archive) may use
+    # other data variable names, so fall back to the first
+    name = get_variable_opts(variable)['plot_fname']
+    da = ds[name] if name in ds.data_vars else ds[list(ds.data_vars)[0]]
+
+    if 'landpoint' in da.dims and not gathered:
+        da = scatter_land(da, ds.latitude, ds.longitude)
+
+    if aest:
+        da = to_aest(da)
+
+    return da
+
+def gather_land(da, landmask):
+    '''
+    CF compression by gathering: keep only land cells of a (..., latitude, longitude) DataArray
+    returns Dataset with the variable on (..., landpoint), where the landpoint coordinate holds
+    the flattened (latitude, longitude) index of each cell, and the full latitude/longitude axes
+    '''
+
+    import numpy as np
+    import xarray as xr
+
+    lead = [dim for dim in da.dims if dim not in ['latitude', 'longitude']]
+    da = da.transpose(*lead, 'latitude', 'longitude')
+    idx = np.flatnonzero((landmask == 1).values.ravel())
+
+    data = da.data.reshape(da.shape[:-2] + (-1,))[..., idx]
+    coords = {k: v for k, v in da.coords.items() if not {'latitude', 'longitude'} & set(v.dims)}
+    gathered = xr.DataArray(data, dims=lead + ['landpoint'], coords=coords, name=da.name, attrs=da.attrs)
+    gathered = gathered.assign_coords(landpoint=('landpoint', idx.astype('int32'), {'compress': 'latitude longitude'}))
+
+    return xr.Dataset({da.name: gathered}, coords={'latitude': da.latitude, 'longitude': da.longitude})
+
+def scatter_land(da, latitude, longitude):
+    '''lazily scatter a gathered (..., landpoint) DataArray back to (..., latitude, longitude), NaN elsewhere'''
+
+    import numpy as np
+    import xarray as xr
+    import dask.array as dsa
+
+    idx = da.landpoint.values
+    shape = (latitude.size, longitude.size)
+    dtype = np.result_type(da.dtype, np.float32)
+
+    def scatter_block(block):
+        out = np.full(block.shape[:-1] + (shape[0]*shape[1],), np.nan, dtype=dtype)
+        out[..., idx] = block
+        return out.reshape(block.shape[:-1] + shape)
+
+    if isinstance(da.data, dsa.Array):
+        data = da.data.rechunk({da.ndim-1: -1})
+        data = data.map_blocks(scatter_block, drop_axis=da.ndim-1, new_axis=[da.ndim-1, da.ndim],
+            chunks=data.chunks[:-1] + ((shape[0],), (shape[1],)), dtype=dtype)
+    else:
+        data = scatter_block(da.values)
+
+    coords = {k: v for k, v in da.coords.items() if 'landpoint' not in v.dims}
+    coords.update({'latitude': latitude.values, 'longitude': longitude.values})
+
+    return xr.DataArray(data, dims=da.dims[:-1] + ('latitude', 'longitude'), coords=coords,
+        name=da.name, attrs=da.attrs)
+
+# temporal aggregates written by the converter (save_aggregates), days and hours in AEST
+aggregates = ['daily_mean', 'daily_max', 'daily_min', 'period_mean', 'hour_of_day_mean']
+
+def get_aggregates(da):
+    '''
+    lazy temporal aggregates of an hourly (time, ...) DataArray (see aggregates)
+    daily aggregates keep only complete AEST days (as stats_functions.daily_table), so the partial
+    days at the start and end of a UTC run are dropped
+    '''
+
+    local = to_aest(da)
+    daily = local.resample(time='1D')
+
+    # time steps in each AEST day, from the time coordinate only (complete days have the most)
+    steps = local.time.resample(time='1D').count()
+    complete = steps.time[steps == steps.max()]
+
+    out = {
+        'daily_mean'       : daily.mean().sel(time=complete),
+        'daily_max'        : daily.max().sel(time=complete),
+        'daily_min'        : daily.min().sel(time=complete),
+        'period_mean'      : da.mean(dim='time', keep_attrs=True),
+        'hour_of_day_mean' : local.groupby('time.hour').mean(),
+    }
+    for key, agg in out.items():
+        agg.name = da.name
+        agg.attrs = dict(da.attrs, aggregate=key, timezone='AEST')
+
+    return out
+
+def get_aggregate_fpath(exp, variable, aggregate, datapath=datapath):
+    '''path of a temporal aggregate file written by the converter'''
+
+    opts = get_variable_opts(variable)
+
+    return f"{datapath}/aggregates/{opts['plot_fname']}/{exp}_{opts['plot_fname']}_{aggregate}.nc"
+
+def open_aggregate(exp, variable, aggregate, datapath=datapath):
+    '''
+    opens a precomputed temporal aggregate (see aggregates), e.g. open_aggregate(exp, 'air_temperature', 'daily_max')
+    falls back to computing it lazily from the hourly file if it was not saved
+    '''
+
+    import os
+    import xarray as xr
+
+    fname = get_aggregate_fpath(exp, variable, aggregate, datapath)
+    if os.path.exists(fname):
+        record_sources([fname])
+        ds = xr.open_dataset(fname)
+        return ds[list(ds.data_vars)[0]]
+
+    print(f'no saved {aggregate} for {exp} {variable}, computing from hourly data')
+
+    return get_aggregates(open_experiment(exp, variable, datapath))[aggregate]
+
+def to_aest(da):
+    '''shift time coordinate from UTC to AEST (UTC+10)'''
+
+    import pandas as pd
+
+    return da.assign_coords(time=da['time'] + pd.Timedelta(hours=10))
+
+###############################################################################
+# derived variables, built lazily from converted variables
+
+# soil layer thicknesses (m) of the standard 4 layer JULES soil
+soil_layer_thickness = [0.1, 0.25, 0.65, 2.0]
+water_density = 1000.  # kg m-3
+
+# fluxes below this magnitude (W m-2) give NaN in flux ratios
+min_flux = 10.
+
+def derive_wind_speed(u, v):
+    return (u**2 + v**2)**0.5
+
+def derive_wind_direction(u, v):
+    '''meteorological convention: direction the wind is from, clockwise from north'''
+
+    import numpy as np
+
+    return (270. - np.rad2deg(np.arctan2(v, u))) % 360.
+
+def derive_net_radiation(sw_net, lw_net):
+    return sw_net + lw_net
+
+def derive_bowen_ratio(sensible, latent):
+    return (sensible / latent).where(abs(latent) >= min_flux)
+
+def derive_evaporative_fraction(sensible, latent):
+    return (latent / (sensible + latent)).where(abs(sensible + latent) >= min_flux)
+
+def derive_volumetric_soil_moisture(soil_moisture, level):
+    '''soil moisture (kg m-2) to volumetric water content (m3 m-3)'''
+
+    return soil_moisture / (soil_layer_thickness[level] * water_density)
+
+# derived variable -> (function, input variables)
+derived_variables = {
+    'wind_speed'          : (derive_wind_speed, ['wind_u', 'wind_v']),
+    'wind_direction'      : (derive_wind_direction, ['wind_u', 'wind_v']),
+    'net_radiation'       : (derive_net_radiation, ['surface_net_shortwave_flux', 'surface_net_longwave_flux']),
+    'bowen_ratio'         : (derive_bowen_ratio, ['sensible_heat_flux', 'latent_heat_flux']),
+    'evaporative_fraction': (derive_evaporative_fraction, ['sensible_heat_flux', 'latent_heat_flux']),
+}
+derived_variables.update({
+    f'volumetric_soil_moisture_l{i+1}': (lambda da, i=i: derive_volumetric_soil_moisture(da, i), [f'soil_moisture_l{i+1}'])
+    for i in range(4)})
+
+def get_derived_fpath(exp, variable, datapath=datapath):
+    '''path of the cached netcdf file for a derived variable'''
+
+    opts = get_variable_opts(variable)
+
+    return f"{datapath}/derived/{opts['plot_fname']}/{exp}_{opts['plot_fname']}.nc"
+
+def get_source_fpaths(exp, variable, datapath=datapath):
+    '''converted files a derived variable is built from (following derived inputs)'''
+
+    import os
+
+    if variable in derived_variables and not os.path.exists(get_fpath(exp, variable, datapath)):
+        return [fpath for var in derived_variables[variable][1] for fpath in get_source_fpaths(exp, var, datapath)]
+
+    return [get_fpath(exp, variable, datapath)]
+
+def open_derived(exp, variable, datapath=datapath, chunks={}, aest=False, cache=False):
+    '''
+    lazy derived variable from its converted inputs (see derived_variables)
+        cache (bool): write the derived variable to {datapath}/derived on first use and read it
+                      afterwards, rebuilding if any input file is newer
+    '''
+
+    import os
+    import xarray as xr
+
+    func, inputs = derived_variables[variable]
+    opts = get_variable_opts(variable)
+    fname = get_derived_fpath(exp, variable, datapath)
+
+    if cache and os.path.exists(fname) and all(
+        os.path.getmtime(fname) >= os.path.getmtime(src) for src in get_source_fpaths(exp, variable, datapath)):
+        da = xr.open_dataset(fname, chunks=chunks)[variable]
+    else:
+        das = xr.align(*[open_experiment(exp, var, datapath, chunks) for var in inputs], join='inner')
+        da = func(*das)
+        da.name = variable
+        da.attrs = {'long_name': opts['plot_title'], 'units': opts['units'],
+            'derived_from': ', '.join(inputs)}
+        if cache:
+            print(f'saving derived {variable} for {exp}')
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            da.astype(opts['dtype']).to_dataset().to_netcdf(fname)
+            da = xr.open_dataset(fname, chunks=chunks)[variable]
+
+    if aest:
+        da = to_aest(da)
+
+    return da
+
+###############################################################################
+# on disk memoization of analysis results (e.g. region mean series and diurnal cycles in notebooks)
+
+memo_path = f'{datapath}/memo'
+max_memo_size = 20e9  # bytes, least recently used results are removed above this
+
+# files opened with open_experiment/open_aggregate are recorded here while a memoized function runs
+memo_sources = []
+
+def record_sources(fpaths):
+    '''record files read by the memoized functions currently running'''
+
+    for sources in memo_sources:
+        sources.extend(fpaths)
+
+def get_fingerprints(fpaths):
+    '''file -> [size, modification time (ns)], None for missing files'''
+
+    import os
+
+    prints = {}
+    for fpath in sorted(set(fpaths)):
+        try:
+            stat = os.stat(fpath)
+            prints[fpath] = [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError:
+            prints[fpath] = None
+
+    return prints
+
+def get_memo_key(func, args, kwargs, fpaths=[]):
+    '''hash of the function (module, name and source code), its arguments and input file fingerprints'''
+
+    import inspect
+    from dask.base import tokenize
+
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = func.__code__.co_code
+
+    # xarray arguments from open_dataset are tokenized by file name and modification time, not values
+    return tokenize(func.__module__, func.__qualname__, source, args, kwargs, get_fingerprints(fpaths))
+
+def memo_dict_key(key):
+    '''dict key as saved by write_memo (numpy scalars as python str/int), TypeError if not supported'''
+
+    import numpy as np
+
+    parts = key if isinstance(key, tuple) else (key,)
+    parts = [part.item() if isinstance(part, (np.integer, np.str_)) else part for part in parts]
+    if not all(isinstance(part, (str, int)) and not isinstance(part, bool) for part in parts):
+        raise TypeError(f'memoize can only save dicts with str or int keys (or tuples of them), not {key!r}')
+
+    return tuple(parts) if isinstance(key, tuple) else parts[0]
+
+def write_memo(result, fname, sources):
+    '''save a DataArray, Dataset or dict of them as compressed netcdf (one group per dict item)'''
+
+    import os
+    import json
+    import xarray as xr
+
+    def compressed(ds):
+        for var in ds.data_vars:
+            if ds[var].dtype.kind in 'biuf':
+                ds[var].encoding.update({'zlib': True, 'complevel': 4, 'shuffle': True})
+        return ds
+
+    def to_dataset(obj):
+        if isinstance(obj, xr.DataArray):
+            name = '__memo__' if obj.name is None else obj.name
+            return obj.to_dataset(name=name).assign_attrs(memo_type='DataArray', memo_name=str(obj.name))
+        elif isinstance(obj, xr.Dataset):
+            return obj.copy().assign_attrs(memo_type='Dataset')
+        raise TypeError(f'memoize can only save DataArray, Dataset or a dict of them, not {type(obj)}')
+
+    # keys are stored as json, so only str and int keys (or tuples of them) are read back unchanged
+    if isinstance(result, dict):
+        keys = [memo_dict_key(key) for key in result]
+
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp = f'{fname}.{os.getpid()}.tmp'
+    root = xr.Dataset(attrs={'sources': json.dumps(get_fingerprints(sources))})
+
+    try:
+        if isinstance(result, dict):
+            root.attrs.update({'memo_type': 'dict', 'keys': json.dumps(keys)})
+            root.to_netcdf(tmp, mode='w')
+            for i, obj in enumerate(result.values()):
+                compressed(to_dataset(obj)).to_netcdf(tmp, mode='a', group=f'item{i}')
+        else:
+            ds = to_dataset(result)
+            compressed(ds.assign_attrs(root.attrs)).to_netcdf(tmp, mode='w')
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    os.replace(tmp, fname)
+
+def read_memo(fname):
+    '''load a saved result and the fingerprints of the files it was computed from'''
+
+    import json
+    import xarray as xr
+
+    def from_dataset(ds):
+        if ds.attrs.get('memo_type') == 'DataArray':
+            da = ds[list(ds.data_vars)[0]]
+            da.name = None if ds.attrs['memo_name'] == 'None' else ds.attrs['memo_name']
+            return da
+        for key in ['memo_type', 'sources']:
+            ds.attrs.pop(key, None)
+        return ds
+
+    root = xr.load_dataset(fname)
+    sources = json.loads(root.attrs['sources'])
+    if root.attrs['memo_type'] == 'dict':
+        # tuple keys are written as json lists
+        keys = [tuple(key) if isinstance(key, list) else key for key in json.loads(root.attrs['keys'])]
+        result = {key: from_dataset(xr.load_dataset(fname, group=f'item{i}')) for i, key in enumerate(keys)}
+    else:
+        result = from_dataset(root)
+
+    return result, sources
+
+def evict_memo(path=memo_path, max_size=max_memo_size, keep=None):
+    '''remove the least recently used results until the memo directory is below max_size (never keep)'''
+
+    import os
+    import glob
+
+    files = sorted([f for f in glob.glob(f'{path}/*.nc') if f != keep], key=os.path.getmtime)
+    if keep is not None and os.path.exists(keep):
+        max_size -= os.path.getsize(keep)
+    total = sum(os.path.getsize(f) for f in files)
+    while files and total > max_size:
+        fname = files.pop(0)
+        total -= os.path.getsize(fname)
+        os.remove(fname)
+
+def clear_memo(func_name=None, path=memo_path):
+    '''remove saved results (of one function, or all)'''
+
+    import os
+    import re
+    import glob
+
+    # memo files are {func_name}_{32 hex digit key}.nc, so e.g. diurnal does not match diurnal_x
+    pattern = re.compile(rf"{re.escape(func_name) if func_name else '.+'}_[0-9a-f]{{32}}\.nc")
+    for fname in glob.glob(f"{path}/{func_name or '*'}_*.nc"):
+        if pattern.fullmatch(os.path.basename(fname)):
+            os.remove(fname)
+
+def memoize(func=None, inputs=None, path=memo_path, max_size=max_memo_size):
+    '''
+    decorator saving results of an expensive analysis function to disk, returned on later calls
+    (including after a kernel restart) with the same function code and arguments
+        inputs (callable): called with the function arguments, returns extra input files to fingerprint
+    results are DataArrays, Datasets or dicts of them (e.g. {label: series}, with str or int keys,
+    including numpy scalars, or tuples of them), loaded into memory. Results that cannot be saved
+    are returned with a warning, and unreadable saved results are removed and recomputed.
+    The newest result is kept even if it is larger than max_size.
+    Files read with open_experiment or open_aggregate during the first call are recorded, and the
+    result is recomputed if any of them (or the inputs) has changed since.
+
+    e.g.
+        @cf.memoize
+        def diurnal(exp, variable, mask):
+            da = cf.open_experiment(exp, variable, aest=True).where(mask)
+            return da.mean(dim=['latitude', 'longitude']).groupby('time.hour').mean()
+    '''
+
+    import os
+    import functools
+
+    if func is None:
+        return functools.partial(memoize, inputs=inputs, path=path, max_size=max_size)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        declared = [] if inputs is None else list(inputs(*args, **kwargs))
+        fname = f'{path}/{func.__name__}_{get_memo_key(func, args, kwargs, declared)}.nc'
+
+        if os.path.exists(fname):
+            try:
+                result, sources = read_memo(fname)
+            except Exception as e:
+                print(f'could not read saved {func.__name__} result ({e}), recomputing')
+                os.remove(fname)
+            else:
+                if get_fingerprints(sources) == sources:
+                    os.utime(fname)
+                    record_sources(list(sources))
+                    return result
+                print(f'input files of {func.__name__} changed, recomputing')
+
+        memo_sources.append(declared)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            sources = memo_sources.pop()
+        record_sources(sources)
+
+        # results are returned loaded and with the same keys as when read back from disk
+        try:
+            if isinstance(result, dict):
+                result = {memo_dict_key(key): obj.load() if hasattr(obj, 'load') else obj
+                    for key, obj in result.items()}
+            elif hasattr(result, 'load'):
+                result = result.load()
+            write_memo(result, fname, sources)
+        except TypeError as e:
+            # the result is still returned, so the computation is not lost
+            print(f'WARNING: {func.__name__} result not saved: {e}')
+            return result
+        print(f'saved {func.__name__} result: {fname}')
+        evict_memo(path, max_size, keep=fname)
+
+        return result
+
+    return wrapper
@@ -0,0 +1,125 @@
+'''
+Pressure level analysis across nested domains (e.g. geopotential height progression).
+
+All pressure levels, domains and experiments of a variable are opened as one lazily chunked
+Dataset, with one (experiment, level, time, latitude, longitude) array per domain. The outer
+domain is also conservatively regridded to the inner grid once (see regrid_functions), so
+inner and outer differences can be compared directly. Time progression difference maps and
+domain mean difference series for every level and domain are then computed in one dask graph.
+
+Usage:
+    import level_functions as lf
+
+    ds = lf.open_nested(['control', 'drysoil'], 'geopotential_height', ['500hPa', '850hPa'])
+    times = [f'2020-02-{day}T{hour:02d}:00' for day in ['09', '10'] for hour in [13, 16, 19]]
+    maps, series = lf.progression(ds, control='control', times=times)
+    maps['outer'].sel(experiment='drysoil', level='850hPa').isel(time=0).plot()
+
+    # region mean profiles from preprocessing/extract_profiles.py
+    profiles = lf.open_profiles(list(cf.experiments.values()), 'air_temperature_plev', aest=True)
+    profiles.sel(region='fires').groupby('time.hour').mean().sel(hour=15).plot.line(y='pressure')
+'''
+
+import dask
+import pandas as pd
+import xarray as xr
+
+import common_functions as cf
+
+###############################################################################
+
+# domain label -> suffix of the experiment names in the archive
+domains = {'inner': 'd0198_RAL3P2', 'outer': 'd1100_GAL9'}
+
+###############################################################################
+
+def open_levels(exps, variable, levels, domain, datapath=cf.datapath, aest=True):
+    '''
+    lazy (experiment, level, time, latitude, longitude) array for one domain
+        exps (list): experiment prefixes (e.g. 'control', 'drysoil')
+        variable (string): variable name without the level (e.g. 'geopotential_height')
+        levels (list): pressure levels as in get_variable_opts (e.g. '500hPa')
+        domain (string): archive suffix of the domain (e.g. 'd0198_RAL3P2')
+    '''
+
+    stack = []
+    for exp in exps:
+        das = [cf.open_experiment(f'{exp}_{domain}', f'{variable}_{level}', datapath, aest=aest) for level in levels]
+        stack.append(xr.concat(das, dim=xr.DataArray(levels, dims='level', name='level'), join='inner'))
+
+    da = xr.concat(stack, dim=xr.DataArray(exps, dims='experiment', name='experiment'), join='inner')
+
+    return da.transpose('experiment', 'level', 'time', 'latitude', 'longitude')
+
+def open_nested(exps, variable, levels, domains=domains, inner='inner', datapath=cf.datapath, aest=True):
+    '''
+    lazy Dataset of a variable for all experiments, levels and domains
+    each domain keeps its own grid (dims lat_<domain>/lon_<domain>, except the inner domain,
+    which keeps latitude/longitude), and each other domain is also regridded to the inner grid
+    as <domain>_on_<inner>
+    '''
+
+    import regrid_functions as rf
+
+    ds = xr.Dataset()
+    grid = open_levels(exps, variable, levels, domains[inner], datapath, aest)
+    ds[inner] = grid
+
+    for label, domain in domains.items():
+        if label == inner:
+            continue
+        da = open_levels(exps, variable, levels, domain, datapath, aest)
+        # weights are computed once and applied to the whole (experiment, level, time) stack
+        regridded = rf.regrid(da, grid.longitude, grid.latitude)
+        ds[f'{label}_on_{inner}'] = regridded.reindex(time=grid.time)
+        ds[label] = da.rename({'latitude': f'lat_{label}', 'longitude': f'lon_{label}'})
+
+    ds.attrs = {'variable': variable, 'inner': inner, 'domains': str(domains)}
+
+    return ds
+
+def progression(ds, control, times, mask=None):
+    '''
+    experiment minus control difference maps at times, and domain mean difference series,
+    for every level and domain in one dask pass
+        times (list): times of the maps (nearest output time is used)
+        mask (DataArray): boolean mask on the inner grid applied to the inner domain means
+    returns (maps, series) Datasets, each with the variables of ds
+    '''
+
+    diff = ds - ds.sel(experiment=control)
+    diff = diff.drop_sel(experiment=control)
+    times = pd.to_datetime(times)
+
+    maps = diff.sel(time=times, method='nearest').assign_coords(time=times)
+
+    series = xr.Dataset()
+    for name, da in diff.data_vars.items():
+        spatial = [dim for dim in da.dims if dim not in ['experiment', 'level', 'time']]
+        if mask is not None and 'latitude' in da.dims:
+            da = da.where(mask)
+        series[name] = da.mean(dim=spatial)
+
+    print(f'computing {len(times)} difference maps and domain mean series for {len(ds.data_vars)} domains')
+    maps, series = dask.compute(maps, series)
+
+    return maps, series
+
+def open_profiles(exps, variable, datapath=cf.datapath, aest=False):
+    '''
+    region mean profiles written by preprocessing/extract_profiles.py
+        exps (list): experiment names
+        variable (string): multi-level variable in get_variable_opts (e.g. 'air_temperature_plev')
+    returns DataArray (experiment, time, pressure, region), the vertical dimension named as by iris
+    ('pressure' for pressure levels, 'model_level_number' for model levels)
+    '''
+
+    opts = cf.get_variable_opts(variable)
+    das = [xr.open_dataset(f"{datapath}/profiles/{opts['plot_fname']}/{exp}_{opts['plot_fname']}_profiles.nc")[variable]
+        for exp in exps]
+    da = xr.concat(das, dim=xr.DataArray(exps, dims='experiment', name='experiment'), join='inner')
+
+    if aest:
+        da = cf.to_aest(da)
+
+    return da.transpose('experiment', 'time', ...)
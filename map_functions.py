@@ -0,0 +1,122 @@
+'''
+Multi-resolution pyramid of time mean and difference maps for fast map rendering.
+
+For a variable, the time mean of every experiment and period, and its difference from control,
+are computed once (in one dask pass) and stored with 2x, 4x and 8x block mean coarsened copies
+as one netcdf group per level. plot_map then reads only the level that matches the pixel width
+of the axes at the figure dpi (nearest resolution), so multi-panel maps (8 experiments x periods) render without
+reducing the hourly data again or drawing more cells than there are pixels.
+
+Usage:
+    import common_functions as cf
+    import map_functions as mf
+
+    periods = [('2020-01-16', '2020-01-21', '16-21 Jan'), ('2020-02-07', '2020-02-13', '7-13 Feb')]
+    fname = mf.build_pyramid(cf.experiments, 'air_temperature', periods)
+
+    fig, axes = plt.subplots(2, 4, figsize=(16, 8), dpi=100, subplot_kw={'projection': ccrs.PlateCarree()})
+    for ax, label in zip(axes.flat, cf.experiments):
+        mf.plot_map(ax, fname, label, '7-13 Feb', field='diff', cmap='RdBu_r', vmin=-3, vmax=3)
+'''
+
+import os
+import numpy as np
+import xarray as xr
+
+import common_functions as cf
+
+###############################################################################
+
+# coarsening factors stored in each pyramid
+factors = [1, 2, 4, 8]
+
+###############################################################################
+
+def get_pyramid_fpath(variable, datapath=cf.datapath):
+    '''path of the pyramid file for a variable'''
+
+    opts = cf.get_variable_opts(variable)
+
+    return f"{datapath}/pyramids/{opts['plot_fname']}_pyramid.nc"
+
+def time_means(exps, variable, periods=None, datapath=cf.datapath, aest=True):
+    '''
+    lazy (experiment, period, latitude, longitude) time means labelled by the keys of exps
+    without periods the whole run is used, read from saved period_mean aggregates where available
+    '''
+
+    means = []
+    for exp in exps.values():
+        if periods is None:
+            mean = cf.open_aggregate(exp, variable, 'period_mean', datapath).expand_dims(period=['all'])
+        else:
+            da = cf.open_experiment(exp, variable, datapath, aest=aest)
+            mean = xr.concat([da.sel(time=slice(start, end)).mean(dim='time') for start, end, _ in periods],
+                dim=xr.DataArray([label for _, _, label in periods], dims='period', name='period'))
+        means.append(mean)
+
+    return xr.concat(means, dim=xr.DataArray(list(exps.keys()), dims='experiment', name='experiment'),
+        join='inner')
+
+def build_pyramid(exps, variable, periods=None, control='Control', datapath=cf.datapath, fname=None):
+    '''
+    compute and save time means and differences from control at each coarsening factor
+        exps (dict): label -> experiment name (e.g. cf.experiments)
+        periods (list): (start, end, label) tuples, None for the whole run
+        control (string): label in exps that differences are taken from
+    returns the pyramid file name (one netcdf group 'x<factor>' per level)
+    '''
+
+    fname = get_pyramid_fpath(variable, datapath) if fname is None else fname
+
+    mean = time_means(exps, variable, periods, datapath)
+    ds = xr.Dataset({'mean': mean, 'diff': mean - mean.sel(experiment=control)})
+    ds.attrs = {'variable': variable, 'control': control, 'units': cf.get_variable_opts(variable)['units']}
+
+    print(f'computing time means for {len(exps)} experiments and {mean.period.size} periods')
+    ds = ds.compute()
+
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    for i, factor in enumerate(factors):
+        level = ds if factor == 1 else ds.coarsen(latitude=factor, longitude=factor, boundary='trim').mean()
+        level.attrs = dict(ds.attrs, factor=factor)
+        level.astype('float32').to_netcdf(fname, group=f'x{factor}', mode='w' if i == 0 else 'a')
+    print(f'saved pyramid: {fname}')
+
+    return fname
+
+def get_factor(ncells, width_inches, dpi):
+    '''pyramid factor with the number of cells across the axes closest to the number of pixels'''
+
+    pixels = width_inches * dpi
+    mismatch = [abs(np.log(ncells / factor / pixels)) for factor in factors]
+
+    return factors[int(np.argmin(mismatch))]
+
+def open_level(fname, factor):
+    '''open one level of a pyramid'''
+
+    return xr.open_dataset(fname, group=f'x{factor}')
+
+def plot_map(ax, fname, experiment, period='all', field='mean', dpi=None, **kwargs):
+    '''
+    pcolormesh of a pyramid field, reading the level matching the axes width at the figure dpi
+        field (string): 'mean' or 'diff'
+        kwargs: passed to pcolormesh (e.g. cmap, vmin, vmax)
+    '''
+
+    dpi = ax.figure.dpi if dpi is None else dpi
+    width = ax.get_position().width * ax.figure.get_figwidth()
+
+    with open_level(fname, 1) as full:
+        ncells = full.longitude.size
+    factor = get_factor(ncells, width, dpi)
+
+    with open_level(fname, factor) as ds:
+        da = ds[field].sel(experiment=experiment, period=period).load()
+
+    if hasattr(ax, 'projection') and 'transform' not in kwargs:
+        import cartopy.crs as ccrs
+        kwargs['transform'] = ccrs.PlateCarree()
+
+    return ax.pcolormesh(da.longitude, da.latitude, da, shading='nearest', **kwargs)
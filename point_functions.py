@@ -0,0 +1,137 @@
+'''
+Point (station or fire scar location) time series from the converted netcdf archive.
+
+A KD-tree of grid cell centres (on the unit sphere) is built once per grid (d0198, GAL9 etc.)
+and gives the nearest cell for any number of points. All points are then pulled from each
+experiment with one vectorised (pointwise) selection, so every file chunk is read once for
+all points rather than once per point, and all experiments are computed in one dask pass.
+Results are written to a compact (experiment, station, time) netcdf cache, which later
+calls read directly.
+
+Usage:
+    import common_functions as cf
+    import point_functions as pf
+
+    points = {'Katoomba': (150.31, -33.71), 'Richmond': (150.78, -33.60)}
+    ds = pf.extract_points(list(cf.experiments.values()), 'air_temperature', points)
+'''
+
+import hashlib
+import json
+import os
+import numpy as np
+import xarray as xr
+
+import common_functions as cf
+
+earth_radius = 6371.  # km
+
+###############################################################################
+
+_trees = {}
+
+def lonlat_to_xyz(lons, lats):
+    '''unit sphere cartesian coordinates, so euclidean KD-tree distances follow great circles'''
+
+    lons, lats = np.deg2rad(lons), np.deg2rad(lats)
+
+    return np.stack([np.cos(lats)*np.cos(lons), np.cos(lats)*np.sin(lons), np.sin(lats)], axis=-1)
+
+def get_grid_key(lons, lats):
+    '''short hash identifying a grid'''
+
+    key = hashlib.sha1()
+    for coord in [lons, lats]:
+        key.update(np.round(np.asarray(coord, dtype=np.float64), 6).tobytes())
+
+    return key.hexdigest()[:16]
+
+def get_tree(lons, lats):
+    '''KD-tree of cell centres for a rectilinear grid, built once per grid and kept in memory'''
+
+    from scipy.spatial import cKDTree
+
+    key = get_grid_key(lons, lats)
+    if key not in _trees:
+        lon_2d, lat_2d = np.meshgrid(lons, lats)
+        _trees[key] = cKDTree(lonlat_to_xyz(lon_2d.ravel(), lat_2d.ravel()))
+
+    return _trees[key]
+
+def nearest_cells(lons, lats, point_lons, point_lats):
+    '''
+    nearest grid cell indices for points
+    returns (iy, ix, distance in km)
+    '''
+
+    tree = get_tree(lons, lats)
+    chord, idx = tree.query(lonlat_to_xyz(np.asarray(point_lons), np.asarray(point_lats)))
+    iy, ix = np.unravel_index(idx, (len(lats), len(lons)))
+    distance = 2*earth_radius*np.arcsin(np.clip(chord/2, 0, 1))
+
+    return iy, ix, distance
+
+def select_points(da, points):
+    '''
+    pointwise selection of nearest cells from a (lazy) DataArray
+        points (dict): name -> (lon, lat)
+    returns DataArray with a 'station' dim in place of latitude/longitude
+    '''
+
+    names = list(points.keys())
+    point_lons, point_lats = np.array(list(points.values()), dtype=float).T
+    iy, ix, distance = nearest_cells(da.longitude.values, da.latitude.values, point_lons, point_lats)
+
+    out = da.isel(latitude=xr.DataArray(iy, dims='station'), longitude=xr.DataArray(ix, dims='station'))
+    out = out.assign_coords(
+        station=names,
+        station_lon=('station', point_lons),
+        station_lat=('station', point_lats),
+        distance_km=('station', distance),
+    )
+
+    return out
+
+def get_cache_fname(exps, variable, points, datapath, cache_dir):
+    '''cache file name keyed by experiments, points and source file modification times'''
+
+    # derived variables have no converted file of their own, so their inputs are used
+    fpaths = [fpath for exp in exps for fpath in cf.get_source_fpaths(exp, variable, datapath)]
+    items = [exps, variable, points, [os.stat(fpath).st_mtime_ns for fpath in fpaths]]
+    key = hashlib.sha1(json.dumps(items, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    return f'{cache_dir}/{variable}_points_{key}.nc'
+
+def extract_points(exps, variable, points, datapath=cf.datapath, cache_dir=None, aest=False):
+    '''
+    time series at the nearest grid cell to each point for several experiments
+        exps (list): experiment names
+        variable (string): variable name in get_variable_opts
+        points (dict): name -> (lon, lat)
+        cache_dir (string): where to keep extracted series (default: {datapath}/point_cache)
+    returns Dataset with dims (experiment, station, time)
+    '''
+
+    cache_dir = f'{datapath}/point_cache' if cache_dir is None else cache_dir
+    points = {name: tuple(float(x) for x in lonlat) for name, lonlat in points.items()}
+    fname = get_cache_fname(exps, variable, points, datapath, cache_dir)
+
+    if os.path.exists(fname):
+        print(f'reading cached points: {fname}')
+        ds = xr.open_dataset(fname).load()
+    else:
+        series = [select_points(cf.open_experiment(exp, variable, datapath), points) for exp in exps]
+        da = xr.concat(series, dim=xr.DataArray(exps, dims='experiment', name='experiment'))
+        da = da.transpose('experiment', 'station', ...)
+        da.name = variable
+        print(f'extracting {len(points)} points from {len(exps)} experiments')
+        ds = da.to_dataset().compute()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        ds.to_netcdf(fname)
+        print(f'saved point cache: {fname}')
+
+    if aest:
+        ds = cf.to_aest(ds)
+
+    return ds
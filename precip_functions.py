@@ -0,0 +1,116 @@
+'''
+Cumulative precipitation index for fast period and event totals.
+
+Hourly rainfall for each experiment is converted to mm and accumulated once along time into a
+cumulative sum with a leading zero slab, and cached as netcdf. The total for any window is then
+the difference of two slabs of the index, so event and period totals no longer re-read the
+hourly data, and adding new event windows costs two lookups each.
+
+Totals match .sel(time=slice(start, end)).sum(dim='time', skipna=True), i.e. both ends are
+inclusive and NaN values count as zero.
+
+Usage:
+    import common_functions as cf
+    import precip_functions as pp
+
+    cs = pp.get_cumsum('control_d0198_RAL3P2', aest=True)
+    total = pp.period_total(cs, *pp.get_agcd_window('2020-01-16', '2020-01-21'))
+    events = [('2020-01-16', '2020-01-21', '16-21 Jan'), ('2020-02-07', '2020-02-13', '7-13 Feb')]
+    totals = pp.event_totals(cs, [pp.get_agcd_window(start, end) + (label,) for start, end, label in events])
+
+    # AGCD (daily) can use the same functions
+    agcd_cs = pp.cumsum_dataset(AGCD)
+'''
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import common_functions as cf
+
+###############################################################################
+
+def cumsum_dataset(da, scale=1.):
+    '''
+    lazy cumulative sum index of a (time, ...) DataArray
+    'cumulative' has a 'step' dim of length ntime+1, where step k is the total of the first k
+    time steps (accumulated in float64, stored as float32), and 'time' holds the original times
+    '''
+
+    accum = (da.fillna(0).astype(np.float64) * scale).cumsum(dim='time')
+    zero = xr.zeros_like(accum.isel(time=[0]))
+    accum = xr.concat([zero, accum], dim='time', coords='minimal', compat='override')
+    accum = accum.drop_vars('time').rename({'time': 'step'}).astype(np.float32)
+    accum.attrs = {'units': 'mm', 'description': 'cumulative total before step (step 0 is zero)'}
+
+    return xr.Dataset({'cumulative': accum}, coords={'time': da.time.values})
+
+def get_cumsum(exp, variable='stratiform_rainfall_flux', datapath=cf.datapath, aest=False):
+    '''
+    cumulative precipitation index for an experiment, building and caching it if needed
+    precipitation flux (kg m-2 s-1) is converted to mm per hour before accumulating
+    the cache is rebuilt if a source file (the inputs of a derived variable) is newer
+    '''
+
+    opts = cf.get_variable_opts(variable)
+    srcs = cf.get_source_fpaths(exp, variable, datapath)
+    fname = f'{datapath}/cumulative_precip/{exp}_{opts["plot_fname"]}_cumulative.nc'
+
+    if not os.path.exists(fname) or any(os.path.getmtime(fname) < os.path.getmtime(src) for src in srcs):
+        print(f'building cumulative precipitation for {exp}')
+        da = cf.open_experiment(exp, variable, datapath)
+        scale = 3600. if opts['units'] == 'kg m-2 s-1' else 1.
+        cs = cumsum_dataset(da, scale)
+        cs['cumulative'].encoding.update({'zlib': True, 'shuffle': True,
+            'chunksizes': (1, da.latitude.size, da.longitude.size)})
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        cs.to_netcdf(fname)
+        print(f'saved: {fname}')
+
+    cs = xr.open_dataset(fname, chunks={'step': 1})
+    if aest:
+        cs = cf.to_aest(cs)
+
+    return cs
+
+def get_steps(cs, start, end):
+    '''index steps bounding the inclusive time window [start, end]'''
+
+    times = cs.time.values
+    i0 = np.searchsorted(times, np.datetime64(pd.Timestamp(start)), side='left')
+    i1 = np.searchsorted(times, np.datetime64(pd.Timestamp(end)), side='right')
+
+    return i0, i1
+
+def period_total(cs, start, end):
+    '''total over the inclusive time window [start, end] from two slabs of the index'''
+
+    i0, i1 = get_steps(cs, start, end)
+
+    return cs['cumulative'].isel(step=i1) - cs['cumulative'].isel(step=i0)
+
+def event_totals(cs, events):
+    '''
+    totals for many windows at once
+        events (list): (start, end, label) tuples
+    returns DataArray (event, ...) reading only the bounding slabs of each event
+    '''
+
+    steps = np.array([get_steps(cs, start, end) for start, end, _ in events])
+    labels = [label for _, _, label in events]
+    i0 = xr.DataArray(steps[:, 0], dims='event', coords={'event': labels})
+    i1 = xr.DataArray(steps[:, 1], dims='event', coords={'event': labels})
+
+    return cs['cumulative'].isel(step=i1) - cs['cumulative'].isel(step=i0)
+
+def get_agcd_window(start, end):
+    '''
+    model (AEST) time window matching AGCD daily totals (9am to 9am) from start to end date,
+    as used in the thesis rainfall notebooks
+    '''
+
+    start_time = pd.Timestamp(start) - pd.Timedelta(days=1) + pd.Timedelta(hours=9)
+    end_time = pd.Timestamp(end) + pd.Timedelta(hours=8)
+
+    return start_time, end_time
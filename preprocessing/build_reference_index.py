@@ -0,0 +1,71 @@
+'''
+Build the catalogue and kerchunk reference index of the converted netcdf archive
+
+Scans every {datapath}/{plot_fname}/{exp}_{plot_fname}.nc once (only new or updated files on
+later runs), records its metadata in {datapath}/catalogue.csv (queried with
+archive_functions.query/open_query) and writes chunk references to {datapath}/references, so each
+domain opens as one virtual zarr dataset with archive_functions.open_archive.
+Run after convert_um_to_netcdf.py. With repair_names, files converted before data variable names
+were normalised are first renamed to their plot_fname in place, with the registry long_name.
+
+GADI ENVIRONMENT
+----------------
+module use /g/data/xp65/public/modules; module load conda/analysis3
+'''
+
+import time
+import os
+import sys
+
+oshome=os.getenv('HOME')
+sys.path.append(f'{oshome}/git/RNS_Sydney_bushfire')
+import archive_functions as af
+import um_functions as uf
+
+# for timing
+tic = time.perf_counter()
+
+######## set up ########
+
+project = 'fy29'
+user = 'mjl561'
+
+########################
+
+cylc_id = 'u-dr216'
+datapath = f'/g/data/{project}/{user}/cylc-run/{cylc_id}/netcdf'
+
+# plot_fname directories to index, None for all
+variables = None
+
+# 'json', 'parquet' or 'auto' (parquet for large domains)
+fmt = 'auto'
+
+# kerchunk references as well as the catalogue
+build_references = True
+
+# rename data variables of existing files to their plot_fname and set the registry long_name
+repair_names = False
+registry_variables = uf.variables_todo + [
+    'geopotential_height_500hPa','geopotential_height_850hPa',
+    'upward_air_velocity_500hPa','upward_air_velocity_850hPa',
+    'wind_u_500hPa','wind_v_500hPa','wind_u_850hPa','wind_v_850hPa']
+
+###############################################################################
+
+if __name__ == "__main__":
+
+    if repair_names:
+        af.repair_archive(registry_variables, datapath)
+
+    catalogue = af.build_catalogue(datapath)
+    print(catalogue.groupby(['domain', 'config']).agg({'variable': 'nunique', 'experiment': 'nunique'}))
+
+    if build_references:
+        indexed = af.build_references(datapath, variables, fmt)
+        for domain, domain_vars in indexed.items():
+            print(f'{domain}: {len(domain_vars)} variables in {af.get_reference_dir(datapath)}/{domain}')
+
+    toc = time.perf_counter() - tic
+
+    print(f"Timer {toc:0.4f} seconds")
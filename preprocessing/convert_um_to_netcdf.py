@@ -12,6 +12,7 @@ module use /g/data/xp65/public/modules; module load conda/analysis3
 
 import time
 import os
+import dask
 import xarray as xr
 import iris
 import numpy as np
@@ -26,6 +27,7 @@ oshome=os.getenv('HOME')
 sys.path.append(f'{oshome}/git/RNS_Sydney_bushfire')
 import common_functions as cf
 importlib.reload(cf)
+import um_functions as uf
 
 # for timing
 tic = time.perf_counter()
@@ -42,27 +44,24 @@ cylc_id = 'u-dr216'
 regions = ['control', 'drysoil']
 regions = ['control']
 save_to_netcdf = True # whether to save netcdf files
+save_aggregates = False # also save daily, period and AEST hour of day aggregates in the same pass
+gather_land = False # store land only variables gathered to land cells (CF compression by gathering)
+
+# variables only meaningful over land (stored gathered if gather_land, the land_sea_mask must be converted first)
+land_variables = [
+    'latent_heat_flux','sensible_heat_flux','ground_heat_flux',
+    'soil_moisture_l1','soil_moisture_l2','soil_moisture_l3','soil_moisture_l4',
+    'soil_temperature_l1','soil_temperature_l2','soil_temperature_l3','soil_temperature_l4',
+    'surface_runoff_flux','subsurface_runoff_flux',
+    ]
 
 ########################
 
 cycle_path = f'/scratch/{project}/{user}/cylc-run/{cylc_id}/share/cycle'
 datapath = f'/g/data/{project}/{user}/cylc-run/{cylc_id}/netcdf'
 
-variables_todo = [
-    'land_sea_mask','air_temperature','surface_temperature','relative_humidity',
-    'latent_heat_flux','sensible_heat_flux','air_pressure_at_sea_level',
-    'surface_downwelling_shortwave_flux','surface_downwelling_longwave_flux',
-    'dew_point_temperature', 'surface_net_downward_longwave_flux','wind_u','wind_v',
-    'specific_humidity','specific_humidity_lowest_atmos_level','wind_speed_of_gust',
-    'soil_moisture_l1','soil_moisture_l2','soil_moisture_l3','soil_moisture_l4',
-    'soil_temperature_l1','soil_temperature_l2','soil_temperature_l3','soil_temperature_l4',
-    'surface_runoff_flux','subsurface_runoff_flux','surface_total_moisture_flux',
-    'surface_temperature','boundary_layer_thickness','surface_air_pressure',
-    'fog_area_fraction','visibility','cloud_area_fraction',
-    'stratiform_rainfall_amount','stratiform_rainfall_flux','convective_rainfall_amount', 'total_precipitation_rate',
-    'toa_outgoing_shortwave_flux','toa_outgoing_shortwave_flux_corrected','toa_outgoing_longwave_flux',
-    'surface_net_longwave_flux', 'surface_net_shortwave_flux','ground_heat_flux', 'surface_altitude'
-    ]
+# all converted variables (shared with build_reference_index.py)
+variables_todo = uf.variables_todo
 
 variables = ['stratiform_rainfall_amount','stratiform_rainfall_flux']
 variables = ['land_sea_mask']
@@ -82,73 +81,6 @@ variables = ['wind_u_500hPa','wind_v_500hPa','wind_u_850hPa','wind_v_850hPa']
 
 ###############################################################################
 
-def get_um_data(exp, exp_path, opts):
-    '''gets UM data, converts to xarray and local time'''
-
-    print(f'processing {exp} (constraint: {opts["constraint"]})')
-
-    fpath = f"{exp_path}/{opts['fname']}*"
-    try:
-        cb = iris.load_cube(fpath, constraint=opts['constraint'])
-        # fix timestamp/bounds error in accumulations
-        if cb.coord('time').bounds is not None:
-            print('WARNING: updating time point to right bound')
-            cb.coord('time').points = cb.coord('time').bounds[:,1]
-        da = xr.DataArray.from_iris(cb)
-    except Exception as e:
-        print(f'trouble opening {fpath}')
-        print(e)
-        return None
-
-    # fix time dimension name if needed
-    if ('time' not in da.dims) and (variable not in ['land_sea_mask','surface_altitude']):
-        print('WARNING: updating time dimension name from dim_0')
-        da = da.swap_dims({'dim_0': 'time'})
-
-    da = filter_odd_times(da)
-
-    if opts['constraint'] in [
-        'air_temperature', 
-        'soil_temperature', 
-        'dew_point_temperature', 
-        'surface_temperature'
-        ]:
-
-        print('converting from K to °C')
-        da = da - 273.15
-        da.attrs['units'] = '°C'
-
-    if opts['constraint'] in ['stratiform_rainfall_flux_mean']:
-        print('converting from mm/s to mm/h')
-        da = da * 3600.
-        da.attrs['units'] = 'mm/h'
-
-    if opts['constraint'] in ['moisture_content_of_soil_layer']:
-        da = da.isel(depth=opts['level'])
-        
-    # # Convert soil moisture from kg m-2 to volumetric water content (m3 m-3)
-    # if variable.startswith('soil_moisture_l'):
-    #     print('WARNING: converting soil moisture from kg m-2 to volumetric water content (m3 m-3)')
-    #     layer_thickness = float(da.depth.values)  # m (soil layer thickness)
-    #     water_density = 1000.0  # kg m-3
-    #     da = da / (layer_thickness * water_density)
-    #     da.attrs['units'] = 'm3 m-3'
-
-    return da
-
-def filter_odd_times(da):
-
-    if da.time.size == 1:
-        return da
-
-    minutes = da.time.dt.minute.values
-    most_common_bins = np.bincount(minutes)
-    most_common_minutes = np.flatnonzero(most_common_bins == np.max(most_common_bins))
-    filtered = np.isin(da.time.dt.minute,most_common_minutes)
-    filtered_da = da.sel(time=filtered)
-
-    return filtered_da
-
 if __name__ == "__main__":
 
     print('running variables:',variables)
@@ -173,56 +105,21 @@ if __name__ == "__main__":
         opts = cf.get_variable_opts(variable)
         ds_all = xr.Dataset()
         
-        # Get cycle list first
-        cycle_list = sorted([x.split('/')[-2] for x in glob.glob(f'{cycle_path}/*/')])
-        assert len(cycle_list) > 0, f"no cycles found in {cycle_path}"
-        
-        # Build complete experiment list for all regions
-        exps = []
-        exps_dirs = []
-        for region in regions:
-            first_cycle_path =  f'{cycle_path}/{cycle_list[0]}/{region}'
-
-            # Dynamically discover experiment directories from first cycle
-            # Include only second-level subdirectories (concatenated with parent using slash)
-            for d in sorted(os.listdir(first_cycle_path)):
-                d_path = os.path.join(first_cycle_path, d)
-                if os.path.isdir(d_path):
-                    # Second level subdirectories (concatenated with parent)
-                    try:
-                        for subdir in sorted(os.listdir(d_path)):
-                            subdir_path = os.path.join(d_path, subdir)
-                            if os.path.isdir(subdir_path):
-                                exps.append(f"{region}_{d}_{subdir}")
-                                exps_dirs.append(f"{region}/{d}/{subdir}")
-                    except (PermissionError, OSError):
-                        # Skip if we can't read the directory
-                        pass
-        
-        print(f'Found experiment directories: {exps}')
+        cycle_list = uf.get_cycle_list(cycle_path)
+        exps, exps_dirs = uf.get_experiments(cycle_path, cycle_list, regions)
 
         for exp, exp_dir in zip(exps, exps_dirs):
 
             # Extract region from experiment name
-            region = exp.split('_')[0]
+            region = cf.parse_experiment(exp)['region']
 
             da_list = []
             for i,cycle in enumerate(cycle_list):
                 print('========================')
                 print(f'getting {exp} {i}: {cycle}\n')
 
-                # experiment path
-                exp_base_path = f'{cycle_path}/{cycle}/{exp_dir}'
-                
-                # Find the um directory by searching through subdirectories
-                exp_path = None
-                if os.path.exists(exp_base_path):
-                    # Walk through subdirectories to find the 'um' directory
-                    for root, dirs, files in os.walk(exp_base_path):
-                        if 'um' in dirs:
-                            exp_path = os.path.join(root, 'um')
-                            break
-                
+                exp_path = uf.get_exp_path(cycle_path, cycle, exp_dir)
+
                 # check if experiment path exists, if not skip this cycle
                 if exp_path is None or not os.path.exists(exp_path):
                     print(f'path {exp_path} does not exist')
@@ -233,7 +130,7 @@ if __name__ == "__main__":
                     print(f'no files in {exp_path}')
                     continue
 
-                da = get_um_data(exp, exp_path, opts)
+                da = uf.get_um_data(exp, exp_path, variable, opts)
 
                 if da is None:
                     print(f'WARNING: no data found at {cycle}')
@@ -267,6 +164,9 @@ if __name__ == "__main__":
             if 'forecast_reference_time' in ds.coords:
                 ds = ds.drop_vars('forecast_reference_time')
 
+            # same data variable name and attributes for every experiment, from the variable registry
+            ds = cf.normalise_metadata(ds, variable)
+
             # chunk to optimise save
             if len(ds.dims)==3:
                 itime, ilon, ilat = ds.shape
@@ -281,6 +181,15 @@ if __name__ == "__main__":
             ds.latitude.encoding.update({'dtype':'float32', '_FillValue': -999})
             ds.encoding.update({'zlib':'true', 'shuffle': True, 'dtype':opts['dtype'], '_FillValue': -999})
 
+            # keep land cells only, read back to 2D with cf.open_experiment
+            out = ds
+            if gather_land and variable in land_variables:
+                print('gathering land cells')
+                landmask = cf.open_experiment(exp, 'land_sea_mask', datapath).squeeze(drop=True).load()
+                out = cf.gather_land(ds, landmask)
+                out[ds.name].encoding.update(ds.encoding)
+                out[ds.name].encoding.update({'chunksizes': out[ds.name].data.chunksize})
+
             if save_to_netcdf:
                 fname = f'{datapath}/{opts["plot_fname"]}/{exp}_{opts["plot_fname"]}.nc'
                 out_dir = os.path.dirname(fname)
@@ -288,7 +197,18 @@ if __name__ == "__main__":
                 if not os.path.exists(out_dir):
                     os.makedirs(out_dir)
                 print(f'saving to netcdf: {fname}')
-                ds.to_netcdf(fname, unlimited_dims='time')
+                writes = [out.to_netcdf(fname, unlimited_dims='time', compute=False)]
+
+                # aggregates share the graph of the hourly data, so the UM files are only read once
+                if save_aggregates and 'time' in ds.dims and ds.time.size > 1:
+                    for aggregate, agg in cf.get_aggregates(ds).items():
+                        agg_fname = cf.get_aggregate_fpath(exp, variable, aggregate, datapath)
+                        os.makedirs(os.path.dirname(agg_fname), exist_ok=True)
+                        print(f'saving {aggregate} to netcdf: {agg_fname}')
+                        agg.encoding.update({'zlib': True, 'shuffle': True, 'dtype': 'float32', '_FillValue': -999})
+                        writes.append(agg.to_netcdf(agg_fname, compute=False))
+
+                dask.compute(*writes)
 
             # if 'd0198' in exp:
             #     print(f'adding {exp} to ds_all')
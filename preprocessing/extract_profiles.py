@@ -0,0 +1,165 @@
+'''
+Region mean vertical profiles from multi-level UM streams
+
+All pressure (or model) levels of a 3D field are read once from the UM output of each cycle and
+reduced straight to region mean profiles (e.g. fire scars, land) for every hour and experiment.
+Only the (time, pressure, region) profiles are written, the full 3D field is never written or
+held in memory. Experiments and cycles are found as in convert_um_to_netcdf.py (um_functions.py).
+
+Variables are multi-level entries of get_variable_opts, e.g. 'air_temperature_plev'. Region
+masks are netcdf files (1 = in region) on the inner grid, and are regridded conservatively to
+other domains (>= 50% coverage).
+
+Output: {datapath}/profiles/{plot_fname}/{exp}_{plot_fname}_profiles.nc
+
+GADI ENVIRONMENT
+----------------
+module use /g/data/xp65/public/modules; module load conda/analysis3
+'''
+
+import time
+import os
+import sys
+import xarray as xr
+
+oshome=os.getenv('HOME')
+sys.path.append(f'{oshome}/git/RNS_Sydney_bushfire')
+import common_functions as cf
+import um_functions as uf
+
+# for timing
+tic = time.perf_counter()
+
+######## set up ########
+
+project = 'fy29'
+user = 'mjl561'
+
+########################
+
+cylc_id = 'u-dr216'
+regions = ['control', 'drysoil']
+
+cycle_path = f'/scratch/{project}/{user}/cylc-run/{cylc_id}/share/cycle'
+datapath = f'/g/data/{project}/{user}/cylc-run/{cylc_id}/netcdf'
+
+variables = ['air_temperature_plev','specific_humidity_plev','wind_u_plev','wind_v_plev',
+             'upward_air_velocity_plev','geopotential_height_plev']
+
+# region name -> (netcdf file, variable name) for ancil files, (experiment, variable) for the
+# converted archive (opened with cf.open_experiment), None for the whole domain
+region_masks = {
+    'fires' : ('/scratch/ng72/as9583/cylc-run/ancil_blue_mountains/share/data/ancils/Bluemountains/d0198/fire_mask.nc', 'fire_mask'),
+    'land'  : ('control_d0198_RAL3P2', 'land_sea_mask'),
+    'domain': None,
+    }
+
+###############################################################################
+
+def load_masks(region_masks):
+    '''boolean region masks (None for the whole domain)'''
+
+    masks = {}
+    for region, src in region_masks.items():
+        if src is None:
+            masks[region] = None
+            continue
+        fname, name = src
+        if fname.endswith('.nc'):
+            mask = xr.open_dataset(fname)[name].squeeze(drop=True)
+        else:
+            # data variable names differ between older and newer converted files
+            mask = cf.open_experiment(fname, name, datapath).squeeze(drop=True)
+        masks[region] = mask.drop_vars([c for c in mask.coords if c not in ['latitude', 'longitude']]) == 1
+
+    return masks
+
+def match_mask(mask, da):
+    '''put a mask on the grid of da (conservative regrid and >= 50% coverage if the grids differ)'''
+
+    if mask is None:
+        return None
+
+    if mask.latitude.size == da.latitude.size and mask.longitude.size == da.longitude.size:
+        return mask.assign_coords(latitude=da.latitude, longitude=da.longitude)
+
+    import regrid_functions as rf
+
+    return rf.regrid(mask.astype(float), da.longitude, da.latitude) >= 0.5
+
+def region_profiles(da, masks):
+    '''lazy region mean profiles (time, pressure, region) from a (time, pressure, latitude, longitude) field'''
+
+    profiles = []
+    for mask in masks.values():
+        mask = match_mask(mask, da)
+        profiles.append((da if mask is None else da.where(mask)).mean(dim=['latitude', 'longitude']))
+
+    profiles = xr.concat(profiles, dim=xr.DataArray(list(masks.keys()), dims='region', name='region'))
+
+    return profiles.transpose('time', ..., 'region')
+
+if __name__ == "__main__":
+
+    print('running variables:',variables)
+
+    print('load dask')
+    from dask.distributed import Client
+    n_workers = int(os.environ['PBS_NCPUS'])
+    local_directory = os.path.join(os.environ['PBS_JOBFS'], 'dask-worker-space')
+    try:
+        print(client)
+    except Exception:
+        client = Client(
+            n_workers=n_workers,
+            threads_per_worker=1,
+            local_directory = local_directory)
+
+    masks = load_masks(region_masks)
+    cycle_list = uf.get_cycle_list(cycle_path)
+    exps, exps_dirs = uf.get_experiments(cycle_path, cycle_list, regions)
+
+    for variable in variables:
+        print(f'processing {variable}')
+        opts = cf.get_variable_opts(variable)
+
+        for exp, exp_dir in zip(exps, exps_dirs):
+
+            profile_list = []
+            for i,cycle in enumerate(cycle_list):
+                print(f'getting {exp} {i}: {cycle}')
+
+                exp_path = uf.get_exp_path(cycle_path, cycle, exp_dir)
+                if exp_path is None:
+                    print(f'no um directory for {exp} at {cycle}')
+                    continue
+
+                da = uf.get_um_data(exp, exp_path, variable, opts)
+                if da is None:
+                    print(f'WARNING: no data found at {cycle}')
+                    continue
+
+                # reduce lazily, the 3D field is only read one chunk at a time
+                profile_list.append(region_profiles(da, masks))
+
+            if len(profile_list) == 0:
+                print(f'no data for {exp}, skipping')
+                continue
+
+            print('computing profiles')
+            profiles = xr.concat(profile_list, dim='time').compute()
+            for coord in ['forecast_period', 'forecast_reference_time']:
+                if coord in profiles.coords:
+                    profiles = profiles.drop_vars(coord)
+            profiles.name = variable
+            profiles.attrs.update({'units': opts['units'], 'regions': ', '.join(masks.keys()),
+                'created_by': 'extract_profiles.py'})
+
+            fname = f'{datapath}/profiles/{opts["plot_fname"]}/{exp}_{opts["plot_fname"]}_profiles.nc'
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            print(f'saving to netcdf: {fname}')
+            profiles.to_dataset().to_netcdf(fname, unlimited_dims='time')
+
+    toc = time.perf_counter() - tic
+
+    print(f"Timer {toc:0.4f} seconds")
@@ -0,0 +1,57 @@
+'''
+Space major copies of converted variables for per grid cell time series work
+
+The converted files are chunked {'time':24, full latitude/longitude}, which suits maps but means
+every chunk of the run is read for the time series of a single cell. This writes a copy of the
+selected variables chunked (full time, tile, tile) to {datapath}/space_major, reading bands of
+latitude rows so memory stays below max_mem. archive_functions.open_layout then reads the copy
+for per cell operations (percentiles, significance tests, diurnal composites) and the converted
+files for maps. Run after convert_um_to_netcdf.py, copies newer than their source are skipped.
+
+GADI ENVIRONMENT
+----------------
+module use /g/data/xp65/public/modules; module load conda/analysis3
+'''
+
+import time
+import os
+import sys
+
+oshome=os.getenv('HOME')
+sys.path.append(f'{oshome}/git/RNS_Sydney_bushfire')
+import common_functions as cf
+import archive_functions as af
+
+# for timing
+tic = time.perf_counter()
+
+######## set up ########
+
+project = 'fy29'
+user = 'mjl561'
+
+########################
+
+cylc_id = 'u-dr216'
+datapath = f'/g/data/{project}/{user}/cylc-run/{cylc_id}/netcdf'
+
+variables = ['air_temperature','latent_heat_flux','sensible_heat_flux','boundary_layer_thickness']
+exps = list(cf.experiments.values())
+
+tile = af.space_major_tile      # latitude x longitude cells per chunk
+max_mem = af.max_rechunk_mem    # bytes held per band of latitude rows
+
+###############################################################################
+
+if __name__ == "__main__":
+
+    for variable in variables:
+        for exp in exps:
+            if not os.path.exists(cf.get_fpath(exp, variable, datapath)):
+                print(f'no converted file for {exp} {variable}, skipping')
+                continue
+            af.rechunk_space_major(exp, variable, datapath, tile, max_mem)
+
+    toc = time.perf_counter() - tic
+
+    print(f"Timer {toc:0.4f} seconds")
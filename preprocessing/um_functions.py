@@ -0,0 +1,154 @@
+'''
+Reading UM output for the preprocessing scripts
+
+Shared by convert_um_to_netcdf.py, extract_profiles.py and build_reference_index.py, so none
+imports another (and its set up). Experiments are discovered from the first cycle of the cylc run.
+'''
+
+import glob
+import os
+import numpy as np
+import xarray as xr
+
+###############################################################################
+
+# variables converted by convert_um_to_netcdf.py (names in get_variable_opts)
+variables_todo = [
+    'land_sea_mask','air_temperature','surface_temperature','relative_humidity',
+    'latent_heat_flux','sensible_heat_flux','air_pressure_at_sea_level',
+    'surface_downwelling_shortwave_flux','surface_downwelling_longwave_flux',
+    'dew_point_temperature', 'surface_net_downward_longwave_flux','wind_u','wind_v',
+    'specific_humidity','specific_humidity_lowest_atmos_level','wind_speed_of_gust',
+    'soil_moisture_l1','soil_moisture_l2','soil_moisture_l3','soil_moisture_l4',
+    'soil_temperature_l1','soil_temperature_l2','soil_temperature_l3','soil_temperature_l4',
+    'surface_runoff_flux','subsurface_runoff_flux','surface_total_moisture_flux',
+    'surface_temperature','boundary_layer_thickness','surface_air_pressure',
+    'fog_area_fraction','visibility','cloud_area_fraction',
+    'stratiform_rainfall_amount','stratiform_rainfall_flux','convective_rainfall_amount', 'total_precipitation_rate',
+    'toa_outgoing_shortwave_flux','toa_outgoing_shortwave_flux_corrected','toa_outgoing_longwave_flux',
+    'surface_net_longwave_flux', 'surface_net_shortwave_flux','ground_heat_flux', 'surface_altitude'
+    ]
+
+###############################################################################
+
+def get_um_data(exp, exp_path, variable, opts):
+    '''gets UM data for a variable (opts from get_variable_opts) and converts to xarray'''
+
+    import iris
+
+    print(f'processing {exp} (constraint: {opts["constraint"]})')
+
+    fpath = f"{exp_path}/{opts['fname']}*"
+    try:
+        cb = iris.load_cube(fpath, constraint=opts['constraint'])
+        # fix timestamp/bounds error in accumulations
+        if cb.coord('time').bounds is not None:
+            print('WARNING: updating time point to right bound')
+            cb.coord('time').points = cb.coord('time').bounds[:,1]
+        da = xr.DataArray.from_iris(cb)
+    except Exception as e:
+        print(f'trouble opening {fpath}')
+        print(e)
+        return None
+
+    # fix time dimension name if needed
+    if ('time' not in da.dims) and (variable not in ['land_sea_mask','surface_altitude']):
+        print('WARNING: updating time dimension name from dim_0')
+        da = da.swap_dims({'dim_0': 'time'})
+
+    da = filter_odd_times(da)
+
+    if opts['constraint'] in [
+        'air_temperature', 
+        'soil_temperature', 
+        'dew_point_temperature', 
+        'surface_temperature'
+        ]:
+
+        print('converting from K to °C')
+        da = da - 273.15
+        da.attrs['units'] = '°C'
+
+    if opts['constraint'] in ['stratiform_rainfall_flux_mean']:
+        print('converting from mm/s to mm/h')
+        da = da * 3600.
+        da.attrs['units'] = 'mm/h'
+
+    if opts['constraint'] in ['moisture_content_of_soil_layer']:
+        da = da.isel(depth=opts['level'])
+        
+    # # Convert soil moisture from kg m-2 to volumetric water content (m3 m-3)
+    # if variable.startswith('soil_moisture_l'):
+    #     print('WARNING: converting soil moisture from kg m-2 to volumetric water content (m3 m-3)')
+    #     layer_thickness = float(da.depth.values)  # m (soil layer thickness)
+    #     water_density = 1000.0  # kg m-3
+    #     da = da / (layer_thickness * water_density)
+    #     da.attrs['units'] = 'm3 m-3'
+
+    return da
+
+def get_cycle_list(cycle_path):
+    '''sorted list of cycle directories'''
+
+    cycle_list = sorted([x.split('/')[-2] for x in glob.glob(f'{cycle_path}/*/')])
+    assert len(cycle_list) > 0, f"no cycles found in {cycle_path}"
+
+    return cycle_list
+
+def get_experiments(cycle_path, cycle_list, regions):
+    '''experiment names and directories for all regions, discovered from the first cycle'''
+
+    exps = []
+    exps_dirs = []
+    for region in regions:
+        first_cycle_path =  f'{cycle_path}/{cycle_list[0]}/{region}'
+
+        # Dynamically discover experiment directories from first cycle
+        # Include only second-level subdirectories (concatenated with parent using slash)
+        for d in sorted(os.listdir(first_cycle_path)):
+            d_path = os.path.join(first_cycle_path, d)
+            if os.path.isdir(d_path):
+                # Second level subdirectories (concatenated with parent)
+                try:
+                    for subdir in sorted(os.listdir(d_path)):
+                        subdir_path = os.path.join(d_path, subdir)
+                        if os.path.isdir(subdir_path):
+                            exps.append(f"{region}_{d}_{subdir}")
+                            exps_dirs.append(f"{region}/{d}/{subdir}")
+                except (PermissionError, OSError):
+                    # Skip if we can't read the directory
+                    pass
+
+    print(f'Found experiment directories: {exps}')
+
+    return exps, exps_dirs
+
+def get_exp_path(cycle_path, cycle, exp_dir):
+    '''path of the um output directory for an experiment and cycle (None if not found)'''
+
+    # experiment path
+    exp_base_path = f'{cycle_path}/{cycle}/{exp_dir}'
+
+    # Find the um directory by searching through subdirectories
+    exp_path = None
+    if os.path.exists(exp_base_path):
+        # Walk through subdirectories to find the 'um' directory
+        for root, dirs, files in os.walk(exp_base_path):
+            if 'um' in dirs:
+                exp_path = os.path.join(root, 'um')
+                break
+
+    return exp_path
+
+def filter_odd_times(da):
+
+    if da.time.size == 1:
+        return da
+
+    minutes = da.time.dt.minute.values
+    most_common_bins = np.bincount(minutes)
+    most_common_minutes = np.flatnonzero(most_common_bins == np.max(most_common_bins))
+    filtered = np.isin(da.time.dt.minute,most_common_minutes)
+    filtered_da = da.sel(time=filtered)
+
+    return filtered_da
@@ -0,0 +1,156 @@
+'''
+Conservative regridding from the model grid (e.g. d0198 RAL3P2) to the AGCD observation grid.
+
+Weights are computed once as a sparse matrix from the overlap of model and AGCD grid cells,
+cached on disk keyed by both grids, and applied to whole (experiment, time) stacks with a
+single sparse matrix multiplication per dask chunk. Unlike bilinear .interp(), area weighted
+averaging conserves precipitation totals.
+
+Usage:
+    import common_functions as cf
+    import regrid_functions as rf
+
+    AGCD = xr.open_dataset('/path/to/AGCD.nc')['precip']
+    control = cf.open_experiment('control_d0198_RAL3P2', 'stratiform_rainfall_flux')
+    control_agcd = rf.regrid(control, AGCD.lon, AGCD.lat)
+
+    # all experiments in one pass
+    stack = rf.regrid_experiments(list(cf.experiments.values()), 'stratiform_rainfall_flux', AGCD.lon, AGCD.lat)
+'''
+
+import hashlib
+import os
+import numpy as np
+import xarray as xr
+
+import common_functions as cf
+
+oshome = os.getenv('HOME')
+cache_dir = f'{oshome}/.cache/regrid_weights'
+
+###############################################################################
+
+def cell_edges(centres):
+    '''cell edges (n+1) from cell centres of a rectilinear axis'''
+
+    centres = np.asarray(centres, dtype=float)
+    mid = 0.5 * (centres[1:] + centres[:-1])
+    first = centres[0] - (mid[0] - centres[0])
+    last = centres[-1] + (centres[-1] - mid[-1])
+
+    return np.concatenate([[first], mid, [last]])
+
+def overlap_matrix(src_edges, dst_edges):
+    '''1D overlap length of each destination cell (rows) with each source cell (columns)'''
+
+    # allow for descending axes
+    src_lo, src_hi = np.minimum(src_edges[:-1], src_edges[1:]), np.maximum(src_edges[:-1], src_edges[1:])
+    dst_lo, dst_hi = np.minimum(dst_edges[:-1], dst_edges[1:]), np.maximum(dst_edges[:-1], dst_edges[1:])
+
+    lo = np.maximum(dst_lo[:, None], src_lo[None, :])
+    hi = np.minimum(dst_hi[:, None], src_hi[None, :])
+
+    return np.clip(hi - lo, 0, None)
+
+def get_cache_fname(src_lons, src_lats, dst_lons, dst_lats):
+    '''cache file name keyed by the coordinates of both grids'''
+
+    key = hashlib.sha1()
+    for coord in [src_lons, src_lats, dst_lons, dst_lats]:
+        key.update(np.round(np.asarray(coord, dtype=np.float64), 6).tobytes())
+
+    return f'{cache_dir}/conservative_{key.hexdigest()[:16]}.npz'
+
+def get_weights(src_lons, src_lats, dst_lons, dst_lats, use_cache=True):
+    '''
+    sparse conservative weights (n_dst, n_src) from a source to a destination rectilinear grid
+    weights are the fraction of each destination cell covered by each source cell
+    (cells are flattened in (lat, lon) order)
+    '''
+
+    import scipy.sparse
+
+    fname = get_cache_fname(src_lons, src_lats, dst_lons, dst_lats)
+    if use_cache and os.path.exists(fname):
+        return scipy.sparse.load_npz(fname)
+
+    print('calculating conservative regridding weights')
+
+    # longitude overlap and sin(latitude) overlap give exact areas on the sphere
+    wx = overlap_matrix(cell_edges(src_lons), cell_edges(dst_lons))
+    wy = overlap_matrix(np.sin(np.deg2rad(cell_edges(src_lats))), np.sin(np.deg2rad(cell_edges(dst_lats))))
+
+    # normalise by destination cell area
+    wx = wx / np.abs(np.diff(cell_edges(dst_lons)))[:, None]
+    wy = wy / np.abs(np.diff(np.sin(np.deg2rad(cell_edges(dst_lats)))))[:, None]
+
+    weights = scipy.sparse.kron(scipy.sparse.csr_matrix(wy), scipy.sparse.csr_matrix(wx), format='csr')
+
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        scipy.sparse.save_npz(fname, weights)
+        print(f'saved weights: {fname}')
+
+    return weights
+
+def apply_weights(data, weights, dst_shape, min_coverage=0.5):
+    '''
+    apply weights to an array (..., lat, lon) in one sparse matrix multiplication
+    NaN source cells are excluded and the remaining weights renormalised, destination cells
+    with less than min_coverage valid source area are NaN
+    '''
+
+    lead = data.shape[:-2]
+    flat = data.reshape(-1, data.shape[-2]*data.shape[-1]).T
+
+    valid = np.isfinite(flat)
+    total = weights @ np.where(valid, flat, 0.)
+    coverage = weights @ valid.astype(float)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = np.where(coverage >= min_coverage, total / coverage, np.nan)
+
+    return out.T.reshape(lead + dst_shape)
+
+def regrid(da, dst_lons, dst_lats, min_coverage=0.5, use_cache=True):
+    '''
+    conservatively regrid a (lazy) DataArray with latitude/longitude dims to a destination grid
+        dst_lons, dst_lats: destination coordinates (e.g. AGCD.lon, AGCD.lat)
+    returns a DataArray with the destination coordinate names, computed lazily per chunk
+    '''
+
+    dst_lons = xr.DataArray(dst_lons) if not isinstance(dst_lons, xr.DataArray) else dst_lons
+    dst_lats = xr.DataArray(dst_lats) if not isinstance(dst_lats, xr.DataArray) else dst_lats
+    lon_name = dst_lons.name or 'lon'
+    lat_name = dst_lats.name or 'lat'
+
+    weights = get_weights(da.longitude.values, da.latitude.values,
+        dst_lons.values, dst_lats.values, use_cache)
+    dst_shape = (dst_lats.size, dst_lons.size)
+
+    out = xr.apply_ufunc(
+        apply_weights, da,
+        input_core_dims=[['latitude', 'longitude']],
+        output_core_dims=[[lat_name, lon_name]],
+        exclude_dims={'latitude', 'longitude'},
+        kwargs={'weights': weights, 'dst_shape': dst_shape, 'min_coverage': min_coverage},
+        dask='parallelized',
+        dask_gufunc_kwargs={'output_sizes': {lat_name: dst_shape[0], lon_name: dst_shape[1]}},
+        output_dtypes=[np.float64],
+    )
+    out = out.assign_coords({lat_name: dst_lats.values, lon_name: dst_lons.values})
+    out.attrs = da.attrs
+
+    return out
+
+def regrid_experiments(exps, variable, dst_lons, dst_lats, datapath=cf.datapath, aest=True, min_coverage=0.5):
+    '''
+    regrid a variable for several experiments as one (experiment, time, lat, lon) stack
+    weights are shared, so they are only calculated (or read from cache) once
+    experiments are aligned on their common times (join='inner'), not matched by position
+    '''
+
+    da = xr.concat([cf.open_experiment(exp, variable, datapath, aest=aest) for exp in exps],
+        dim=xr.DataArray(exps, dims='experiment', name='experiment'), join='inner')
+
+    return regrid(da, dst_lons, dst_lats, min_coverage)
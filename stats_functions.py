@@ -0,0 +1,403 @@
+'''
+Statistics of experiment differences for the converted archive.
+
+Percentiles of experiment minus control differences:
+    All requested percentiles for every experiment, variable and period are computed in one
+    dask pass. Fields use exact np.nanpercentile while their total size fits in memory
+    (max_exact_size values, shared by all exact fields of the pass), the others are summarised
+    block by block with mergeable t-digest sketches, so no full difference array is materialised
+    beyond that budget.
+
+Per grid cell temporal quantile maps:
+    The time series are rechunked into spatial tiles with the full time dimension, so each
+    task only holds one tile.
+
+Block bootstrap confidence intervals:
+    Region mean experiment minus control series are computed for all experiments and regions
+    in one dask pass, split into whole (AEST) days, and resampled with moving blocks of days
+    so the autocorrelation of hourly output is kept. Resamples are vectorised index arrays and
+    each (experiment, region) combination runs in its own process. Intervals are given for
+    each hour of the day and for the overall mean.
+
+Frequency histograms:
+    Bin edges come from the bins field of get_variable_opts (fixed or log spaced) and are shared
+    by every experiment. Counts are accumulated with np.histogram on each dask block and summed,
+    for all experiments, masks, resampling periods and time windows in one dask pass, so the
+    hourly archive is never loaded.
+
+Usage:
+    import common_functions as cf
+    import stats_functions as sf
+
+    periods = [('2020-01-16', '2020-01-21', '16-21 Jan'), ('2020-02-07', '2020-02-13', '7-13 Feb')]
+    diffs = sf.experiment_differences(list(cf.experiments.values()), ['stratiform_rainfall_flux'], periods,
+                                      how={'stratiform_rainfall_flux': 'sum'}, mask=landmask == 1)
+    pct = sf.difference_percentiles(diffs, q=[5, 95])
+    q90 = sf.temporal_quantile_map(cf.open_experiment('control_d0198_RAL3P2', 'air_temperature'), 0.9)
+
+    regions = {'fires': fire_mask == 1, 'land': landmask == 1}
+    ci = sf.bootstrap_ci(list(cf.experiments.values()), 'air_temperature', regions, n_boot=5000)
+
+    counts = sf.histograms(cf.experiments, 'stratiform_rainfall_flux', masks={'land': landmask == 1},
+                           resample={'daily': '1D'}, windows=[('2020-01-15', '2020-01-18', '15-18 Jan')],
+                           convert=lambda da: da*3600)
+'''
+
+import concurrent.futures
+import multiprocessing
+
+import dask
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import common_functions as cf
+
+###############################################################################
+
+# total values of the fields given exact percentiles in one pass, the rest use t-digest sketches
+max_exact_size = 2e8
+
+# t-digest compression (larger is more accurate, ~compression centroids are kept)
+compression = 200
+
+###############################################################################
+# t-digest (merging digest with the arcsine scale function, vectorised)
+
+def tdigest_compress(means, weights, delta=compression):
+    '''merge weighted centroids so that each spans at most one unit of the scale function'''
+
+    order = np.argsort(means, kind='stable')
+    means, weights = means[order], weights[order]
+    total = weights.sum()
+
+    # quantile at the centre of each centroid, and its group on the scale function
+    q = (np.cumsum(weights) - 0.5*weights) / total
+    k = delta/(2*np.pi) * np.arcsin(2*q - 1)
+    group = np.floor(k - k.min()).astype(int)
+
+    new_weights = np.bincount(group, weights=weights)
+    new_means = np.bincount(group, weights=means*weights)
+    keep = new_weights > 0
+
+    return new_means[keep]/new_weights[keep], new_weights[keep]
+
+def tdigest(values, delta=compression):
+    '''t-digest sketch of an array (NaN values are ignored)'''
+
+    values = np.asarray(values, dtype=np.float64).ravel()
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return {'means': np.array([]), 'weights': np.array([]), 'min': np.nan, 'max': np.nan}
+
+    means, weights = tdigest_compress(values, np.ones_like(values), delta)
+
+    return {'means': means, 'weights': weights, 'min': values.min(), 'max': values.max()}
+
+def tdigest_merge(digests, delta=compression):
+    '''merge several t-digest sketches'''
+
+    digests = [d for d in digests if d['weights'].size > 0]
+    if len(digests) == 0:
+        return {'means': np.array([]), 'weights': np.array([]), 'min': np.nan, 'max': np.nan}
+
+    means, weights = tdigest_compress(
+        np.concatenate([d['means'] for d in digests]),
+        np.concatenate([d['weights'] for d in digests]), delta)
+
+    return {'means': means, 'weights': weights,
+        'min': min(d['min'] for d in digests), 'max': max(d['max'] for d in digests)}
+
+def tdigest_quantile(digest, q):
+    '''approximate quantiles (0-1) from a t-digest sketch'''
+
+    if digest['weights'].size == 0:
+        return np.full(np.shape(q), np.nan)
+
+    weights = digest['weights']
+    cum = np.cumsum(weights) - 0.5*weights
+    x = np.concatenate([[0.], cum, [weights.sum()]])
+    y = np.concatenate([[digest['min']], digest['means'], [digest['max']]])
+
+    return np.interp(np.asarray(q)*weights.sum(), x, y)
+
+###############################################################################
+# percentiles of experiment differences
+
+def experiment_differences(exps, variables, periods, control=cf.experiments['Control'],
+                           how=None, mask=None, datapath=cf.datapath, aest=True):
+    '''
+    lazy experiment minus control difference fields
+        periods (list): (start, end, label) tuples, or None for the whole run
+        how (dict): variable -> 'sum', 'mean' or None (None keeps the time dimension)
+        mask (DataArray): boolean mask applied to the differences (e.g. landmask == 1)
+    returns dict (exp, variable, period label) -> DataArray
+    '''
+
+    how = {} if how is None else how
+    periods = [(None, None, 'all')] if periods is None else periods
+
+    diffs = {}
+    for variable in variables:
+        ctrl = cf.open_experiment(control, variable, datapath, aest=aest)
+        for exp in exps:
+            if exp == control:
+                continue
+            da = cf.open_experiment(exp, variable, datapath, aest=aest)
+            for start, end, label in periods:
+                diff = (da - ctrl).sel(time=slice(start, end))
+                if how.get(variable) == 'sum':
+                    diff = diff.sum(dim='time', skipna=True)
+                elif how.get(variable) == 'mean':
+                    diff = diff.mean(dim='time', skipna=True)
+                if mask is not None:
+                    diff = diff.where(mask)
+                diffs[(exp, variable, label)] = diff
+
+    return diffs
+
+def block_digests(da):
+    '''delayed t-digest for each dask block of a DataArray'''
+
+    blocks = da.data.to_delayed().ravel() if dask.is_dask_collection(da.data) else [da.values]
+
+    return [dask.delayed(tdigest)(block) for block in blocks]
+
+def difference_percentiles(diffs, q=(5, 95)):
+    '''
+    percentiles (0-100) of each difference field, all computed in one dask pass
+    fields are exact (smallest first) while their total size is up to max_exact_size values,
+    the others use t-digest sketches
+    returns DataFrame indexed by (experiment, variable, period), with one column per percentile
+    '''
+
+    q = np.atleast_1d(q)
+    keys = list(diffs.keys())
+
+    # all exact fields are held in memory together, so the limit applies to their total size
+    exact, total = [False]*len(keys), 0
+    for i in sorted(range(len(keys)), key=lambda i: diffs[keys[i]].size):
+        if total + diffs[keys[i]].size > max_exact_size:
+            break
+        exact[i], total = True, total + diffs[keys[i]].size
+
+    todo = [diffs[key].data if is_exact else block_digests(diffs[key]) for key, is_exact in zip(keys, exact)]
+    print(f'computing percentiles for {len(keys)} fields ({sum(exact)} exact, {len(keys)-sum(exact)} sketched)')
+    results = dask.compute(*todo)
+
+    rows = []
+    for result, is_exact in zip(results, exact):
+        if is_exact:
+            rows.append(np.nanpercentile(np.asarray(result, dtype=np.float64), q))
+        else:
+            rows.append(tdigest_quantile(tdigest_merge(result), q/100))
+
+    index = pd.MultiIndex.from_tuples(keys, names=['experiment', 'variable', 'period'])
+
+    return pd.DataFrame(rows, index=index, columns=[f'p{x:g}' for x in q])
+
+###############################################################################
+# per grid cell temporal quantiles
+
+def temporal_quantile_map(da, q, tile=50):
+    '''
+    lazy quantiles along time for each grid cell
+    the data are rechunked to (full time, tile x tile) blocks so each task holds one tile, unless
+    already space major (e.g. from archive_functions.open_layout(exp, variable, 'quantile'))
+    '''
+
+    if da.chunks is None or len(da.chunksizes['time']) > 1:
+        da = da.chunk({'time': -1, 'latitude': tile, 'longitude': tile})
+
+    return da.quantile(q, dim='time', skipna=True)
+
+###############################################################################
+# block bootstrap confidence intervals
+
+def region_differences(exps, variable, regions, control=cf.experiments['Control'],
+                       datapath=cf.datapath, aest=True):
+    '''
+    region mean experiment minus control series for all experiments and regions (one dask pass)
+        regions (dict): region name -> boolean mask DataArray (None for the full domain)
+    returns DataArray (experiment, region, time)
+    '''
+
+    exps = [exp for exp in exps if exp != control]
+    ctrl = cf.open_experiment(control, variable, datapath, aest=aest)
+
+    series = []
+    for exp in exps:
+        diff = cf.open_experiment(exp, variable, datapath, aest=aest) - ctrl
+        means = [(diff if mask is None else diff.where(mask)).mean(dim=['latitude', 'longitude'])
+            for mask in regions.values()]
+        series.append(xr.concat(means, dim=xr.DataArray(list(regions.keys()), dims='region', name='region')))
+
+    da = xr.concat(series, dim=xr.DataArray(exps, dims='experiment', name='experiment'))
+    print(f'computing region mean differences for {len(exps)} experiments and {len(regions)} regions')
+
+    return da.compute()
+
+def daily_table(series):
+    '''
+    hourly series (..., time) as (..., day, hour of day), keeping only complete days
+    also used by boundary_layer_functions
+    '''
+
+    times = pd.DatetimeIndex(series.time.values)
+    table = series.assign_coords(day=('time', times.normalize()), hour=('time', times.hour))
+    table = table.set_index(time=['day', 'hour']).unstack('time')
+
+    return table.reindex(hour=np.arange(24)).dropna('day', how='any')
+
+def block_indices(ndays, block_days, n_boot, rng):
+    '''(n_boot, ndays) day indices from circular moving blocks of block_days consecutive days'''
+
+    if ndays < 1:
+        raise ValueError('no complete days to resample')
+
+    nblocks = -(-ndays // block_days)
+    starts = rng.integers(0, ndays, size=(n_boot, nblocks))
+    idx = (starts[:, :, None] + np.arange(block_days)) % ndays
+
+    return idx.reshape(n_boot, -1)[:, :ndays]
+
+def bootstrap_table(table, block_days=2, n_boot=2000, alpha=0.05, seed=None, batch=1000):
+    '''
+    block bootstrap of the diurnal cycle and overall mean of a (day, hour) table
+    returns dict of (25,) arrays: estimate, lower, upper (hours 0-23, then the overall mean)
+    '''
+
+    rng = np.random.default_rng(seed)
+    ndays = table.shape[0]
+
+    samples = []
+    for start in range(0, n_boot, batch):
+        idx = block_indices(ndays, block_days, min(batch, n_boot - start), rng)
+        diurnal = table[idx].mean(axis=1)
+        samples.append(np.column_stack([diurnal, diurnal.mean(axis=1)]))
+    samples = np.concatenate(samples)
+
+    estimate = np.append(table.mean(axis=0), table.mean())
+    lower, upper = np.percentile(samples, [100*alpha/2, 100*(1 - alpha/2)], axis=0)
+
+    return {'estimate': estimate, 'lower': lower, 'upper': upper}
+
+def bootstrap_ci(exps, variable, regions, control=cf.experiments['Control'], block_days=2,
+                 n_boot=2000, alpha=0.05, seed=0, datapath=cf.datapath, max_workers=None):
+    '''
+    block bootstrap confidence intervals of region mean differences from control
+        regions (dict): region name -> boolean mask DataArray (None for the full domain)
+        block_days (int): length of the resampled blocks in (AEST) days
+        alpha (float): the intervals cover 1 - alpha
+    returns Dataset with estimate, lower and upper on (experiment, region, hour), and the same
+    for the overall mean (mean_estimate, mean_lower, mean_upper) on (experiment, region)
+    combinations without any complete day (e.g. an empty region) are NaN, with a warning
+    '''
+
+    diffs = region_differences(exps, variable, regions, control, datapath, aest=True)
+    combos = [(exp, region) for exp in diffs.experiment.values for region in diffs.region.values]
+    tables = [daily_table(diffs.sel(experiment=exp, region=region)).values for exp, region in combos]
+    seeds = np.random.SeedSequence(seed).spawn(len(combos))
+
+    # regions with no valid data (e.g. an all False mask) have no complete days, their intervals are NaN
+    ndays = [table.shape[0] for table in tables]
+    for (exp, region), n in zip(combos, ndays):
+        if n == 0:
+            print(f'WARNING: no complete days for {exp} in region {region}, intervals are NaN')
+    todo = [i for i, n in enumerate(ndays) if n > 0]
+    valid = [ndays[i] for i in todo] or [0]
+
+    print(f'bootstrapping {len(todo)} combinations with {n_boot} resamples ({min(valid)}-{max(valid)} days)')
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as pool:
+        done = pool.map(bootstrap_table, [tables[i] for i in todo], [block_days]*len(todo), [n_boot]*len(todo),
+            [alpha]*len(todo), [seeds[i] for i in todo])
+        results = [{key: np.full(25, np.nan) for key in ['estimate', 'lower', 'upper']}]*len(combos)
+        for i, result in zip(todo, done):
+            results[i] = result
+
+    shape = (diffs.experiment.size, diffs.region.size, 25)
+    coords = {'experiment': diffs.experiment.values, 'region': diffs.region.values}
+
+    ds = xr.Dataset(coords=dict(coords, hour=np.arange(24)))
+    for key in ['estimate', 'lower', 'upper']:
+        values = np.array([result[key] for result in results]).reshape(shape)
+        ds[key] = (('experiment', 'region', 'hour'), values[..., :24])
+        ds[f'mean_{key}'] = (('experiment', 'region'), values[..., 24])
+    ds.attrs = {'variable': variable, 'control': control, 'block_days': block_days,
+        'n_boot': n_boot, 'confidence': 1 - alpha}
+
+    return ds
+
+###############################################################################
+# frequency histograms
+
+def get_bin_edges(bins):
+    '''bin edges from a list, or a ('log'|'linear', min, max, n) spec (n edges)'''
+
+    if isinstance(bins, tuple) and isinstance(bins[0], str):
+        kind, lo, hi, n = bins
+        assert kind in ['log', 'linear'], f'unknown bin spacing: {kind}'
+        return np.geomspace(lo, hi, n) if kind == 'log' else np.linspace(lo, hi, n)
+
+    return np.asarray(bins, dtype=np.float64)
+
+def histograms(exps, variable, masks=None, resample=None, windows=None, bins=None, how='sum',
+               convert=None, datapath=cf.datapath, aest=True):
+    '''
+    frequency histogram counts for all combinations in one dask pass
+        exps (dict or list): label -> experiment name (or list of experiment names)
+        masks (dict): mask name -> boolean mask DataArray (None for the full domain)
+        resample (dict): period label -> resampling frequency (e.g. '1D'), None for native output
+        windows (list): (start, end, label) time windows, applied after resampling
+        bins: bin edges or spec (default: bins from get_variable_opts)
+        how (string): resampling reduction ('sum' or 'mean')
+        convert (function): applied to the model data first (e.g. lambda da: da*3600)
+    returns DataArray of counts (experiment, period, mask, window, bin), with bin edge coords
+    (NaN values are ignored and the last bin includes its upper edge, as np.histogram)
+    '''
+
+    import dask.array as dsa
+
+    exps = dict(zip(exps, exps)) if not isinstance(exps, dict) else exps
+    masks = {'domain': None} if masks is None else masks
+    resample = {'native': None} if resample is None else resample
+    windows = [(None, None, 'all')] if windows is None else windows
+    bins = cf.get_variable_opts(variable)['bins'] if bins is None else bins
+    assert bins is not None, f'no bins defined for {variable}'
+    edges = get_bin_edges(bins)
+
+    counts = []
+    for exp in exps.values():
+        da = cf.open_experiment(exp, variable, datapath, aest=aest)
+        if convert is not None:
+            da = convert(da)
+        for freq in resample.values():
+            # resample before masking so masked cells are not summed to zero
+            data = da if freq is None else getattr(da.resample(time=freq), how)()
+            for mask in masks.values():
+                masked = data if mask is None else data.where(mask)
+                for start, end, _ in windows:
+                    values = masked.sel(time=slice(start, end)).data
+                    values = values if dask.is_dask_collection(values) else dsa.from_array(values)
+                    counts.append(dsa.histogram(values, bins=edges)[0])
+
+    print(f'computing {len(counts)} histograms with {len(edges) - 1} bins')
+    counts = dask.compute(*counts)
+
+    shape = (len(exps), len(resample), len(masks), len(windows), len(edges) - 1)
+    out = xr.DataArray(
+        np.array(counts).reshape(shape),
+        dims=['experiment', 'period', 'mask', 'window', 'bin'],
+        coords={
+            'experiment': list(exps.keys()),
+            'period': list(resample.keys()),
+            'mask': list(masks.keys()),
+            'window': [label for _, _, label in windows],
+            'bin_lower': ('bin', edges[:-1]),
+            'bin_upper': ('bin', edges[1:]),
+        },
+        name='count',
+    )
+
+    return out
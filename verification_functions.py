@@ -0,0 +1,211 @@
+'''
+Model vs observation verification with streaming skill statistics.
+
+Uses the obs_key, obs_period, threshold and fmt fields of get_variable_opts. For every
+experiment, variable and region, model and observations are resampled to obs_period and
+split into time blocks. Each block is reduced to partial statistics (count, means, sums of
+squared deviations and co-deviations, absolute and squared errors, and the count of values
+within the error benchmark, |model - obs| <= threshold). The partial statistics for all
+combinations are computed in one dask pass and merged with the parallel (Chan et al.) update,
+so no block or experiment is held in memory longer than needed.
+
+Usage:
+    import common_functions as cf
+    import verification_functions as vf
+
+    AGCD = xr.open_dataset('/path/to/AGCD.nc')['precip']
+    obs = {cf.get_variable_opts('stratiform_rainfall_flux')['obs_key']: AGCD}
+    regions = {'fires': fire_mask, 'land': landmask == 1}
+    stats = vf.verify(list(cf.experiments.values()), ['stratiform_rainfall_flux'], obs, regions,
+                      obs_period='1D', convert={'stratiform_rainfall_flux': lambda da: da*86400})
+    print(vf.format_stats(stats))
+'''
+
+import dask
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import common_functions as cf
+
+###############################################################################
+
+moment_keys = ['n', 'mean_m', 'mean_o', 'm2_m', 'm2_o', 'c_mo']
+count_keys = ['sae', 'sse', 'within']
+
+###############################################################################
+
+def get_resample_period(period):
+    '''pandas offset alias from obs_period (e.g. '1H' -> '1h')'''
+
+    return period.replace('H', 'h').replace('T', 'min')
+
+def block_stats(model, obs, threshold=None):
+    '''lazy partial statistics for one block of matching model and obs values'''
+
+    valid = model.notnull() & obs.notnull()
+    m, o = model.where(valid), obs.where(valid)
+    mean_m, mean_o = m.mean(), o.mean()
+    err = m - o
+
+    stats = {
+        'n'     : valid.sum(),
+        'mean_m': mean_m,
+        'mean_o': mean_o,
+        'm2_m'  : ((m - mean_m)**2).sum(),
+        'm2_o'  : ((o - mean_o)**2).sum(),
+        'c_mo'  : ((m - mean_m)*(o - mean_o)).sum(),
+        'sae'   : abs(err).sum(),
+        'sse'   : (err**2).sum(),
+    }
+
+    # threshold is the registry error benchmark (e.g. 2 °C), not an exceedance level
+    if threshold is not None:
+        stats['within'] = (abs(err) <= threshold).sum()
+
+    return {key: val.data for key, val in stats.items()}
+
+def combine_stats(a, b):
+    '''merge two sets of partial statistics (parallel algorithm for means and co-moments)'''
+
+    if a['n'] == 0:
+        return dict(b)
+    if b['n'] == 0:
+        return dict(a)
+
+    n = a['n'] + b['n']
+    d_m = b['mean_m'] - a['mean_m']
+    d_o = b['mean_o'] - a['mean_o']
+    f = a['n']*b['n']/n
+
+    out = {
+        'n'     : n,
+        'mean_m': a['mean_m'] + d_m*b['n']/n,
+        'mean_o': a['mean_o'] + d_o*b['n']/n,
+        'm2_m'  : a['m2_m'] + b['m2_m'] + d_m*d_m*f,
+        'm2_o'  : a['m2_o'] + b['m2_o'] + d_o*d_o*f,
+        'c_mo'  : a['c_mo'] + b['c_mo'] + d_m*d_o*f,
+    }
+    for key in count_keys:
+        if key in a or key in b:
+            out[key] = a.get(key, 0) + b.get(key, 0)
+
+    return out
+
+def finalise_stats(stats):
+    '''skill scores from merged partial statistics'''
+
+    n = stats['n']
+    out = {'n': int(n)}
+    if n == 0:
+        return out
+
+    out.update({
+        'bias' : stats['mean_m'] - stats['mean_o'],
+        'rmse' : np.sqrt(stats['sse']/n),
+        'mae'  : stats['sae']/n,
+        'corr' : stats['c_mo']/np.sqrt(stats['m2_m']*stats['m2_o']),
+        'model_mean': stats['mean_m'],
+        'obs_mean'  : stats['mean_o'],
+    })
+
+    if 'within' in stats:
+        out['within_threshold'] = stats['within']/n
+
+    return out
+
+def match_to_obs(model, obs, period):
+    '''regrid model to the obs grid if needed, resample both to period and align in time'''
+
+    if 'latitude' in model.dims and 'latitude' not in obs.dims:
+        import regrid_functions as rf
+        model = rf.regrid(model, obs.lon, obs.lat)
+
+    period = get_resample_period(period)
+    model = model.resample(time=period).mean()
+    obs = obs.resample(time=period).mean()
+
+    return xr.align(model, obs, join='inner')
+
+def match_region(mask, obs):
+    '''put a region mask on the obs grid (conservative regrid and >= 50% coverage if needed)'''
+
+    if 'latitude' in mask.dims and 'latitude' not in obs.dims:
+        import regrid_functions as rf
+        mask = rf.regrid(mask.astype(float), obs.lon, obs.lat) >= 0.5
+
+    return mask.astype(bool)
+
+def verify(exps, variables, obs, regions=None, obs_period=None, convert=None,
+           datapath=cf.datapath, aest=False, block_size=24):
+    '''
+    verification statistics for every experiment, variable and region in one parallel pass
+        exps (list): experiment names
+        variables (list): variable names in get_variable_opts
+        obs (dict): obs_key -> observation DataArray
+        regions (dict): region name -> boolean mask DataArray (None for the full domain)
+        obs_period (string): overrides obs_period from get_variable_opts
+        convert (dict): variable -> function applied to model data (e.g. unit conversion)
+        block_size (int): number of time steps (after resampling) in each block
+    returns a DataFrame indexed by (experiment, variable, region)
+    '''
+
+    regions = {'domain': None} if regions is None else regions
+    convert = {} if convert is None else convert
+
+    keys, partials = [], []
+    for variable in variables:
+        opts = cf.get_variable_opts(variable)
+        assert opts['obs_key'] in obs, f"no observations for {variable} (obs_key '{opts['obs_key']}')"
+        period = opts['obs_period'] if obs_period is None else obs_period
+
+        for exp in exps:
+            model = cf.open_experiment(exp, variable, datapath, aest=aest)
+            if variable in convert:
+                model = convert[variable](model)
+            model, ob = match_to_obs(model, obs[opts['obs_key']], period)
+
+            for region, mask in regions.items():
+                if mask is not None:
+                    mask = match_region(mask, ob)
+                    m, o = model.where(mask), ob.where(mask)
+                else:
+                    m, o = model, ob
+                blocks = [block_stats(m.isel(time=slice(i, i+block_size)), o.isel(time=slice(i, i+block_size)),
+                    opts['threshold']) for i in range(0, m.time.size, block_size)]
+                keys.append((exp, variable, region))
+                partials.append(blocks)
+
+    print(f'computing statistics for {len(keys)} experiment/variable/region combinations')
+    partials = dask.compute(*partials)
+
+    rows = []
+    for blocks in partials:
+        merged = {key: 0. for key in moment_keys}
+        for block in blocks:
+            merged = combine_stats(merged, {key: float(val) for key, val in block.items()})
+        rows.append(finalise_stats(merged))
+
+    index = pd.MultiIndex.from_tuples(keys, names=['experiment', 'variable', 'region'])
+
+    return pd.DataFrame(rows, index=index)
+
+def format_stats(stats):
+    '''format statistics with each variable's fmt (correlation and fractions to 3 decimal places)'''
+
+    value_cols = ['bias', 'rmse', 'mae', 'model_mean', 'obs_mean']
+    formatted = stats.astype(object).copy()
+
+    for idx, row in stats.iterrows():
+        fmt = cf.get_variable_opts(idx[1])['fmt']
+        for col in stats.columns:
+            if pd.isnull(row[col]):
+                formatted.loc[idx, col] = ''
+            elif col in value_cols:
+                formatted.loc[idx, col] = fmt.format(row[col])
+            elif col == 'n':
+                formatted.loc[idx, col] = f'{int(row[col])}'
+            else:
+                formatted.loc[idx, col] = f'{row[col]:.3f}'
+
+    return formatted
@@ -0,0 +1,139 @@
+'''
+Pressure level wind vectors (e.g. 850 hPa) prepared for quiver and streamline figures.
+
+u and v for each experiment are opened lazily and reduced to what a figure draws: arrows are
+taken from a decimated set of cells (every skip-th cell, or block means), the background speed
+is coarsened to display resolution, and streamlines use block mean vectors on a regular display
+grid. All panels (experiments x times or periods) are computed in one dask pass, so full
+resolution u and v are never held in memory, and the result can be saved for re-plotting.
+
+Usage:
+    import common_functions as cf
+    import wind_functions as wf
+
+    exps = {'Control': 'control_d0198_RAL3P2', 'SM': 'drysoil_d0198_RAL3P2'}
+    times = ['2020-02-09T16:00', '2020-02-10T16:00']
+    ds = wf.quiver_fields(exps, times, skip=18)
+    for exp in ds.experiment.values:
+        for t in ds.time.values:
+            panel = ds.sel(experiment=exp, time=t)
+            ax.pcolormesh(panel.longitude, panel.latitude, panel.speed)
+            ax.quiver(panel.lon_q, panel.lat_q, panel.u_q, panel.v_q, scale=500)
+
+    periods = [('2020-02-08', '2020-02-11', '8-11 Feb')]
+    diff = wf.period_mean_vectors(exps, periods, control='control_d0198_RAL3P2')
+'''
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import common_functions as cf
+
+###############################################################################
+
+def open_wind(exp, level='850hPa', datapath=cf.datapath, aest=True):
+    '''lazy u, v and speed for an experiment at a pressure level (e.g. '850hPa')'''
+
+    u = cf.open_experiment(exp, f'wind_u_{level}', datapath, aest=aest)
+    v = cf.open_experiment(exp, f'wind_v_{level}', datapath, aest=aest)
+    u, v = xr.align(u, v, join='inner')
+
+    ds = xr.Dataset({'u': u, 'v': v})
+    ds['speed'] = np.sqrt(ds.u**2 + ds.v**2)
+
+    return ds
+
+def get_skip(size, width_inches, arrows_per_inch=2.5):
+    '''cell stride giving roughly arrows_per_inch arrows across a panel width_inches wide'''
+
+    return max(1, int(round(size / (width_inches*arrows_per_inch))))
+
+def thin(ds, skip, how='sample'):
+    '''
+    reduce to every skip-th cell ('sample', as [::skip, ::skip]) or to skip x skip block means
+    ('mean', better represents the flow between arrows)
+    '''
+
+    if how == 'sample':
+        return ds.isel(latitude=slice(None, None, skip), longitude=slice(None, None, skip))
+    elif how == 'mean':
+        return ds.coarsen(latitude=skip, longitude=skip, boundary='trim').mean()
+    else:
+        raise ValueError(f'unknown thinning method: {how}')
+
+def rename_grid(ds, suffix):
+    '''rename latitude/longitude so several grids can share one Dataset'''
+
+    return ds.rename({'latitude': f'lat_{suffix}', 'longitude': f'lon_{suffix}'})
+
+def stack_experiments(fields, exps):
+    '''concatenate per-experiment fields along an 'experiment' dim labelled by exps keys'''
+
+    return xr.concat(fields, dim=xr.DataArray(list(exps.keys()), dims='experiment', name='experiment'),
+        join='inner')
+
+def quiver_fields(exps, times, level='850hPa', skip=18, how='sample', speed_factor=1, streamlines=None,
+                  datapath=cf.datapath, aest=True, fname=None):
+    '''
+    display ready wind fields for each experiment and time, computed in one dask pass
+        exps (dict or list): label -> experiment name (or list of experiment names)
+        times (list): times to plot (nearest output time is used)
+        skip (int): arrow stride in grid cells (see get_skip)
+        how (string): 'sample' or 'mean' thinning of the arrows
+        speed_factor (int): coarsening of the background speed (1 keeps full resolution)
+        streamlines (int): if set, block mean u/v on a grid coarsened by this factor (for streamplot)
+        fname (string): save the fields to netcdf
+    returns Dataset with speed on (experiment, time, latitude, longitude), arrows u_q/v_q on
+    (experiment, time, lat_q, lon_q) and optional u_s/v_s on (experiment, time, lat_s, lon_s)
+    '''
+
+    exps = dict(zip(exps, exps)) if not isinstance(exps, dict) else exps
+    times = pd.to_datetime(times)
+
+    panels = []
+    for exp in exps.values():
+        ds = open_wind(exp, level, datapath, aest).sel(time=times, method='nearest')
+        out = xr.Dataset({'speed': thin(ds.speed, speed_factor, 'mean') if speed_factor > 1 else ds.speed})
+        arrows = rename_grid(thin(ds[['u', 'v']], skip, how), 'q')
+        out['u_q'], out['v_q'] = arrows.u, arrows.v
+        if streamlines is not None:
+            stream = rename_grid(thin(ds[['u', 'v']], streamlines, 'mean'), 's')
+            out['u_s'], out['v_s'] = stream.u, stream.v
+        panels.append(out.assign_coords(time=times))
+
+    ds = stack_experiments(panels, exps)
+    ds.attrs = {'level': level, 'skip': skip, 'thinning': how, 'speed_factor': speed_factor}
+
+    print(f'computing wind fields for {len(exps)} experiments and {len(times)} times')
+    ds = ds.compute()
+
+    if fname is not None:
+        os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+        ds.to_netcdf(fname)
+        print(f'saved: {fname}')
+
+    return ds
+
+def period_mean_vectors(exps, periods, level='850hPa', control=None, datapath=cf.datapath, aest=True):
+    '''
+    lazy period mean u, v and mean speed for each experiment and period
+        periods (list): (start, end, label) tuples
+        control (string): if set, return experiment minus control differences
+    returns Dataset (experiment, period, latitude, longitude)
+    '''
+
+    exps = dict(zip(exps, exps)) if not isinstance(exps, dict) else exps
+
+    def period_means(exp):
+        ds = open_wind(exp, level, datapath, aest)
+        means = [ds.sel(time=slice(start, end)).mean(dim='time') for start, end, _ in periods]
+        return xr.concat(means, dim=xr.DataArray([label for _, _, label in periods], dims='period', name='period'))
+
+    ds = stack_experiments([period_means(exp) for exp in exps.values()], exps)
+    if control is not None:
+        ds = ds - period_means(control)
+    ds.attrs = {'level': level, 'control': str(control)}
+
+    return ds